@@ -0,0 +1,30 @@
+"""Run every benchmark with its defaults.
+
+    python -m benchmarks [--output FILE]
+
+Prints (or writes to FILE) a JSON list of the results, one object per
+benchmark, so runs can be compared to catch regressions.
+"""
+import argparse
+import json
+
+from . import bench_bot, bench_channel_db, bench_matcher, bench_membership
+
+BENCHMARKS = (bench_matcher, bench_bot, bench_channel_db, bench_membership)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+    results = json.dumps([benchmark.run() for benchmark in BENCHMARKS],
+                         indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark a bot's message throughput and reply latency on a FakeFlow.
+
+    python -m benchmarks.bench_bot [--messages N] [--channels N]
+        [--send-latency SECS] [--handler-latency SECS]
+
+Posts messages that each trigger a reply, then waits for every reply to
+be sent. Prints a JSON object with the messages handled per second and
+the reply latency percentiles, in milliseconds.
+"""
+import argparse
+import threading
+import time
+
+from flowbot.bot import FlowBot
+from flowbot.tests.mocks import FakeFlow
+
+from .harness import make_bot, percentiles, report
+
+
+class PingBot(FlowBot):
+    """Replies 'pong <n>' to 'ping <n>'."""
+
+    handler_latency = 0
+
+    def commands(self):
+        return {'ping': self.ping}
+
+    def ping(self, message):
+        if self.handler_latency:
+            time.sleep(self.handler_latency)
+        self.reply(message, message['text'].replace('ping', 'pong', 1))
+
+
+def run(messages=2000, channels=20, send_latency=0.0, handler_latency=0.0,
+        timeout=60):
+    flow = FakeFlow(channels=channels,
+                    latency={'send_message': send_latency})
+    posted = {}
+    replied = {}
+    done = threading.Event()
+    send_message = flow.send_message
+
+    def timed_send(**kwargs):
+        send_message(**kwargs)
+        replied[kwargs['msg']] = time.time()
+        if len(replied) == messages:
+            done.set()
+    flow.send_message = timed_send
+
+    bot = make_bot(flow, PingBot)
+    bot.handler_latency = handler_latency
+    bot.run(block=False)
+    cids = sorted(flow.channels)
+    start = time.time()
+    for i in range(messages):
+        posted['pong %d' % i] = time.time()
+        flow.post(cids[i % len(cids)], 'ping %d' % i)
+    done.wait(timeout)
+    elapsed = time.time() - start
+    bot.cleanup()
+
+    latencies = [replied[text] - posted[text] for text in replied]
+    return {
+        'benchmark': 'bot',
+        'messages': messages,
+        'channels': channels,
+        'send_latency': send_latency,
+        'handler_latency': handler_latency,
+        'replied': len(replied),
+        'msgs_per_sec': round(len(replied) / elapsed, 1),
+        'reply_latency_ms': percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--send-latency', type=float, default=0.0)
+    parser.add_argument('--handler-latency', type=float, default=0.0)
+    args = parser.parse_args()
+    report(run(args.messages, args.channels, args.send_latency,
+               args.handler_latency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Benchmark ChannelDb startup time against the db channel's history size.
+
+    python -m benchmarks.bench_channel_db [--sizes N,N,...] [--keys N]
+
+Fills a FakeFlow db channel with N records spread over --keys keys, then
+times creating the ChannelDb with the default lazy loading (one db_key)
+and with db_index, plus a lookup of a key that is not loaded. Prints a
+JSON object with the times in milliseconds for each size.
+"""
+import argparse
+import json
+import time
+
+from flowbot.channel_db import ChannelDb
+from flowbot.config import Config
+from flowbot.tests.mocks import FakeFlow, FakeServer
+
+from .harness import SETTINGS, report
+
+
+def make_flow(size, keys):
+    flow = FakeFlow(channels=0)
+    cid = flow.new_channel(flow.org_id, 'FLOWBOT_DB_CHANNEL')
+    flow.add_history(cid, (json.dumps({'key%d' % (i % keys): i})
+                           for i in range(size)))
+    return flow
+
+
+def startup_ms(flow, **settings):
+    config = Config(dict(SETTINGS, **settings))
+    start = time.time()
+    db = ChannelDb(FakeServer(flow), config)
+    elapsed = time.time() - start
+    start = time.time()
+    db.get('key1')
+    lookup = time.time() - start
+    db.close()
+    return round(1000 * elapsed, 3), round(1000 * lookup, 3)
+
+
+def run(sizes=(100, 1000, 10000), keys=100):
+    results = []
+    for size in sizes:
+        flow = make_flow(size, keys)
+        lazy, lazy_lookup = startup_ms(flow, db_keys=['key0'])
+        indexed, indexed_lookup = startup_ms(flow, db_index=True)
+        results.append({
+            'history': size,
+            'lazy_startup_ms': lazy,
+            'lazy_lookup_ms': lazy_lookup,
+            'index_startup_ms': indexed,
+            'index_lookup_ms': indexed_lookup,
+        })
+    return {'benchmark': 'channel_db', 'keys': keys, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100,1000,10000')
+    parser.add_argument('--keys', type=int, default=100)
+    args = parser.parse_args()
+    report(run([int(s) for s in args.sizes.split(',')], args.keys))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark the compiled CommandMatcher against a linear trigger scan.
+
+    python -m benchmarks.bench_matcher [--triggers N] [--messages N]
+
+Prints a JSON object with the messages matched per second for each approach.
+"""
+import argparse
+import random
+import string
+import time
+
+from flowbot.matcher import CommandMatcher
+
+from .harness import report
+
+
+def linear_scan(commands, text):
+    """The matching FlowBot used before CommandMatcher."""
+    return [command for match, command in commands if match in text]
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_workload(triggers, messages, seed=0):
+    rng = random.Random(seed)
+    commands = [(random_word(rng, rng.randint(4, 10)), i)
+                for i in range(triggers)]
+    texts = []
+    for _ in range(messages):
+        words = [random_word(rng, rng.randint(2, 8)) for _ in range(20)]
+        if rng.random() < 0.2:
+            words.append(rng.choice(commands)[0])
+        rng.shuffle(words)
+        texts.append(' '.join(words))
+    return commands, texts
+
+
+def timed(func, texts):
+    start = time.time()
+    for text in texts:
+        func(text)
+    return len(texts) / (time.time() - start)
+
+
+def run(triggers=500, messages=5000):
+    commands, texts = make_workload(triggers, messages)
+    matcher = CommandMatcher(commands)
+    for text in texts:
+        assert matcher.match(text) == linear_scan(commands, text)
+
+    linear = timed(lambda text: linear_scan(commands, text), texts)
+    compiled = timed(matcher.match, texts)
+    return {
+        'benchmark': 'matcher',
+        'triggers': triggers,
+        'messages': messages,
+        'linear_scan_msgs_per_sec': round(linear, 1),
+        'compiled_msgs_per_sec': round(compiled, 1),
+        'speedup': round(compiled / linear, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--triggers', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=5000)
+    args = parser.parse_args()
+    report(run(args.triggers, args.messages))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Benchmark the admin checks against the size of the org.
+
+    python -m benchmarks.bench_membership [--sizes N,N,...] [--checks N]
+        [--enumerate-latency SECS]
+
+Times FlowBot.from_admin for members of a FakeFlow org of each size: the
+first (cold) check, which enumerates the members, and the average of
+--checks cached (warm) checks. Prints a JSON object with the times in
+microseconds.
+"""
+import argparse
+import time
+
+from flowbot.tests.mocks import FakeFlow
+
+from .harness import make_bot, report
+
+
+def run(sizes=(100, 1000, 10000), checks=10000, enumerate_latency=0.0):
+    results = []
+    for size in sizes:
+        flow = FakeFlow(channels=1, org_members=size, channel_members=size,
+                        latency={
+                            'enumerate_org_members': enumerate_latency,
+                            'enumerate_channel_members': enumerate_latency,
+                        })
+        bot = make_bot(flow)
+        messages = [{'channelId': 'c0', 'senderAccountId': 'm%d' % i}
+                    for i in range(1, size, max(1, size // 100))]
+        start = time.time()
+        bot.from_admin(messages[0])
+        cold = time.time() - start
+        start = time.time()
+        for i in range(checks):
+            bot.from_admin(messages[i % len(messages)])
+        warm = (time.time() - start) / checks
+        results.append({
+            'org_size': size,
+            'cold_check_us': round(1e6 * cold, 2),
+            'warm_check_us': round(1e6 * warm, 2),
+        })
+    return {
+        'benchmark': 'membership',
+        'checks': checks,
+        'enumerate_latency': enumerate_latency,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100,1000,10000')
+    parser.add_argument('--checks', type=int, default=10000)
+    parser.add_argument('--enumerate-latency', type=float, default=0.0)
+    args = parser.parse_args()
+    report(run([int(s) for s in args.sizes.split(',')], args.checks,
+               args.enumerate_latency))
+
+
+if __name__ == '__main__':
+    main()
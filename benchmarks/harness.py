@@ -0,0 +1,40 @@
+"""Shared helpers for the benchmarks that run a bot on a FakeFlow."""
+import json
+
+from mock import patch
+
+from flowbot import bot as bot_module
+from flowbot.bot import FlowBot
+from flowbot.tests.mocks import FakeServer
+
+SETTINGS = {
+    'username': 'bench',
+    'password': 'bench',
+    'org_id': 'org',
+    'metrics': 'none',
+}
+
+
+def make_bot(flow, bot_class=FlowBot, **settings):
+    """Create a bot connected to flow, a FakeFlow, instead of a server."""
+    settings = dict(SETTINGS, **settings)
+    with patch.object(bot_module, 'Server', lambda config: FakeServer(flow)):
+        return bot_class(settings)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return {'p50': ..., 'max': ...} for a list of seconds, in ms."""
+    values = sorted(values)
+    if not values:
+        return {}
+    result = dict(
+        ('p%d' % point, round(1000 * values[
+            min(len(values) - 1, len(values) * point // 100)], 3))
+        for point in points)
+    result['max'] = round(1000 * values[-1], 3)
+    return result
+
+
+def report(result):
+    """Print a benchmark result as JSON."""
+    print(json.dumps(result, indent=2, sort_keys=True))
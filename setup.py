@@ -12,6 +12,7 @@ setup(
     package_dir={"flowbot": "src"},
     packages=["flowbot"],
     license='MPL 2.0',
+    python_requires='>=3.7',
     description='A boilerplate for flowbots.',
     long_description=README,
     url='https://github.com/SpiderOak/flowbot',
@@ -0,0 +1,164 @@
+"""aio.py - an asyncio-native FlowBot."""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .bot import FlowBot
+from .executor import command_options
+import asyncio
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncFlowBot(FlowBot):
+    """A FlowBot that runs its commands on an asyncio event loop.
+
+    Commands may be coroutine functions, so an I/O-bound bot can have many
+    handlers waiting at once without a thread each. Plain functions still
+    work; they run in a bounded thread pool (async_blocking_workers), and
+    may return a coroutine to be awaited on the loop.
+
+    flow's notification loop runs in its own thread and hands messages to
+    the event loop. Outgoing messages go through the same Sender as
+    FlowBot's, so its send rate limits, retries, journal and overflow
+    policies apply. Coroutines should use `await self.run_blocking(...)`
+    for any blocking call, such as self.from_admin or the channel_db.
+    """
+
+    # Commands waiting for a handler slot; only changed on the loop.
+    _waiting = 0
+
+    def __init__(self, settings):
+        """Initialize the bot; the event loop is created by run()."""
+        super(AsyncFlowBot, self).__init__(settings)
+        self.loop = None
+        self._blocking = ThreadPoolExecutor(
+            max_workers=self.config.async_blocking_workers)
+        self._handler_slots = None
+        self._tasks = set()
+
+    def run(self, block=True):
+        """Run the bot on a new event loop until it is interrupted."""
+        if not block:
+            thread = threading.Thread(target=self.run, args=(True,))
+            thread.daemon = True
+            thread.start()
+            return
+        try:
+            asyncio.run(self.run_async())
+        except (KeyboardInterrupt, SystemExit):
+            LOG.info('Interrupt Received')
+
+    async def run_async(self):
+        """Run the bot on the current event loop."""
+        LOG.info('AsyncFlowBot is starting up...')
+        self.loop = asyncio.get_running_loop()
+        self._handler_slots = asyncio.Semaphore(self.config.async_handlers)
+        self.sender.start()
+
+        reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            await self.loop.run_in_executor(
+                reader, self.server.flow.process_notifications)
+        finally:
+            await self.loop.run_in_executor(None, partial(
+                self.sender.stop, drain=self.config.drain_timeout))
+            self.cleanup()
+            reader.shutdown(wait=False)
+            self._blocking.shutdown(wait=False)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking call in the bounded thread pool and await it."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._blocking, partial(func, *args, **kwargs))
+
+    def _queue_message(self, message, future=None):
+        """Queue a message for sending; safe to call from any thread.
+
+        Returns False if the message was dropped because its queue is full.
+        On the event loop this never waits for room: a message that would
+        have to wait is dropped instead.
+        """
+        return self.sender.put(
+            message, future, block=not _on_loop(self.loop))
+
+    async def send_message_async(self, oid, cid, msg, **kwargs):
+        """Queue a message, waiting for room if its queue is full.
+
+        Returns False if the message was dropped anyway.
+        """
+        message = dict(oid=oid, cid=cid, msg=msg, attachments=None,
+                       other_data=None, push_notify_account_ids=None,
+                       timeout=None)
+        message.update(kwargs)
+        return await self.run_blocking(self.sender.put, message)
+
+    def _process_commands(self, message):
+        """Hand the matched commands over to the event loop."""
+        for command in self._commands.match(message.text):
+            if self._admit(command, message):
+                self.loop.call_soon_threadsafe(
+                    self._start_task, self._dispatch(command, message))
+
+    def _start_task(self, coro):
+        """Run coro as a task, keeping a reference until it is done."""
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _backlog(self, message):
+        """The number of commands waiting for a handler slot."""
+        return self._waiting
+
+    async def _dispatch(self, command, message):
+        """Run one command, honouring its timeout and the handler limit."""
+        timeout = command_options(command).get(
+            'timeout', self.config.handler_timeout) or None
+        name = getattr(command, '__name__', repr(command))
+        self._waiting += 1
+        try:
+            await self._handler_slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            received = getattr(message, 'received', None)
+            if received is not None:
+                self.metrics.since(
+                    'handler_wait_seconds', received, command=name)
+            start = time.time()
+            try:
+                result = await asyncio.wait_for(
+                    self._call(command, message), timeout)
+            except asyncio.TimeoutError:
+                LOG.warning('%s timed out after %ss', command, timeout)
+                self.metrics.incr('handler_timeouts', command=name)
+                return
+            except Exception:
+                LOG.exception('%s failed', command)
+                self.metrics.incr('handler_errors', command=name)
+                return
+            finally:
+                self.metrics.since('handler_seconds', start, command=name)
+            self.metrics.incr('handler_completed', command=name)
+        finally:
+            self._handler_slots.release()
+        if isinstance(result, str) and self._replies(command):
+            self.reply(message, result)
+
+    async def _call(self, command, message):
+        if asyncio.iscoroutinefunction(command):
+            return await command(message)
+        result = await self.run_blocking(command, message)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+
+def _on_loop(loop):
+    """Determine if the caller is running on the given event loop."""
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
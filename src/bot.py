@@ -1,16 +1,26 @@
 """bot.py - implements the FlowBot class, a boilerplate for other bots."""
+from .broadcast import BroadcastDeduper, BroadcastResult
 from .channel_db import ChannelDb
+from .channel_directory import ChannelDirectory
 from .server import Server
 from .config import Config
+from .executor import HandlerExecutor, command_options
+from .filters import (
+    CHANNEL, COMMAND, SENDER, AgeFilter, AuthorFilter, ChannelFilter,
+    CommandLimiter, FilterPipeline, SenderRateFilter
+)
+from .journal import JOURNAL_FILENAME, OutboxJournal
+from .matcher import CommandMatcher
+from .membership import ADMIN_STATES, MembershipCache
+from .message import Message
+from .metrics import NULL_METRICS, PhaseTimes, create_metrics
+from .ratelimit import KeyedBuckets, TokenBucket
+from .sender import Sender
+from concurrent.futures import Future
 import logging
+import os
 import threading
 import time
-import json
-
-try:
-    import Queue
-except ImportError:
-    import queue as Queue
 
 
 LOG = logging.getLogger(__name__)
@@ -19,17 +29,68 @@ LOG = logging.getLogger(__name__)
 class FlowBot(object):
     """A boilerplate for bot development."""
 
-    def __init__(self, settings):
-        """Initialize the bot with an active flow instance."""
-        self.config = Config(settings)
-        self.server = Server(self.config)
-        self.account_id = self.server.flow.account_id()
-        self._commands = self._register_commands()
-        self.channel_db = ChannelDb(self.server, self.config)
+    metrics = NULL_METRICS
+
+    def __init__(self, settings, host=None):
+        """Initialize the bot with an active flow instance.
 
-        # Setup Queue
-        # FIXME: Do we want a max size and a handler for that?
-        self.queue = Queue.Queue()
+        A bot run by a BotHost (see flowbot.host) shares the host's flow
+        connection, channel and membership caches, sender, handler
+        executor and metrics instead of creating its own.
+        """
+        started = time.time()
+        self.startup = PhaseTimes()
+        with self.startup.phase('config'):
+            self.config = Config(settings)
+        self.host = host
+        if host:
+            self.metrics = host.metrics
+            self.server = host.server_for(self.config)
+        else:
+            self.metrics = create_metrics(self.config)
+            self.server = Server(self.config)
+            self.startup.extend(self.server.timings)
+        with self.startup.phase('account'):
+            self.account_id = self.server.flow.account_id()
+        self._commands = self._register_commands()
+        self.filters = FilterPipeline(self.message_filters())
+        self.limiter = create_limiter(self.config)
+        if host:
+            self.directory = host.directory_for(self.config)
+            self.membership = host.membership_for(self.config)
+        else:
+            self.directory = ChannelDirectory(
+                self.server.flow,
+                self.config.org_id,
+                ttl=self.config.channel_ttl
+            )
+            self.membership = MembershipCache(
+                self.server.flow,
+                self.config.org_id,
+                ttl=self.config.membership_ttl
+            )
+        with self.startup.phase('channel_db'):
+            self.channel_db = ChannelDb(
+                self.server, self.config, self.directory, metrics=self.metrics)
+
+        if host:
+            self.sender = host.sender_for(self.config)
+            self.executor = host.executor
+        else:
+            # Setup the outbound sender
+            self.sender = create_sender(
+                self.config, self.server.flow.send_message, self.metrics)
+
+            # Setup the command handler executor
+            self.executor = HandlerExecutor(
+                lanes=self.config.handler_lanes,
+                processes=self.config.handler_processes,
+                timeout=self.config.handler_timeout,
+                metrics=self.metrics
+            )
+
+        self._broadcasts = BroadcastDeduper(
+            self.config.broadcast_dedupe_window)
 
         # Setup threads and events
         self.threads_running = False
@@ -42,25 +103,41 @@ class FlowBot(object):
             args=()
         )
 
-        # process_msg_queue
-        self.message_queue_thread = threading.Thread(
-            target=self.process_msg_queue,
-            args=()
-        )
-        self.loop_msg_queue = threading.Event()
+        if not host:
+            self._register_handlers(self.server.flow)
+
+        self.startup.observe(self.metrics)
+        LOG.info('FlowBot set up in %.3fs (%s)',
+                 time.time() - started, self.startup)
 
-        @self.server.flow.message
+    def _register_handlers(self, flow):
+        """Route flow's notifications to this bot."""
+        @flow.message
         def _handle_message(notification_type, message):
             self.handle_message(notification_type, message)
 
+        @flow.channel
+        def _handle_channel(notification_type, data):
+            self.directory.handle_channel_notification(
+                notification_type, data)
+
+        @flow.channel_member_event
+        def _handle_channel_member_event(notification_type, data):
+            self.membership.handle_channel_member_event(
+                notification_type, data)
+
+        @flow.org_member_event
+        def _handle_org_member_event(notification_type, data):
+            self.membership.handle_org_member_event(notification_type, data)
+
     def run(self, block=True):
         """Run the bot"""
         cleaned = False
         try:
             LOG.info('FlowBot is starting up...')
             self.threads_running = True
-            self.loop_msg_queue.set()
-            self.message_queue_thread.start()
+            self.sender.start()
+            self.executor.start()
             if block:
                 self.server.flow.process_notifications()
             else:
@@ -87,47 +164,41 @@ class FlowBot(object):
         LOG.info('FlowBot is shutting down...')
         if self.threads_running:
             LOG.info('Thread cleanup...')
-            self.loop_msg_queue.clear()
+            self.executor.stop()
+            self.sender.stop(drain=self.config.drain_timeout)
+        self.channel_db.close()
         if self.server.flow:
             self.server.flow.terminate()
 
         self.threads_running = False
 
-    def process_msg_queue(self):
-        """Read messages from the queue and send them to flow"""
-        LOG.info('Message queue thread started...')
-        while self.loop_msg_queue.is_set():
-            if not self.queue.empty():
-                try:
-                    LOG.debug('Message found in the queue. Processing')
-                    message = self.queue.get(block=False)
-                    self.server.flow.send_message(**message)
-                    self.queue.task_done()
-                except Queue.Empty:
-                    LOG.debug('Queue empty when attempting to grab message')
-                except:
-                    raise
-            time.sleep(0.1)
-        LOG.info('Message queue thread has ended...')
-
     def send_message(self, oid, cid, msg, attachments=None,
                      other_data=None, push_notify_account_ids=None,
                      timeout=None):
         """Wrapper for send_message.  Send to our queue instead of
         directly to flow.  Prevents blocking on a long-running
-        send_message."""
+        send_message.
 
-        self.queue.put(
-            {
-                "oid": oid,
-                "cid": cid,
-                "msg": msg,
-                "attachments": attachments,
-                "other_data": other_data,
-                "push_notify_account_ids": push_notify_account_ids,
-                "timeout": timeout,
-            }
-        )
+        Returns False if the message was dropped because the outbound queue
+        is full (see the queue_overflow setting).
+        """
+
+        return self._queue_message({
+            "oid": oid,
+            "cid": cid,
+            "msg": msg,
+            "attachments": attachments,
+            "other_data": other_data,
+            "push_notify_account_ids": push_notify_account_ids,
+            "timeout": timeout,
+        })
+
+    def _queue_message(self, message, future=None):
+        """Put send_message keyword arguments on the outbound queue.
+
+        The optional Future completes once the message has been sent.
+        """
+        return self.sender.put(message, future)
 
     def reply(self, original_message, response_msg, highlight=None):
         """Reply to the original message in the same channel."""
@@ -147,28 +218,75 @@ class FlowBot(object):
         )
 
     def message_all_channels(self, msg, highlight=None):
-        """Send a message to all this bot's channels."""
-        for channel_id in self.channels():
-            self.message_channel(channel_id, msg, highlight)
+        """Send a message to all this bot's channels.
+
+        Returns a BroadcastResult, see broadcast().
+        """
+        return self.broadcast(msg, highlight)
+
+    def broadcast(self, msg, highlight=None, channel_ids=None):
+        """Send a message to many channels (default: all of the bot's).
+
+        The sends are spread over the sender workers, within the send rate
+        limits. Returns a BroadcastResult; call its wait() to block until
+        every channel has been sent to, then read sent and failed. The same
+        broadcast repeated within broadcast_dedupe_window seconds is not
+        sent again; it returns the first broadcast's result.
+        """
+        if channel_ids is None:
+            channel_ids = self.channels()
+        channel_ids = list(channel_ids)
+        key = (msg, tuple(highlight or ()), tuple(sorted(channel_ids)))
+        return self._broadcasts.get_or_send(
+            key, lambda: self._send_broadcast(channel_ids, msg, highlight))
+
+    def _send_broadcast(self, channel_ids, msg, highlight):
+        """Queue msg for each channel, with a Future to report back on."""
+        other_data = {'highlighted': highlight} if highlight else None
+        futures = {}
+        for channel_id in channel_ids:
+            futures[channel_id] = future = Future()
+            self._queue_message({
+                "oid": self.config.org_id,
+                "cid": channel_id,
+                "msg": msg,
+                "attachments": None,
+                "other_data": other_data,
+                "push_notify_account_ids": None,
+                "timeout": None,
+            }, future)
+        return BroadcastResult(futures)
 
     def handle_message(self, notification_type, message):
         """Handle an incoming flow message."""
         for m in message.get('regularMessages', []):
-            m = self._conform_other_data(m)
-            self._process_commands(m)
+            self.metrics.incr('messages_received')
+            if self.channel_db.is_db_message(m):
+                self.channel_db.apply_message(m)
+                continue
+            if self.filters.accept(m):
+                self._process_commands(Message(m))
+            else:
+                self.metrics.incr('messages_filtered')
 
-    def _conform_other_data(self, message):
-        """If otherData exists in message, try to make it a dict.
+    def message_filters(self):
+        """Return the filters run on every message before dispatch.
 
-        Until flowapp correctly handles this, we should just try to convert it
-        to a dict if the object exists.
+        Override to add or reorder filters; see flowbot.filters. By default
+        the bot drops its own messages, old messages, and any configured
+        channel or sender rate limits.
         """
-        if 'otherData' in message:
-            try:
-                message['otherData'] = json.loads(message['otherData'])
-            except ValueError:
-                pass
-        return message
+        filters = [
+            AuthorFilter(self.account_id),
+            AgeFilter(self.config.message_age_limit),
+        ]
+        if self.config.channel_allow or self.config.channel_deny:
+            filters.append(ChannelFilter(
+                self.config.channel_allow, self.config.channel_deny))
+        if self.config.sender_rate:
+            filters.append(SenderRateFilter(
+                self.config.sender_rate, self.config.sender_burst))
+        return filters
 
     def mentioned(self, message, account_id=None):
         """Determine if this account_id was mentioned in the message.
@@ -178,9 +296,7 @@ class FlowBot(object):
         if not account_id:
             account_id = self.account_id
 
-        other_data = message.get('otherData', {})
-        highlighted = other_data.get('highlighted', [])
-        return account_id in highlighted
+        return account_id in Message.wrap(message).highlighted
 
     def from_admin(self, message):
         """Determine if this message was sent from an admin
@@ -190,24 +306,20 @@ class FlowBot(object):
 
     def from_channel_admin(self, message):
         """Determine if this message was sent from an admin of the channel."""
-        for member in self.server.flow.enumerate_channel_members(message['channelId']):  # NOQA
-            if member['accountId'] == message['senderAccountId']:
-                if member['state'] in ['o', 'a']:
-                    return True
-        return False
+        with self.metrics.timer('membership_lookup_seconds', scope='channel'):
+            state = self.membership.channel_state(
+                message['channelId'], message['senderAccountId'])
+        return state in ADMIN_STATES
 
     def from_org_admin(self, message):
-        """Determine if this message was sent from an admin of the channel."""
-        for member in self.server.flow.enumerate_org_members(self.config.org_id):  # NOQA
-            if member['accountId'] == message['senderAccountId']:
-                if member['state'] in ['o', 'a']:
-                    return True
-        return False
+        """Determine if this message was sent from an admin of the org."""
+        with self.metrics.timer('membership_lookup_seconds', scope='org'):
+            state = self.membership.org_state(message['senderAccountId'])
+        return state in ADMIN_STATES
 
     def channels(self):
         """Return the list of channel ids to which this bot belongs."""
-        channels = self.server.flow.enumerate_channels(self.config.org_id)
-        return [c['id'] for c in channels]
+        return self.directory.ids()
 
     def _is_author(self, message):
         """Determine if the bot is the author of this message."""
@@ -217,7 +329,9 @@ class FlowBot(object):
         """Override this method to provide customer commands.
 
         Returns a dict where the key is the command trigger and the value is
-        a function which accepts the message as a parameter.
+        a function which accepts the message as a parameter. A trigger is a
+        string found anywhere in the message text, or a flowbot.matcher
+        Word, Prefix or Regex trigger.
         """
         return {}
 
@@ -225,28 +339,100 @@ class FlowBot(object):
         """Register the given commands to this bot.
 
         Expects a dictionary where the key is the command trigger and the value
-        is the function which processes the message.
+        is the function which processes the message. The triggers are compiled
+        into a CommandMatcher so each message is scanned only once.
         """
         commands = []
         for commandKey, commandFunc in self.commands().items():
             commands.append((commandKey, commandFunc))
-        return commands
+        return CommandMatcher(commands)
 
     def _process_commands(self, message):
-        """Detect and execute commands within the message."""
-        if not self._is_author(message) and not self._is_old(message):
-            message_text = message.get('text', '')
-            for match, command in self._commands:
-                if match in message_text:
-                    command(message)
+        """Detect and execute commands within the message.
+
+        The message has already passed the message_filters.
+        """
+        for command in self._commands.match(message.text):
+            if self._admit(command, message):
+                self.executor.submit(
+                    command, message,
+                    self._handle_result if self._replies(command) else None)
+
+    def _admit(self, command, message):
+        """Check the command rate limits and backlog (see self.limiter)."""
+        reason = self.limiter.check(command, message, self._backlog(message))
+        if reason is None:
+            return True
+        self.metrics.incr(
+            'commands_shed',
+            command=getattr(command, '__name__', repr(command)),
+            reason=reason)
+        return False
+
+    def _backlog(self, message):
+        """The number of handler calls waiting ahead of message's."""
+        return self.executor.backlog(message.get('channelId'))
+
+    def _replies(self, command):
+        """Whether the text a command returns is sent as a reply.
+
+        Only for commands marked by @cpu_bound or @cached, unless the
+        reply_with_result setting is on.
+        """
+        return (self.config.reply_with_result or
+                command_options(command).get('reply', False))
+
+    def _handle_result(self, message, result):
+        """Reply with a command's return value, if it returned text."""
+        if isinstance(result, str):
+            self.reply(message, result)
 
     def _is_old(self, message):
         """Determine if this is an old message.
 
         Old message age is configured in Config.
         """
-        if 'creationTime' not in message:
+        creation_time = Message.wrap(message).creation_time
+        if creation_time is None:
             return False
-        creation_time = message['creationTime'] / 1000.0
         age = time.time() - creation_time
         return age > self.config.message_age_limit
+
+
+def create_sender(config, send, metrics=None):
+    """Create the outbound Sender configured by config."""
+    journal = None
+    if config.send_journal:
+        journal = OutboxJournal(
+            os.path.join(config.db_dir, JOURNAL_FILENAME % config.username),
+            interval=config.send_journal_interval
+        )
+    return Sender(
+        send,
+        workers=config.sender_workers,
+        max_queue_size=config.max_queue_size,
+        overflow_policy=config.queue_overflow,
+        put_timeout=config.queue_put_timeout,
+        rate_limit=config.send_rate and TokenBucket(
+            config.send_rate, config.send_burst),
+        channel_rate_limit=config.channel_send_rate and KeyedBuckets(
+            config.channel_send_rate, config.channel_send_burst),
+        retries=config.send_retries,
+        retry_base=config.send_retry_base,
+        retry_max=config.send_retry_max,
+        metrics=metrics,
+        journal=journal
+    )
+
+
+def create_limiter(config):
+    """Create the inbound CommandLimiter configured by config."""
+    return CommandLimiter(
+        limits=[
+            (SENDER, config.command_sender_rate, config.command_sender_burst),
+            (CHANNEL, config.command_channel_rate,
+             config.command_channel_burst),
+            (COMMAND, config.command_rate, config.command_burst),
+        ],
+        max_backlog=config.handler_max_backlog
+    )
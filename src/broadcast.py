@@ -0,0 +1,90 @@
+"""broadcast.py - results and de-duplication for channel broadcasts."""
+from concurrent.futures import Future, wait
+import threading
+import time
+
+
+class BroadcastResult(object):
+    """The outcome of sending one message to many channels.
+
+    Holds a Future per channel id; use wait() to block until every send
+    has finished (or a timeout passes), then read sent and failed.
+    """
+
+    def __init__(self, futures):
+        """Create a result from a {channel_id: Future} dict."""
+        self.futures = futures
+
+    def wait(self, timeout=None):
+        """Wait for the sends to finish; return self."""
+        wait(list(self.futures.values()), timeout)
+        return self
+
+    def done(self):
+        """Determine if every send has finished."""
+        return all(f.done() for f in self.futures.values())
+
+    @property
+    def sent(self):
+        """The channel ids the message was sent to."""
+        return [cid for cid, f in self.futures.items()
+                if f.done() and f.exception() is None]
+
+    @property
+    def failed(self):
+        """A {channel_id: error} dict of the sends that failed."""
+        return dict((cid, f.exception()) for cid, f in self.futures.items()
+                    if f.done() and f.exception() is not None)
+
+    @property
+    def pending(self):
+        """The channel ids still waiting to be sent."""
+        return [cid for cid, f in self.futures.items() if not f.done()]
+
+    def __repr__(self):
+        return '<BroadcastResult sent=%d failed=%d pending=%d>' % (
+            len(self.sent), len(self.failed), len(self.pending))
+
+
+class BroadcastDeduper(object):
+    """Collapse identical broadcasts made within window seconds.
+
+    The first broadcast is sent; repeats within the window get its result
+    instead of sending again. A repeat made while the first is still being
+    queued waits for its result; broadcasts of other messages don't.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.deduplicated = 0
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def get_or_send(self, key, send):
+        """Return the recent result for key, or call send() to make one."""
+        if not self.window:
+            return send()
+        now = time.time()
+        with self._lock:
+            for old in [k for k, (t, _) in self._recent.items()
+                        if now - t > self.window]:
+                del self._recent[old]
+            sending = key not in self._recent
+            if sending:
+                future = Future()
+                self._recent[key] = (now, future)
+            else:
+                self.deduplicated += 1
+                future = self._recent[key][1]
+        if not sending:
+            return future.result()
+        try:
+            result = send()
+        except Exception as err:
+            with self._lock:
+                if self._recent.get(key, (None, None))[1] is future:
+                    del self._recent[key]
+            future.set_exception(err)
+            raise
+        future.set_result(result)
+        return result
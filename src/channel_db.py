@@ -1,35 +1,205 @@
 """ChannelDb impelements a "Channel as a Database" service for bot use."""
+from .channel_directory import ChannelDirectory
+from .metrics import NULL_METRICS
+from .record_store import RecordStore
+from .snapshot import ChannelDbSnapshot, SNAPSHOT_FILENAME
+from .write_buffer import WriteBuffer
+from collections import Counter
+from concurrent.futures import Future
 import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Marks a message holding the compacted history of a key, which replaces
+# every earlier record of that key.
+COMPACTED = 'flowbot.compacted'
 
 
 class ChannelDb(object):
-    """Flow Channel as a Database."""
+    """Flow Channel as a Database.
+
+    By default only the configured db_keys are loaded at startup and any
+    other key is searched for in the db channel when it is requested. With
+    the db_index setting the whole db channel is read once into an index of
+    every key, which is then kept current from the notification stream (see
+    apply_message), so no lookup needs a search. The db_snapshot setting
+    also saves that index to disk, so a restart only reads the messages
+    posted since the last run.
+
+    A db channel message holds either a single record, {key: value}, a
+    batch of records, [{key: value}, ...], or a compacted key history,
+    {COMPACTED: {key: [value, ...]}}.
+    """
+
+    _db_channel_id = None
+    _indexed = False
+    _writer = None
+    _loader = None
+    snapshot = None
+    metrics = NULL_METRICS
+    cache_ttl = 0
 
-    _data = {}
+    def __init__(self, server, config, directory=None, metrics=None):
+        """Initialize the channel db using the server connection passed.
 
-    def __init__(self, server, config):
-        """Initialize the channel db using the server connection passed."""
+        directory is the ChannelDirectory used to find the db channel; one
+        is created if it is not given. Lookups are counted in the metrics
+        sink, if one is given.
+        """
         self.config = config
+        self.metrics = metrics or NULL_METRICS
         self.server = server
         self.account_id = self.server.flow.account_id()
-        self._data = self._get_all(config.db_keys)
+        self.directory = directory or ChannelDirectory(
+            server.flow, config.org_id, ttl=config.channel_ttl)
+        self._db_channel_id = None
+        self._pending_echoes = Counter()
+        self._echo_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._searches = {}
+        self._search_lock = threading.Lock()
+        self._expires = {}
+        self.cache_ttl = config.db_cache_ttl
+        self._loaded = threading.Event()
+        if config.db_snapshot:
+            self.snapshot = ChannelDbSnapshot(os.path.join(
+                config.db_dir, SNAPSHOT_FILENAME % config.username))
+        self._data = RecordStore(
+            max_keys=config.db_max_keys, on_evict=self._evicted)
+        if config.db_write_behind:
+            self._writer = WriteBuffer(
+                self._send_records,
+                batch_size=config.db_batch_size,
+                interval=config.db_flush_interval
+            )
+        if config.fast_start:
+            self._loader = threading.Thread(
+                target=self._load, name='flowbot-channel-db-load')
+            self._loader.daemon = True
+            self._loader.start()
+        else:
+            self._load()
+
+    def _load(self):
+        """Load db_keys, or the whole index, into memory.
+
+        With fast_start this runs in the background and every read waits
+        for it. If it fails, keys are searched for as they are requested.
+        """
+        start = time.time()
+        try:
+            if self.config.db_index or self.snapshot:
+                # A complete index can't evict keys, so it is never capped.
+                self._data = self._load_index()
+                self._indexed = True
+            else:
+                data = self._get_all(self.config.db_keys)
+                with self._write_lock:
+                    for key, records in data.items():
+                        self._data.pin(key, records)
+                        self._expires.pop(key, None)
+            elapsed = time.time() - start
+            self.metrics.observe(
+                'startup_seconds', elapsed, phase='channel_db_load')
+            LOG.info('ChannelDb loaded in %.3fs', elapsed)
+        except Exception:
+            if not self.config.fast_start:
+                raise
+            LOG.exception('ChannelDb failed to load')
+        finally:
+            self._loaded.set()
 
     def get(self, key):
         """Get all records for the given key in the channel database.
 
         If the key has already been loaded into memory (self._data) then just
         fetch it from there. Otherwise, do a search for the key in the
-        db-channel.
+        db-channel, unless the whole channel is indexed, in which case the key
+        has no records. Searched keys are kept in memory for db_cache_ttl
+        seconds, and concurrent lookups of the same key share one search.
         """
-        if key in self._data:
-            return self._data[key]
+        self._wait_loaded()
+        records = self._cached(key)
+        if records is not None:
+            self.metrics.incr('channel_db_hits')
+            return records
+        self.metrics.incr('channel_db_misses')
+        if self._indexed:
+            return []
 
-        messages = self.server.flow.search(
-            oid=self.config.org_id,
-            cid=self._get_db_channel_id(),
-            search=key)
+        with self._search_lock:
+            future = self._searches.get(key)
+            searching = future is None
+            if searching:
+                future = self._searches[key] = Future()
+        if not searching:
+            self.metrics.incr('channel_db_coalesced')
+            return list(future.result())
+        try:
+            with self.metrics.timer('channel_db_search_seconds'):
+                messages = self.server.flow.search(
+                    oid=self.config.org_id,
+                    cid=self._get_db_channel_id(),
+                    search=key)
+            records = self._get_data_from_messages(messages, key)
+            self._cache({key: records})
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(records)
+        finally:
+            with self._search_lock:
+                del self._searches[key]
+        return list(records)
+
+    def get_many(self, keys):
+        """Get all records for each of the given keys, as {key: records}.
+
+        Keys that aren't in memory are read from one scan of the db-channel
+        instead of a search each.
+        """
+        self._wait_loaded()
+        data = {}
+        missing = []
+        for key in keys:
+            records = self._cached(key)
+            if records is None:
+                missing.append(key)
+            else:
+                data[key] = records
+        if missing and self._indexed:
+            data.update((key, []) for key in missing)
+        elif len(missing) == 1:
+            data[missing[0]] = self.get(missing[0])
+        elif missing:
+            self.metrics.incr('channel_db_misses', len(missing))
+            cid = self._get_db_channel_id()
+            messages = []
+            if cid:
+                with self.metrics.timer('channel_db_scan_seconds'):
+                    messages = self.server.flow.enumerate_messages(
+                        self.config.org_id, cid)
+            found = self._collect(messages, missing)
+            self._cache(found)
+            data.update(found)
+        return data
 
-        return self._get_data_from_messages(messages, key)
+    def invalidate(self, key=None):
+        """Forget a searched key (or all of them), so it is searched again.
+
+        Keys loaded at startup (db_keys) or by db_index are kept.
+        """
+        self._wait_loaded()
+        with self._write_lock:
+            keys = list(self._expires) if key is None else [key]
+            for key in keys:
+                if self._expires.pop(key, None) is not None:
+                    self._data.discard(key)
 
     def get_last(self, key):
         """Get the most recent record for the given key."""
@@ -37,35 +207,218 @@ class ChannelDb(object):
         return all_records[-1] if all_records else None
 
     def new(self, key, value):
-        """Save a new record in both memory (self._data) and the db-channel."""
-        self._data.setdefault(key, self.get(key)).append(value)
+        """Save a new record in both memory (self._data) and the db-channel.
 
-        self.server.flow.send_message(
-            cid=self._get_or_create_db_channel(),
-            oid=self.config.org_id,
-            msg=json.dumps({key: value})
-        )
+        Returns a Future that completes once the record is in the
+        db-channel. With db_write_behind the record is posted later, batched
+        with others, from a background thread; otherwise it is posted before
+        new returns.
+        """
+        self._wait_loaded()
+        initial = () if key in self._data else self.get(key)
+        with self._write_lock:
+            # Our own writes keep the key current, so it no longer expires.
+            self._expires.pop(key, None)
+            self._data.append(key, value, initial)
+            if self._writer:
+                return self._writer.add((key, value))
+        self._send_records([(key, value)])
+        return _done()
+
+    def compact(self, key):
+        """Rewrite all the records for key as a single db-channel message.
+
+        Loads and searches stop reading the key's history at the newest
+        compacted message, so they parse far fewer messages afterwards.
+        Returns a completed Future, like new().
+        """
+        self._wait_loaded()
+        with self._write_lock:
+            if self._writer:
+                self._writer.flush()
+            values = self.get(key)
+            self._data.replace(key, values)
+            self._send_message(json.dumps({COMPACTED: {key: values}}))
+        return _done()
+
+    def close(self):
+        """Post any buffered writes and close the snapshot."""
+        self._wait_loaded()
+        if self._writer:
+            self._writer.close()
+        if self.snapshot:
+            self.snapshot.close()
+
+    def is_db_message(self, message):
+        """Determine if a notification message was posted in the db channel."""
+        return (self._db_channel_id is not None and
+                message.get('channelId') == self._db_channel_id)
+
+    def apply_message(self, message):
+        """Add the records in a new db channel message to memory.
+
+        With db_index every record is added to the index; otherwise only
+        records of keys already in memory are, which keeps them current
+        with writes from other processes. Call it for each regular message
+        where is_db_message is true.
+        """
+        self._wait_loaded()
+        if not self._is_author(message):
+            return
+        records = self._records(message)
+        if self.snapshot and self.snapshot.is_new(message):
+            self.snapshot.save([(message, records)])
+        text = _message_data(message).get('text')
+        with self._echo_lock:
+            if self._pending_echoes.get(text):
+                self._pending_echoes[text] -= 1
+                return
+        if not self._indexed:
+            records = [r for r in records if r[0] in self._data]
+        with self._write_lock:
+            _apply_records(self._data, records)
+
+    def _wait_loaded(self):
+        """Block until the startup load (see _load) has finished."""
+        loader = self._loader
+        if (loader is not None and not self._loaded.is_set() and
+                loader is not threading.current_thread()):
+            self._loaded.wait()
 
     def _get_all(self, keys):
         """Load records for each of the given keys into a dict."""
-        data = {}
-        if keys:
-            for key in keys:
-                data[key] = self.get(key)
+        return self.get_many(keys) if keys else {}
+
+    def _load_index(self):
+        """Read every record in the db channel into a store of all keys.
+
+        With a snapshot, start from the saved records and only parse the
+        messages posted after the snapshot's position.
+        """
+        cid = self._get_db_channel_id()
+        data = RecordStore(self.snapshot.load(self.config.org_id, cid)
+                           if self.snapshot else None)
+        if not cid:
+            return data
+        messages = self.server.flow.enumerate_messages(
+            self.config.org_id, cid)
+        if self.snapshot:
+            messages = [m for m in messages if self.snapshot.is_new(m)]
+        messages = sorted(
+            messages, key=lambda m: _message_data(m).get('creationTime', 0))
+        seen = []
+        for message in messages:
+            if self._is_author(message):
+                records = self._records(message)
+                _apply_records(data, records)
+                seen.append((message, records))
+        if self.snapshot and seen:
+            self.snapshot.save(seen)
+        LOG.info('channel db indexed %d keys, %d new messages',
+                 len(data), len(messages))
         return data
 
     def _get_data_from_messages(self, messages, key):
         """Retrieve records with the given key saved in the set of messages."""
-        data = []
-        for message in messages:
+        return self._collect(messages, [key])[key]
+
+    def _collect(self, messages, keys):
+        """Retrieve {key: records} for the given keys from the messages.
+
+        Messages are read newest first, stopping at each key's most recent
+        compacted history.
+        """
+        messages = sorted(
+            messages, key=lambda m: _message_data(m).get('creationTime', 0))
+        data = dict((key, []) for key in keys)
+        complete = set()
+        for message in reversed(messages):
+            if len(complete) == len(data):
+                break
             try:
-                if self._is_author(message):
-                    message_text = json.loads(message['data']['text'])
-                    data.append(message_text[key])
+                if not self._is_author(message):
+                    continue
             except:
-                pass
+                continue
+            for key, value, replace in reversed(self._records(message)):
+                if key not in data or key in complete:
+                    continue
+                if replace:
+                    data[key].extend(reversed(value))
+                    complete.add(key)
+                else:
+                    data[key].append(value)
+        for records in data.values():
+            records.reverse()
         return data
 
+    def _cached(self, key):
+        """Return key's records from memory, or None if not there or stale."""
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.invalidate(key)
+            return None
+        return self._data.get(key)
+
+    def _evicted(self, key):
+        """Forget the expiry of a key the record store has evicted."""
+        self._expires.pop(key, None)
+
+    def _cache(self, found):
+        """Keep searched {key: records} in memory for cache_ttl seconds.
+
+        A key written or loaded in the meantime is left as it is.
+        """
+        if not self.cache_ttl:
+            return
+        expires = time.time() + self.cache_ttl
+        with self._write_lock:
+            for key, records in found.items():
+                if key not in self._data:
+                    self._data.replace(key, records)
+                    self._expires[key] = expires
+
+    def _records(self, message):
+        """Return the (key, value, replace) records in a db channel message.
+
+        replace is True for a compacted history, whose value is the full
+        list of the key's records.
+        """
+        try:
+            body = json.loads(_message_data(message)['text'])
+        except (KeyError, TypeError, ValueError):
+            return []
+        if isinstance(body, dict) and isinstance(body.get(COMPACTED), dict):
+            return [(key, values, True)
+                    for key, values in body[COMPACTED].items()]
+        if isinstance(body, dict):
+            body = [body]
+        if not isinstance(body, list):
+            return []
+        return [(key, value, False)
+                for item in body if isinstance(item, dict)
+                for key, value in item.items()]
+
+    def _send_records(self, records):
+        """Post (key, value) records as one db-channel message."""
+        if len(records) == 1:
+            key, value = records[0]
+            self._send_message(json.dumps({key: value}))
+        else:
+            self._send_message(
+                json.dumps([{key: value} for key, value in records]))
+
+    def _send_message(self, msg):
+        """Post a message to the db-channel."""
+        # Already applied to memory; skip it when it comes back from flow.
+        with self._echo_lock:
+            self._pending_echoes[msg] += 1
+        self.server.flow.send_message(
+            cid=self._get_or_create_db_channel(),
+            oid=self.config.org_id,
+            msg=msg
+        )
+
     def _get_or_create_db_channel(self):
         """Get or create the db channel."""
         config_channel_id = self._get_db_channel_id()
@@ -76,17 +429,48 @@ class ChannelDb(object):
         return config_channel_id
 
     def _get_db_channel_id(self):
-        """Determine if the db channel already exists."""
-        for channel in self.server.flow.enumerate_channels(self.config.org_id):
-            if channel['name'] == self.config.db_channel:
-                return channel['id']
-        return None
+        """Determine if the db channel already exists.
+
+        The id is remembered once found, so the channel list is only
+        consulted until the db channel exists.
+        """
+        if not self._db_channel_id:
+            self._db_channel_id = self.directory.id_for(
+                self.config.db_channel)
+        return self._db_channel_id
 
     def _create_db_channel(self):
         """Create a db channel for the given org."""
-        return self.server.flow.new_channel(
+        self._db_channel_id = self.server.flow.new_channel(
             self.config.org_id, self.config.db_channel)
+        self.directory.add(self._db_channel_id, self.config.db_channel)
+        return self._db_channel_id
 
     def _is_author(self, message):
         """Determine if the bot is the author of this message."""
-        return message['data']['senderAccountId'] == self.account_id
+        return _message_data(message)['senderAccountId'] == self.account_id
+
+
+def _apply_records(store, records):
+    """Apply (key, value, replace) records to a RecordStore."""
+    for key, value, replace in records:
+        if replace:
+            store.replace(key, value)
+        else:
+            store.append(key, value)
+
+
+def _done():
+    """Return a Future that has already completed."""
+    future = Future()
+    future.set_result(None)
+    return future
+
+
+def _message_data(message):
+    """Return the message fields of a search result or plain message.
+
+    Search results wrap the message in a 'data' dict; notifications and
+    enumerated messages do not.
+    """
+    return message.get('data', message)
@@ -0,0 +1,67 @@
+"""channel_directory.py - a cached, name-indexed list of the bot's channels."""
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ChannelDirectory(object):
+    """Cache the channels this account belongs to, indexed by name.
+
+    The list is loaded with one enumerate_channels call and reused until it
+    is ttl seconds old (0 reloads it every time) or flow reports a channel
+    change.
+    """
+
+    def __init__(self, flow, org_id, ttl=300):
+        """Create a directory of the org's channels loaded through flow."""
+        self.flow = flow
+        self.org_id = org_id
+        self.ttl = ttl
+        self._channels = None
+        self._by_name = {}
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def channels(self):
+        """Return the channel dicts, as from flow.enumerate_channels."""
+        with self._lock:
+            if self._channels is None or time.time() >= self._expires:
+                self._load()
+            return self._channels
+
+    def ids(self):
+        """Return the ids of every channel."""
+        return [c['id'] for c in self.channels()]
+
+    def id_for(self, name):
+        """Return the id of the channel with the given name, or None."""
+        self.channels()
+        return self._by_name.get(name)
+
+    def add(self, channel_id, name):
+        """Record a channel this process just created."""
+        with self._lock:
+            if self._channels is not None:
+                self._channels = self._channels + [
+                    {'id': channel_id, 'name': name}]
+            self._by_name[name] = channel_id
+
+    def invalidate(self):
+        """Reload the channel list on next use."""
+        with self._lock:
+            self._channels = None
+
+    def handle_channel_notification(self, notification_type, data):
+        """Invalidate the list when flow reports a channel change."""
+        LOG.debug('channel directory invalidated by %s', notification_type)
+        self.invalidate()
+
+    def _load(self):
+        """Enumerate the channels and rebuild the name index."""
+        channels = self.flow.enumerate_channels(self.org_id)
+        self._channels = channels
+        self._by_name = dict((c['name'], c['id']) for c in channels)
+        self._expires = time.time() + self.ttl
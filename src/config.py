@@ -1,12 +1,36 @@
 """settings.py - Configuration model for FlowBot."""
 from flow import definitions
+from .journal import JOURNAL_INTERVAL_SECS
+from .metrics import METRICS_SINKS, REGISTRY
+from .sender import OVERFLOW_POLICIES, BLOCK
 import base64
+import os
 
 
 MESSAGE_AGE_SECS = 2 * 60
+SENDER_WORKERS = 4
+MAX_QUEUE_SIZE = 10000
+SEND_RETRIES = 3
+SEND_RETRY_BASE_SECS = 0.5
+SEND_RETRY_MAX_SECS = 30
+QUEUE_PUT_TIMEOUT_SECS = 5
+MEMBERSHIP_TTL_SECS = 60
+CHANNEL_TTL_SECS = 5 * 60
+BROADCAST_DEDUPE_SECS = 10
+HANDLER_LANES = 4
+ASYNC_HANDLERS = 100
+ASYNC_BLOCKING_WORKERS = 16
+DB_BATCH_SIZE = 50
+DB_MAX_KEYS = 1000
+DB_CACHE_TTL_SECS = 5 * 60
+DB_FLUSH_INTERVAL_SECS = 1.0
+STATSD_PORT = 8125
 
+# Encoded photos, by (path, modification time, size).
+_PHOTOS = {}
 
-class ImproperlyConfigured(object):
+
+class ImproperlyConfigured(Exception):
     """Raise when the settings dictionary passed is improper."""
     pass
 
@@ -26,8 +50,79 @@ class Config(object):
         self.photo = self.get_photo(settings)
 
         self.message_age_limit = self.get_message_age(settings)
+        self.channel_allow = settings.get('channel_allow', None)
+        self.channel_deny = settings.get('channel_deny', None)
+        self.sender_rate = settings.get('sender_rate', 0)
+        self.sender_burst = settings.get('sender_burst', None)
+        self.sender_workers = self.get_positive_int(
+            settings, 'sender_workers', SENDER_WORKERS)
+        self.max_queue_size = self.get_non_negative_int(
+            settings, 'max_queue_size', MAX_QUEUE_SIZE)
+        self.queue_overflow = self.get_choice(
+            settings, 'queue_overflow', OVERFLOW_POLICIES, BLOCK)
+        self.queue_put_timeout = settings.get(
+            'queue_put_timeout', QUEUE_PUT_TIMEOUT_SECS)
+        self.send_rate = settings.get('send_rate', 0)
+        self.send_burst = settings.get('send_burst', None)
+        self.channel_send_rate = settings.get('channel_send_rate', 0)
+        self.channel_send_burst = settings.get('channel_send_burst', None)
+        self.send_retries = self.get_non_negative_int(
+            settings, 'send_retries', SEND_RETRIES)
+        self.send_retry_base = settings.get(
+            'send_retry_base', SEND_RETRY_BASE_SECS)
+        self.send_retry_max = settings.get(
+            'send_retry_max', SEND_RETRY_MAX_SECS)
+        self.send_journal = settings.get('send_journal', False)
+        self.send_journal_interval = settings.get(
+            'send_journal_interval', JOURNAL_INTERVAL_SECS)
+        self.drain_timeout = settings.get('drain_timeout', 0)
+        self.handler_lanes = self.get_non_negative_int(
+            settings, 'handler_lanes', HANDLER_LANES)
+        self.handler_processes = self.get_non_negative_int(
+            settings, 'handler_processes', 0)
+        self.handler_timeout = settings.get('handler_timeout', 0)
+        self.reply_with_result = settings.get('reply_with_result', False)
+        self.handler_max_backlog = self.get_non_negative_int(
+            settings, 'handler_max_backlog', 0)
+        self.command_sender_rate = settings.get('command_sender_rate', 0)
+        self.command_sender_burst = settings.get('command_sender_burst', None)
+        self.command_channel_rate = settings.get('command_channel_rate', 0)
+        self.command_channel_burst = settings.get(
+            'command_channel_burst', None)
+        self.command_rate = settings.get('command_rate', 0)
+        self.command_burst = settings.get('command_burst', None)
+        self.async_handlers = self.get_positive_int(
+            settings, 'async_handlers', ASYNC_HANDLERS)
+        self.async_blocking_workers = self.get_positive_int(
+            settings, 'async_blocking_workers', ASYNC_BLOCKING_WORKERS)
+        self.worker_processes = self.get_non_negative_int(
+            settings, 'worker_processes', 0)
+        self.membership_ttl = self.get_non_negative_int(
+            settings, 'membership_ttl', MEMBERSHIP_TTL_SECS)
+        self.channel_ttl = self.get_non_negative_int(
+            settings, 'channel_ttl', CHANNEL_TTL_SECS)
+        self.broadcast_dedupe_window = settings.get(
+            'broadcast_dedupe_window', BROADCAST_DEDUPE_SECS)
+        self.metrics = self.get_choice(
+            settings, 'metrics', METRICS_SINKS, REGISTRY)
+        self.metrics_prefix = settings.get('metrics_prefix', 'flowbot')
+        self.statsd_host = settings.get('statsd_host', 'localhost')
+        self.statsd_port = self.get_positive_int(
+            settings, 'statsd_port', STATSD_PORT)
         self.db_channel = settings.get('db_channel', 'FLOWBOT_DB_CHANNEL')
         self.db_keys = settings.get('db_keys', [])
+        self.db_index = settings.get('db_index', False)
+        self.db_snapshot = settings.get('db_snapshot', False)
+        self.db_max_keys = self.get_non_negative_int(
+            settings, 'db_max_keys', DB_MAX_KEYS)
+        self.db_cache_ttl = self.get_non_negative_int(
+            settings, 'db_cache_ttl', DB_CACHE_TTL_SECS)
+        self.fast_start = settings.get('fast_start', False)
+        self.db_write_behind = settings.get('db_write_behind', False)
+        self.db_batch_size = self.get_positive_int(
+            settings, 'db_batch_size', DB_BATCH_SIZE)
+        self.db_flush_interval = settings.get(
+            'db_flush_interval', DB_FLUSH_INTERVAL_SECS)
         self.flowappglue = settings.get('flowappglue', "")
         self.uri = settings.get('uri', definitions.DEFAULT_URI)
         self.host = settings.get('host', definitions.DEFAULT_SERVER)
@@ -57,14 +152,46 @@ class Config(object):
                 'Message age limit should be integer number of seconds.')
         return message_age_limit
 
+    def get_positive_int(self, settings, key, default):
+        """Return an integer setting that must be at least 1."""
+        value = settings.get(key, default)
+        if type(value) != int or value < 1:
+            raise ImproperlyConfigured(
+                '%s should be a positive integer.' % key)
+        return value
+
+    def get_non_negative_int(self, settings, key, default):
+        """Return an integer setting that may be 0 but not negative."""
+        value = settings.get(key, default)
+        if type(value) != int or value < 0:
+            raise ImproperlyConfigured(
+                '%s should be a non-negative integer.' % key)
+        return value
+
+    def get_choice(self, settings, key, choices, default):
+        """Return a setting that must be one of the given choices."""
+        value = settings.get(key, default)
+        if value not in choices:
+            raise ImproperlyConfigured(
+                '%s should be one of: %s' % (key, ', '.join(choices)))
+        return value
+
     def get_photo(self, settings):
-        """Return a base64 image URI based on image path in settings."""
+        """Return a base64 image URI based on image path in settings.
+
+        The URI is remembered until the file changes, so bots sharing a
+        photo (or restarted in the same process) only encode it once.
+        """
         path = settings.get('photo', None)
 
         if path:
-            with open(path, "rb") as image_file:
-                image_raw_data = image_file.read()
-            return "data:image/png;base64,%s" % (
-                base64.b64encode(image_raw_data),
-            )
+            stat = os.stat(path)
+            key = (path, stat.st_mtime, stat.st_size)
+            if key not in _PHOTOS:
+                with open(path, "rb") as image_file:
+                    image_raw_data = image_file.read()
+                _PHOTOS[key] = "data:image/png;base64,%s" % (
+                    base64.b64encode(image_raw_data),
+                )
+            return _PHOTOS[key]
         return None
@@ -1,4 +1,9 @@
+from .filters import LIMIT_SCOPES, SENDER
+from .message import Message
+from .metrics import NULL_METRICS
+from .reply_cache import ReplyCache
 from functools import wraps
+import inspect
 
 
 def mentioned(bot_command):
@@ -7,6 +12,7 @@ def mentioned(bot_command):
     def _func(bot, message, *args, **kwargs):
         if bot.mentioned(message):
             return bot_command(bot, message, *args, **kwargs)
+        _skipped(bot, bot_command, 'not_mentioned')
     return _func
 
 
@@ -16,6 +22,7 @@ def admin_only(bot_command):
     def _func(bot, message, *args, **kwargs):
         if bot.from_admin(message):
             return bot_command(bot, message, *args, **kwargs)
+        _skipped(bot, bot_command, 'not_admin')
     return _func
 
 
@@ -25,6 +32,7 @@ def channel_admin_only(bot_command):
     def _func(bot, message, *args, **kwargs):
         if bot.from_channel_admin(message):
             return bot_command(bot, message, *args, **kwargs)
+        _skipped(bot, bot_command, 'not_channel_admin')
     return _func
 
 
@@ -34,4 +42,101 @@ def org_admin_only(bot_command):
     def _func(bot, message, *args, **kwargs):
         if bot.from_org_admin(message):
             return bot_command(bot, message, *args, **kwargs)
+        _skipped(bot, bot_command, 'not_org_admin')
     return _func
+
+
+def handler_limits(timeout=None, concurrency=None):
+    """Limit how the decorated bot command runs in the handler executor.
+
+    After timeout seconds its channel stops waiting for it and moves on;
+    at most concurrency calls of it run at once, others wait up to timeout.
+    """
+    def decorator(bot_command):
+        options = dict(getattr(bot_command, 'flowbot_options', {}))
+        if timeout is not None:
+            options['timeout'] = timeout
+        if concurrency is not None:
+            options['concurrency'] = concurrency
+        bot_command.flowbot_options = options
+        return bot_command
+    return decorator
+
+
+def rate_limit(rate, burst=None, per=SENDER):
+    """Shed calls of the decorated bot command beyond rate per second.
+
+    The limit is kept per 'sender', per 'channel', or for all calls of the
+    command ('command'), and allows bursts of up to burst calls (default
+    max(1, rate)). Shed calls are dropped before they reach the handler
+    executor, so they cost no lane time.
+    """
+    if per not in LIMIT_SCOPES:
+        raise ValueError('per should be one of: %s' % ', '.join(LIMIT_SCOPES))
+
+    def decorator(bot_command):
+        options = dict(getattr(bot_command, 'flowbot_options', {}))
+        options['rate_limit'] = (per, rate, burst)
+        bot_command.flowbot_options = options
+        return bot_command
+    return decorator
+
+
+def cached(ttl=60, key=None, max_size=256):
+    """Reuse the decorated bot command's reply for ttl seconds.
+
+    For commands that only look something up and return their reply.
+    key(message) gives what the reply depends on; by default the channel
+    and the message text, lowercased with its whitespace collapsed. The
+    max_size most recently used replies are kept, and identical requests
+    that arrive while the command is running wait for its reply instead of
+    running it again. The bot replies with the text the command returns;
+    replies of None are not cached. The decorated
+    command's cache (a ReplyCache, with hit and miss stats()) is its cache
+    attribute.
+    """
+    key = key or reply_key
+
+    def decorator(bot_command):
+        if inspect.iscoroutinefunction(bot_command):
+            raise TypeError('cached does not support async commands')
+        cache = ReplyCache(ttl, max_size)
+
+        @wraps(bot_command)
+        def _func(bot, message, *args, **kwargs):
+            return cache.get_or_call(
+                (id(bot), key(message)),
+                lambda: bot_command(bot, message, *args, **kwargs))
+        _func.cache = cache
+        options = dict(getattr(_func, 'flowbot_options', {}))
+        options['reply'] = True
+        _func.flowbot_options = options
+        return _func
+    return decorator
+
+
+def reply_key(message):
+    """The default cached key: the channel and the normalized text."""
+    message = Message.wrap(message)
+    return (message.channel_id,
+            ' '.join((message.text or '').lower().split()))
+
+
+def cpu_bound(bot_command):
+    """Run the decorated command in the handler process pool.
+
+    The command must be a module-level function taking the message, so it
+    can be sent to another process. If it returns a string, the bot replies
+    with it. Without a process pool (handler_processes) it runs in a thread.
+    """
+    options = dict(getattr(bot_command, 'flowbot_options', {}))
+    options['process'] = True
+    options['reply'] = True
+    bot_command.flowbot_options = options
+    return bot_command
+
+
+def _skipped(bot, bot_command, reason):
+    """Count a command call a decorator's check turned away."""
+    getattr(bot, 'metrics', NULL_METRICS).incr(
+        'commands_skipped', command=bot_command.__name__, reason=reason)
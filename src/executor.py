@@ -0,0 +1,268 @@
+"""executor.py - runs command handlers off the notification thread."""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from queue import Queue
+from .metrics import NULL_METRICS
+from .sender import shard_index
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+# Put on a lane's queue to tell it to stop.
+_STOP = object()
+
+
+def command_options(command):
+    """Return the options set on a command by the handler decorators."""
+    return getattr(command, 'flowbot_options', {})
+
+
+class HandlerExecutor(object):
+    """Run command handlers on a pool of lanes instead of the caller.
+
+    Each message goes to a lane picked by its channel id. A lane runs its
+    channels' commands one at a time, in arrival order, while other lanes
+    run in parallel, so a slow handler only delays its own channel(s).
+
+    A command's options (see flowbot.decorators.handler_limits and
+    cpu_bound) can give it a timeout, after which its lane stops waiting
+    for it, a limit on how many copies run at once, or send it to a process
+    pool. With no lanes, handlers run on the calling thread as before.
+
+    A handler that can't be started (say the process pool broke because a
+    worker process died) is counted as an error like one that fails; a
+    broken process pool is replaced.
+    """
+
+    def __init__(self, lanes=4, processes=0, timeout=0, on_result=None,
+                 name='flowbot-handler', metrics=None):
+        """Create an executor.
+
+        timeout is the default per-command timeout in seconds (0 for none).
+        on_result(message, result) is called with each handler's return
+        value. metrics is the flowbot.metrics sink handler timings go to.
+        """
+        self.timeout = timeout
+        self.on_result = on_result
+        self.name = name
+        self.metrics = metrics or NULL_METRICS
+        self.counts = dict.fromkeys(
+            ('submitted', 'completed', 'errors', 'timeouts', 'rejected'), 0)
+        self._queues = [Queue() for _ in range(lanes)]
+        self._threads = []
+        self._processes = processes
+        self._process_pool = None
+        self._timeout_pool = None
+        self._semaphores = {}
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the lanes and pools."""
+        if self._processes:
+            self._process_pool = ProcessPoolExecutor(self._processes)
+        if self._queues:
+            self._timeout_pool = ThreadPoolExecutor(
+                max_workers=len(self._queues) * 2)
+        for i, queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run_lane,
+                args=(queue,),
+                name='%s-%d' % (self.name, i)
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=1.0):
+        """Stop the lanes once they reach the end of their queues."""
+        for queue in self._queues:
+            queue.put(_STOP)
+        current = threading.current_thread()
+        for thread in self._threads:
+            if thread is not current:
+                thread.join(timeout)
+        self._threads = []
+        for pool in (self._process_pool, self._timeout_pool):
+            if pool:
+                pool.shutdown(wait=False)
+
+    def submit(self, command, message, on_result=None):
+        """Queue command(message) on the message's channel lane.
+
+        on_result, if given, replaces the executor's on_result for this
+        call.
+        """
+        self._count('submitted')
+        on_result = on_result or self.on_result
+        if not self._queues:
+            self._execute(command, message, on_result)
+            return
+        lane = shard_index(message.get('channelId'), len(self._queues))
+        self._queues[lane].put((command, message, on_result))
+
+    def backlog(self, channel_id=None):
+        """The number of handler calls waiting for their lane.
+
+        With channel_id, only those waiting for that channel's lane.
+        """
+        if channel_id is not None and self._queues:
+            lane = shard_index(channel_id, len(self._queues))
+            return self._queues[lane].qsize()
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        """Return a dict of counters and gauges for the executor."""
+        stats = dict(self.counts)
+        stats['backlog'] = self.backlog()
+        stats['running'] = self._running
+        stats['lanes'] = len(self._queues)
+        return stats
+
+    def _run_lane(self, queue):
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                break
+            try:
+                self._execute(*item)
+            except Exception:
+                LOG.exception('handler lane error')
+
+    def _execute(self, command, message, on_result):
+        """Run one handler, honouring its timeout and concurrency limit."""
+        options = command_options(command)
+        timeout = options.get('timeout', self.timeout) or None
+        semaphore = self._semaphore(command, options.get('concurrency'))
+        if semaphore and not semaphore.acquire(*_wait_args(timeout)):
+            self._count('rejected', command)
+            LOG.warning('%s is at its concurrency limit, dropping call',
+                        _name(command))
+            return
+
+        received = getattr(message, 'received', None)
+        if received is not None:
+            self.metrics.since(
+                'handler_wait_seconds', received, command=_name(command))
+        try:
+            future = self._submit(command, message, options, timeout)
+        except Exception:
+            self._count('errors', command)
+            LOG.exception("%s couldn't be started", _name(command))
+            if semaphore:
+                semaphore.release()
+            return
+        if future is None:
+            self._call(command, message, on_result, semaphore)
+            return
+
+        with self._lock:
+            self._running += 1
+        start = time.time()
+        future.add_done_callback(lambda f: self._finished(
+            f, command, message, on_result, semaphore, start))
+        try:
+            future.result(timeout)
+        except FutureTimeout:
+            self._count('timeouts', command)
+            LOG.warning('%s timed out after %ss, moving on',
+                        _name(command), timeout)
+        except Exception:
+            pass  # reported by _finished
+
+    def _submit(self, command, message, options, timeout):
+        """Start a handler in a pool; return None to run it here instead."""
+        if options.get('process') and self._process_pool:
+            pool = self._process_pool
+            try:
+                return pool.submit(command, message)
+            except BrokenProcessPool:
+                LOG.error('handler process pool is broken, replacing it')
+                self._replace_process_pool(pool)
+                return self._process_pool.submit(command, message)
+        if timeout and self._timeout_pool:
+            return self._timeout_pool.submit(command, message)
+        return None
+
+    def _replace_process_pool(self, broken):
+        """Start a new process pool in place of a broken one."""
+        with self._lock:
+            if self._process_pool is broken:
+                self._process_pool = ProcessPoolExecutor(self._processes)
+        broken.shutdown(wait=False)
+
+    def _call(self, command, message, on_result, semaphore):
+        """Run a handler on the current thread."""
+        with self._lock:
+            self._running += 1
+        start = time.time()
+        try:
+            result = command(message)
+        except Exception:
+            self._count('errors', command)
+            LOG.exception('%s failed', _name(command))
+        else:
+            self._count('completed', command)
+            self._deliver(message, result, on_result)
+        finally:
+            self.metrics.since(
+                'handler_seconds', start, command=_name(command))
+            with self._lock:
+                self._running -= 1
+            if semaphore:
+                semaphore.release()
+
+    def _finished(self, future, command, message, on_result, semaphore,
+                  start):
+        """Done callback for handlers run in a pool."""
+        self.metrics.since('handler_seconds', start, command=_name(command))
+        with self._lock:
+            self._running -= 1
+        if semaphore:
+            semaphore.release()
+        if future.exception() is not None:
+            self._count('errors', command)
+            LOG.error('handler failed: %r', future.exception())
+        else:
+            self._count('completed', command)
+            self._deliver(message, future.result(), on_result)
+
+    def _deliver(self, message, result, on_result):
+        if result is not None and on_result:
+            try:
+                on_result(message, result)
+            except Exception:
+                LOG.exception('handler result callback failed')
+
+    def _semaphore(self, command, limit):
+        if not limit:
+            return None
+        key = _key(command)
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(limit)
+            return self._semaphores[key]
+
+    def _count(self, name, command=None):
+        with self._lock:
+            self.counts[name] += 1
+        if command is not None:
+            self.metrics.incr('handler_%s' % name, command=_name(command))
+
+
+def _name(command):
+    return getattr(command, '__name__', repr(command))
+
+
+def _key(command):
+    """A stable key for a command, the same for each bound method object."""
+    return getattr(command, '__func__', command)
+
+
+def _wait_args(timeout):
+    """Arguments for a blocking acquire, with an optional timeout."""
+    return (True, timeout) if timeout else (True,)
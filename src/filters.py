@@ -0,0 +1,179 @@
+"""filters.py - cheap checks that drop incoming messages before dispatch.
+
+Filters run on the raw message dict flow delivered, before it is wrapped
+in a Message or matched against commands, so a dropped message costs no
+parsing. Put the cheapest, most selective filters first.
+
+CommandLimiter is the second line: it runs per matched command, just
+before the command is handed to the handler executor.
+"""
+from .executor import command_options
+from .ratelimit import KeyedBuckets
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+# What a command rate limit is kept per: each sender, each channel, or one
+# bucket for all of a command's calls.
+SENDER = 'sender'
+CHANNEL = 'channel'
+COMMAND = 'command'
+LIMIT_SCOPES = (SENDER, CHANNEL, COMMAND)
+
+
+class MessageFilter(object):
+    """Base class for a pipeline stage; accept() returns False to drop."""
+
+    name = 'filter'
+
+    def accept(self, message):
+        return True
+
+
+class AuthorFilter(MessageFilter):
+    """Drop messages sent by this bot."""
+
+    name = 'author'
+
+    def __init__(self, account_id):
+        self.account_id = account_id
+
+    def accept(self, message):
+        return message.get('senderAccountId') != self.account_id
+
+
+class AgeFilter(MessageFilter):
+    """Drop messages older than max_age seconds, e.g. a backlog replay."""
+
+    name = 'age'
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+    def accept(self, message):
+        created = message.get('creationTime')
+        if created is None:
+            return True
+        return time.time() - created / 1000.0 <= self.max_age
+
+
+class ChannelFilter(MessageFilter):
+    """Only accept the allowed channels (if any), and never denied ones."""
+
+    name = 'channel'
+
+    def __init__(self, allow=None, deny=None):
+        self.allow = frozenset(allow) if allow else None
+        self.deny = frozenset(deny or ())
+
+    def accept(self, message):
+        channel_id = message.get('channelId')
+        if channel_id in self.deny:
+            return False
+        return self.allow is None or channel_id in self.allow
+
+
+class SenderRateFilter(MessageFilter):
+    """Drop messages from a sender beyond rate per second (burst allowed)."""
+
+    name = 'sender_rate'
+
+    def __init__(self, rate, burst=None):
+        self.buckets = KeyedBuckets(rate, burst)
+
+    def accept(self, message):
+        return self.buckets.consume(message.get('senderAccountId'))
+
+
+class FilterPipeline(object):
+    """Run filters in order and count what each one drops."""
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.passed = 0
+        self.dropped = dict((f.name, 0) for f in self.filters)
+        self._lock = threading.Lock()
+
+    def accept(self, message):
+        """Return True if every filter accepts the message."""
+        for message_filter in self.filters:
+            if not message_filter.accept(message):
+                with self._lock:
+                    self.dropped[message_filter.name] += 1
+                return False
+        with self._lock:
+            self.passed += 1
+        return True
+
+    def stats(self):
+        """Return the pass count and the per-filter drop counts."""
+        with self._lock:
+            return {'passed': self.passed, 'dropped': dict(self.dropped)}
+
+
+class CommandLimiter(object):
+    """Decide whether a matched command may run, so floods are shed early.
+
+    Each limit is a token bucket per sender, per channel or per command.
+    The limits given here apply to every command; a command may add its own
+    with flowbot.decorators.rate_limit. With max_backlog, a command is also
+    shed while that many handler calls are already waiting for its lane,
+    so one noisy channel cannot hold up the channels on other lanes.
+    """
+
+    def __init__(self, limits=(), max_backlog=0):
+        """limits is a list of (scope, rate, burst); a rate of 0 is off."""
+        self.max_backlog = max_backlog
+        self.shed = {}
+        self._limits = [(scope, KeyedBuckets(rate, burst))
+                        for scope, rate, burst in limits if rate]
+        self._command_limits = {}
+        self._lock = threading.Lock()
+
+    def check(self, command, message, backlog=0):
+        """Return None if command may run for message, else why not.
+
+        backlog is the number of handler calls waiting ahead of it.
+        """
+        if self.max_backlog and backlog >= self.max_backlog:
+            return self._shed('overload')
+        for scope, buckets in self._limits + self._command_limit(command):
+            if not buckets.consume(_scope_key(scope, command, message)):
+                return self._shed('%s_rate' % scope)
+        return None
+
+    def stats(self):
+        """Return how many commands were shed, by reason."""
+        with self._lock:
+            return dict(self.shed)
+
+    def _command_limit(self, command):
+        """The command's own rate_limit, as a list of zero or one limit."""
+        limit = command_options(command).get('rate_limit')
+        if not limit:
+            return []
+        # Each access to a bound method creates a new object; key by the
+        # function so every call shares the bucket.
+        key = getattr(command, '__func__', command)
+        with self._lock:
+            if key not in self._command_limits:
+                scope, rate, burst = limit
+                self._command_limits[key] = (
+                    scope, KeyedBuckets(rate, burst))
+            return [self._command_limits[key]]
+
+    def _shed(self, reason):
+        with self._lock:
+            self.shed[reason] = self.shed.get(reason, 0) + 1
+        return reason
+
+
+def _scope_key(scope, command, message):
+    if scope == SENDER:
+        return message.get('senderAccountId')
+    if scope == CHANNEL:
+        return message.get('channelId')
+    return getattr(command, '__func__', command)
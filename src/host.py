@@ -0,0 +1,215 @@
+"""host.py - run many FlowBots in one process on shared infrastructure."""
+from .bot import create_sender
+from .channel_directory import ChannelDirectory
+from .config import Config, ImproperlyConfigured
+from .executor import HandlerExecutor
+from .membership import MembershipCache
+from .metrics import create_metrics
+from .server import Server
+import logging
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+class BotHost(object):
+    """Run several FlowBots in one process.
+
+    Bots that log in with the same username share one Server (one flow
+    connection and flowappglue), which joins each of their orgs. They also
+    share one profile, so their display_name, biography and photo
+    settings must match. Bots of the same account and org share its
+    channel directory and membership cache. Every bot shares the host's
+    sender workers, handler executor and metrics, so each extra bot costs
+    little more than its commands and ChannelDb.
+
+    Each flow connection has one notification thread. Its messages are
+    routed to the bots of the message's org (or all the account's bots
+    when flow doesn't say), and each bot filters and dispatches them as a
+    standalone bot would. Run the host, not the bots.
+    """
+
+    def __init__(self, bots, settings=None):
+        """Create the host and its bots.
+
+        bots is a list of (bot_class, bot_settings) pairs. settings sizes
+        the shared sender, executor and metrics, using the same keys as the
+        bot settings; missing keys come from the first bot's settings.
+        """
+        if not bots:
+            raise ValueError('BotHost needs at least one bot')
+        self.config = Config(dict(bots[0][1], **(settings or {})))
+        self.metrics = create_metrics(self.config)
+        self._servers = {}
+        self._orgs = {}
+        self._profiles = {}
+        self._directories = {}
+        self._memberships = {}
+        self._threads = []
+        self.sender = create_sender(self.config, self._send, self.metrics)
+        self.executor = HandlerExecutor(
+            lanes=self.config.handler_lanes,
+            processes=self.config.handler_processes,
+            timeout=self.config.handler_timeout,
+            metrics=self.metrics
+        )
+        self.bots = [bot_class(bot_settings, host=self)
+                     for bot_class, bot_settings in bots]
+        for username, server in self._servers.items():
+            self._register_handlers(server.flow, [
+                bot for bot in self.bots
+                if bot.config.username == username])
+
+    def server_for(self, config):
+        """Return the shared Server for config's account.
+
+        The first bot of an account creates it; later bots of other orgs
+        have it join their org.
+        """
+        username = config.username
+        profile = (config.display_name, config.biography, config.photo)
+        if username not in self._servers:
+            self._servers[username] = Server(config)
+            self._orgs[username] = set([config.org_id])
+            self._profiles[username] = profile
+        elif self._profiles[username] != profile:
+            raise ImproperlyConfigured(
+                'Bots of account %s have different profiles' % username)
+        elif config.org_id not in self._orgs[username]:
+            self._servers[username].join_org(config.org_id)
+            self._orgs[username].add(config.org_id)
+        return self._servers[username]
+
+    def directory_for(self, config):
+        """Return the shared ChannelDirectory for config's account and org."""
+        key = (config.username, config.org_id)
+        if key not in self._directories:
+            self._directories[key] = ChannelDirectory(
+                self._servers[config.username].flow,
+                config.org_id,
+                ttl=config.channel_ttl
+            )
+        return self._directories[key]
+
+    def membership_for(self, config):
+        """Return the shared MembershipCache for config's account and org."""
+        key = (config.username, config.org_id)
+        if key not in self._memberships:
+            self._memberships[key] = MembershipCache(
+                self._servers[config.username].flow,
+                config.org_id,
+                ttl=config.membership_ttl
+            )
+        return self._memberships[key]
+
+    def sender_for(self, config):
+        """Return the shared sender, sending as config's account."""
+        return AccountSender(self.sender, config.username)
+
+    def run(self, block=True):
+        """Start the shared workers and every notification thread."""
+        LOG.info('BotHost is starting %d bot(s)...', len(self.bots))
+        self.sender.start()
+        self.executor.start()
+        for username, server in self._servers.items():
+            thread = threading.Thread(
+                target=server.flow.process_notifications,
+                name='flowbot-host-%s' % username
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if not block:
+            return
+        try:
+            while any(t.is_alive() for t in self._threads):
+                for thread in self._threads:
+                    thread.join(1.0)
+        except (KeyboardInterrupt, SystemExit):
+            LOG.info('Interrupt Received')
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        """Stop the shared workers and close every bot's connection."""
+        LOG.info('BotHost is shutting down...')
+        self.executor.stop()
+        self.sender.stop(drain=self.config.drain_timeout)
+        for bot in self.bots:
+            bot.channel_db.close()
+        for server in self._servers.values():
+            if server.flow:
+                server.flow.terminate()
+        self._threads = []
+
+    def _send(self, account, **message):
+        """Send a message through the given account's flow connection."""
+        self._servers[account].flow.send_message(**message)
+
+    def _register_handlers(self, flow, bots):
+        """Route one flow connection's notifications to its bots."""
+        by_org = {}
+        for bot in bots:
+            by_org.setdefault(bot.config.org_id, []).append(bot)
+        directories = _unique(bot.directory for bot in bots)
+        memberships = _unique(bot.membership for bot in bots)
+
+        @flow.message
+        def _handle_message(notification_type, data):
+            for bot, messages in _route(data, bots, by_org):
+                bot.handle_message(
+                    notification_type, {'regularMessages': messages})
+
+        @flow.channel
+        def _handle_channel(notification_type, data):
+            for directory in directories:
+                directory.handle_channel_notification(
+                    notification_type, data)
+
+        @flow.channel_member_event
+        def _handle_channel_member_event(notification_type, data):
+            for membership in memberships:
+                membership.handle_channel_member_event(
+                    notification_type, data)
+
+        @flow.org_member_event
+        def _handle_org_member_event(notification_type, data):
+            for membership in memberships:
+                membership.handle_org_member_event(notification_type, data)
+
+
+class AccountSender(object):
+    """A view of a shared Sender that sends as one account.
+
+    Anything other than put() is passed through to the shared Sender.
+    """
+
+    def __init__(self, sender, account):
+        self.sender = sender
+        self.account = account
+
+    def put(self, message, future=None):
+        """Queue send_message keyword arguments for this account."""
+        return self.sender.put(dict(message, account=self.account), future)
+
+    def __getattr__(self, name):
+        return getattr(self.sender, name)
+
+
+def _route(data, bots, by_org):
+    """Return (bot, messages) pairs for the bots the messages belong to."""
+    routed = {}
+    for message in data.get('regularMessages', []):
+        oid = message.get('orgId')
+        for bot in by_org.get(oid, []) if oid else bots:
+            routed.setdefault(id(bot), (bot, []))[1].append(message)
+    return routed.values()
+
+
+def _unique(items):
+    """The distinct objects in items, in order."""
+    seen = {}
+    for item in items:
+        seen.setdefault(id(item), item)
+    return list(seen.values())
@@ -0,0 +1,100 @@
+"""journal.py - an on-disk journal of the outbound messages not yet sent."""
+import json
+import logging
+import sqlite3
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_FILENAME = 'flowbot-outbox-%s.sqlite'
+
+# How often buffered journal changes are written and synced, in seconds.
+JOURNAL_INTERVAL_SECS = 0.1
+
+
+class OutboxJournal(object):
+    """Keep the Sender's queued messages on disk until they are sent.
+
+    add() and done() only buffer the change; a background thread writes
+    the buffered changes every interval seconds in one transaction, so
+    there is one disk sync per interval however many messages are sent. A
+    message added and sent within the same interval never reaches the
+    disk. After a crash, the messages of the last interval may be lost;
+    messages that were sent but not yet marked done are sent again.
+    """
+
+    def __init__(self, path, interval=JOURNAL_INTERVAL_SECS,
+                 name='flowbot-journal'):
+        """Open (or create) the journal database at path."""
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Held while a batch is taken and written, so batches stay in order.
+        self._write_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY, message TEXT NOT NULL)')
+        self._pending = self._conn.execute(
+            'SELECT id, message FROM outbox ORDER BY id').fetchall()
+        self._next_id = self._pending[-1][0] + 1 if self._pending else 1
+        self._added = {}
+        self._done = []
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pending(self):
+        """Return the (id, message) pairs left unsent by the last run."""
+        return [(id_, json.loads(text)) for id_, text in self._pending]
+
+    def add(self, message):
+        """Journal a message (a JSON-serializable dict); return its id."""
+        text = json.dumps(message)
+        with self._lock:
+            id_ = self._next_id
+            self._next_id += 1
+            self._added[id_] = text
+        return id_
+
+    def done(self, id_):
+        """Forget a message that has been sent (or given up on)."""
+        with self._lock:
+            if self._added.pop(id_, None) is None:
+                self._done.append(id_)
+
+    def flush(self):
+        """Write the buffered changes now."""
+        with self._write_lock:
+            with self._lock:
+                added, self._added = self._added, {}
+                done, self._done = self._done, []
+            if not added and not done:
+                return
+            try:
+                with self._conn:
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO outbox (id, message) '
+                        'VALUES (?, ?)', sorted(added.items()))
+                    self._conn.executemany(
+                        'DELETE FROM outbox WHERE id = ?',
+                        [(id_,) for id_ in done])
+            except sqlite3.Error:
+                LOG.exception('outbox journal write failed')
+
+    def close(self):
+        """Write the buffered changes and close the journal."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        self._conn.close()
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
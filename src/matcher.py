@@ -0,0 +1,163 @@
+"""matcher.py - compiles command triggers into a single-pass matcher.
+
+A plain string trigger fires when it appears anywhere in the message text.
+Wrap a trigger to change how it matches:
+
+- Word('hello') only matches 'hello' as a whole word
+- Prefix('!cmd') only matches at the start of the message, as a whole word
+- Regex(r'issue #\\d+') matches if the regular expression is found
+
+All literal triggers (plain, Word and Prefix) are compiled into one
+combined regular expression, so the text is scanned once however many
+commands are registered.
+"""
+import re
+
+# Below this many plain string triggers, `in` (a C substring search per
+# trigger) beats a combined regex, so the matcher keeps the linear scan.
+LINEAR_SCAN_MAX = 64
+
+
+class Trigger(object):
+    """Base class for a command trigger that matches in a special way."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.pattern == other.pattern)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.pattern))
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.pattern)
+
+
+class Word(Trigger):
+    """Match the trigger only as a whole word."""
+
+
+class Prefix(Trigger):
+    """Match the trigger only as the first word of the message."""
+
+
+class Regex(Trigger):
+    """Match a regular expression anywhere in the message."""
+
+    def __init__(self, pattern, flags=0):
+        super(Regex, self).__init__(pattern)
+        self.regex = re.compile(pattern, flags)
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class CommandMatcher(object):
+    """Find the commands triggered by a message in a single pass."""
+
+    def __init__(self, commands):
+        """Compile a list of (trigger, command) pairs.
+
+        Commands are returned from match() in the order given here.
+        """
+        self.commands = list(commands)
+        self._always = set()
+        self._regexes = []
+        # literal -> [(index, kind)] for the triggers using that literal
+        literals = {}
+        for index, (trigger, _) in enumerate(self.commands):
+            if isinstance(trigger, Regex):
+                self._regexes.append((index, trigger.regex))
+            elif isinstance(trigger, Trigger):
+                literals.setdefault(trigger.pattern, []).append(
+                    (index, type(trigger)))
+            elif not trigger:
+                self._always.add(index)
+            else:
+                literals.setdefault(trigger, []).append((index, None))
+        literals.pop('', None)
+
+        self._linear = None
+        self._scanner = None
+        self._triggers = {}
+        if len(literals) <= LINEAR_SCAN_MAX and all(
+                kind is None for triggers in literals.values()
+                for _, kind in triggers):
+            self._linear = sorted(
+                (index, literal) for literal, triggers in literals.items()
+                for index, _ in triggers)
+        elif literals:
+            # The scanner reports the longest literal at each position, which
+            # also matches every shorter literal that is its prefix.
+            for literal in literals:
+                self._triggers[literal] = [
+                    (index, kind, end)
+                    for end in range(1, len(literal) + 1)
+                    for index, kind in literals.get(literal[:end], ())
+                ]
+            self._scanner = re.compile(
+                _trie_pattern(sorted(literals)), re.DOTALL)
+
+    def match(self, text):
+        """Return the commands triggered by text, each at most once."""
+        matched = set(self._always)
+        if self._linear is not None:
+            matched.update(
+                index for index, literal in self._linear if literal in text)
+        if self._scanner is not None:
+            # Resume one character after each hit rather than after its end,
+            # so literals overlapping the hit are still found.
+            found = self._scanner.search(text)
+            while found is not None:
+                start = found.start()
+                for index, kind, length in self._triggers[found.group()]:
+                    if index not in matched and self._accept(
+                            text, kind, start, start + length):
+                        matched.add(index)
+                found = self._scanner.search(text, start + 1)
+        for index, regex in self._regexes:
+            if index not in matched and regex.search(text):
+                matched.add(index)
+        return [self.commands[i][1] for i in sorted(matched)]
+
+    def _accept(self, text, kind, start, end):
+        """Check a literal match at text[start:end] against its kind."""
+        if kind is None:
+            return True
+        if kind is Prefix and text[:start].strip():
+            return False
+        return ((start == 0 or not _is_word_char(text[start - 1])) and
+                (end == len(text) or not _is_word_char(text[end])))
+
+
+def _trie_pattern(literals):
+    """Build a regex matching the longest of the sorted literals.
+
+    Literals sharing a prefix share a branch, so the regex engine tries
+    one character at a time instead of every literal in turn.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    terminal = '' in node
+    branches = [re.escape(char) + _node_pattern(child)
+                for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and not terminal:
+        return branches[0]
+    pattern = '(?:%s)' % '|'.join(branches)
+    return pattern + '?' if terminal else pattern
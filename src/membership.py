@@ -0,0 +1,118 @@
+"""membership.py - a TTL cache of channel and org membership."""
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+# Member states with admin rights: owner and admin.
+ADMIN_STATES = frozenset(['o', 'a'])
+
+
+class MembershipCache(object):
+    """Cache channel and org membership as accountId -> state dicts.
+
+    Entries expire after ttl seconds (0 disables caching) and are dropped
+    early when flow reports a membership change, so an admin check is a
+    dict lookup instead of a full member enumeration. An enumeration that
+    was running when its entry was invalidated is returned but not cached,
+    so a stale member list is never served for a whole ttl.
+    """
+
+    def __init__(self, flow, org_id, ttl=60):
+        """Create a cache that loads members through the given flow."""
+        self.flow = flow
+        self.org_id = org_id
+        self.ttl = ttl
+        self._entries = {}
+        # Bumped by each invalidation of a key, or of a whole kind.
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def channel_members(self, cid):
+        """Return {accountId: state} for the members of a channel."""
+        return self._members(
+            ('channel', cid), self.flow.enumerate_channel_members, cid)
+
+    def org_members(self, oid=None):
+        """Return {accountId: state} for the members of an org."""
+        oid = oid or self.org_id
+        return self._members(
+            ('org', oid), self.flow.enumerate_org_members, oid)
+
+    def channel_state(self, cid, account_id):
+        """Return an account's state in a channel, None if not a member."""
+        return self.channel_members(cid).get(account_id)
+
+    def org_state(self, account_id, oid=None):
+        """Return an account's state in an org, None if not a member."""
+        return self.org_members(oid).get(account_id)
+
+    def invalidate_channel(self, cid=None):
+        """Forget one channel's members, or every channel's if cid is None."""
+        self._invalidate('channel', cid)
+
+    def invalidate_org(self, oid=None):
+        """Forget one org's members, or every org's if oid is None."""
+        self._invalidate('org', oid)
+
+    def handle_channel_member_event(self, notification_type, data):
+        """Invalidate the channels named in a channel-member-event."""
+        cids = _ids(data, 'channelId')
+        if not cids:
+            self.invalidate_channel()
+        for cid in cids:
+            self.invalidate_channel(cid)
+
+    def handle_org_member_event(self, notification_type, data):
+        """Invalidate the orgs named in an org-member-event."""
+        oids = _ids(data, 'orgId')
+        if not oids:
+            self.invalidate_org()
+        for oid in oids:
+            self.invalidate_org(oid)
+
+    def _members(self, key, enumerate_members, id_):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation(key)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        members = dict(
+            (member['accountId'], member['state'])
+            for member in enumerate_members(id_)
+        )
+        if self.ttl:
+            with self._lock:
+                if self._generation(key) == generation:
+                    self._entries[key] = (now + self.ttl, members)
+        return members
+
+    def _generation(self, key):
+        """The invalidation counts of key and its kind; hold the lock."""
+        return (self._generations.get(key, 0),
+                self._generations.get(key[0], 0))
+
+    def _invalidate(self, kind, id_):
+        with self._lock:
+            if id_ is None:
+                for key in [k for k in self._entries if k[0] == kind]:
+                    del self._entries[key]
+                self._generations[kind] = self._generations.get(kind, 0) + 1
+            else:
+                key = (kind, id_)
+                self._entries.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+        LOG.debug('membership cache invalidated: %s %s', kind, id_ or '*')
+
+
+def _ids(data, field):
+    """Collect the values of field from a notification payload."""
+    items = data if isinstance(data, list) else [data]
+    return set(
+        item[field] for item in items
+        if isinstance(item, dict) and item.get(field)
+    )
@@ -0,0 +1,124 @@
+"""message.py - a lazily decoded envelope for incoming flow messages."""
+import json
+import time
+
+
+class Message(dict):
+    """An incoming flow message.
+
+    Behaves exactly like the message dict flow delivered, except that
+    otherData (which flow sends as a JSON string) is decoded the first time
+    it is read instead of for every message, and the fields the bot checks
+    on every message are cached as attributes. received is the time the
+    bot received it.
+    """
+
+    __slots__ = ('_decoded', '_highlighted', '_creation_time', 'received')
+
+    def __init__(self, *args, **kwargs):
+        super(Message, self).__init__(*args, **kwargs)
+        self.received = time.time()
+        self._decoded = False
+        self._highlighted = None
+        self._creation_time = False
+
+    @classmethod
+    def wrap(cls, message):
+        """Return message as a Message, without copying one that is."""
+        return message if isinstance(message, cls) else cls(message)
+
+    def __getitem__(self, key):
+        if key == 'otherData' and not self._decoded:
+            self._decode()
+        return super(Message, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if key == 'otherData' and not self._decoded:
+            self._decode()
+        return super(Message, self).get(key, default)
+
+    def pop(self, key, *default):
+        if key == 'otherData' and not self._decoded:
+            self._decode()
+        return super(Message, self).pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key == 'otherData' and not self._decoded:
+            self._decode()
+        return super(Message, self).setdefault(key, default)
+
+    def popitem(self):
+        self._decode()
+        return super(Message, self).popitem()
+
+    def __iter__(self):
+        # Not dict's own iterator, so dict(message), {**message} and
+        # update(message) copy through keys() and __getitem__, which
+        # decodes otherData, instead of copying the raw values.
+        return super(Message, self).__iter__()
+
+    def items(self):
+        self._decode()
+        return super(Message, self).items()
+
+    def values(self):
+        self._decode()
+        return super(Message, self).values()
+
+    def copy(self):
+        self._decode()
+        return Message(self)
+
+    def __reduce__(self):
+        self._decode()
+        return (Message, (dict(self),))
+
+    @property
+    def sender(self):
+        """The account id of the sender."""
+        return super(Message, self).get('senderAccountId')
+
+    @property
+    def channel_id(self):
+        """The id of the channel the message was posted in."""
+        return super(Message, self).get('channelId')
+
+    @property
+    def text(self):
+        """The message text, '' if there is none."""
+        return super(Message, self).get('text', '')
+
+    @property
+    def creation_time(self):
+        """The creation time in seconds since the epoch, or None."""
+        if self._creation_time is False:
+            millis = super(Message, self).get('creationTime')
+            self._creation_time = None if millis is None else millis / 1000.0
+        return self._creation_time
+
+    @property
+    def highlighted(self):
+        """The frozenset of account ids highlighted in the message."""
+        if self._highlighted is None:
+            other_data = self.get('otherData') or {}
+            highlighted = ()
+            if isinstance(other_data, dict):
+                highlighted = other_data.get('highlighted') or ()
+            self._highlighted = frozenset(highlighted)
+        return self._highlighted
+
+    def _decode(self):
+        """If otherData exists, try to make it a dict (only once).
+
+        Until flowapp correctly handles this, we should just try to convert
+        it to a dict if the object exists.
+        """
+        if self._decoded:
+            return
+        self._decoded = True
+        other_data = super(Message, self).get('otherData')
+        if isinstance(other_data, (str, bytes)):
+            try:
+                self['otherData'] = json.loads(other_data)
+            except ValueError:
+                pass
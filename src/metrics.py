@@ -0,0 +1,243 @@
+"""metrics.py - counters and latency histograms for the bot's hot paths."""
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import socket
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+# Sinks for the metrics setting
+REGISTRY = 'registry'
+STATSD = 'statsd'
+NONE = 'none'
+METRICS_SINKS = (REGISTRY, STATSD, NONE)
+
+# Histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics(object):
+    """Where the bot reports its counters and timings.
+
+    This base class discards everything; Registry and Statsd are the
+    sinks that keep them. A sink must be safe to call from any thread and
+    cheap enough to call on every message.
+    """
+
+    def incr(self, name, value=1, **labels):
+        """Add value to the counter name."""
+
+    def observe(self, name, seconds, **labels):
+        """Record a duration, in seconds, in the histogram name."""
+
+    def timer(self, name, **labels):
+        """Return a context manager that observes how long its block takes."""
+        return Timer(self, name, labels)
+
+    def since(self, name, start, **labels):
+        """Observe the time elapsed since start (a time.time() value)."""
+        self.observe(name, time.time() - start, **labels)
+
+    def dump(self):
+        """Return the current values as text, if the sink keeps them."""
+        return ''
+
+
+class Timer(object):
+    """Times a with block into a Metrics histogram."""
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(
+            self.name, time.time() - self.start, **self.labels)
+
+
+class PhaseTimes(object):
+    """How long each phase of a multi-step job (such as startup) took.
+
+    Phases may be timed from several threads at once; they are kept in
+    the order they finish.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Return a context manager that times its block as phase name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        """Record that phase name took seconds."""
+        with self._lock:
+            self.phases.append((name, seconds))
+
+    def extend(self, other):
+        """Add every phase recorded by another PhaseTimes."""
+        for name, seconds in list(other.phases):
+            self.add(name, seconds)
+
+    def observe(self, metrics, name='startup_seconds'):
+        """Record each phase in the histogram name, labelled by phase."""
+        for phase, seconds in list(self.phases):
+            metrics.observe(name, seconds, phase=phase)
+
+    def __str__(self):
+        return ', '.join(
+            '%s %.3fs' % (name, seconds) for name, seconds in self.phases)
+
+
+class Registry(Metrics):
+    """Keeps the metrics in process; dump() renders them for Prometheus.
+
+    Counters are exposed as <prefix>_<name>_total and histograms as the
+    usual _bucket, _sum and _count series.
+    """
+
+    def __init__(self, prefix='flowbot', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, one for +Inf, then the sum.
+                histogram = self._histograms[key] = (
+                    [0] * (len(self.buckets) + 1) + [0.0])
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def counter(self, name, **labels):
+        """Return the value of a counter."""
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0)
+
+    def histogram(self, name, **labels):
+        """Return a dict with the count and sum of a histogram."""
+        with self._lock:
+            histogram = self._histograms.get((name, _label_key(labels)))
+            if histogram is None:
+                return {'count': 0, 'sum': 0.0}
+            return {'count': sum(histogram[:-1]), 'sum': histogram[-1]}
+
+    def dump(self):
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, list(values))
+                for key, values in self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = '%s_%s_total' % (self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %s' % (metric, _format_labels(labels), value))
+        for (name, labels), values in histograms:
+            metric = '%s_%s' % (self.prefix, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s histogram' % metric)
+            cumulative = 0
+            bounds = ['%g' % b for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, values[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    metric, _format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('%s_sum%s %r' % (
+                metric, _format_labels(labels), values[-1]))
+            lines.append('%s_count%s %d' % (
+                metric, _format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+class Statsd(Metrics):
+    """Sends the metrics to a statsd server over UDP.
+
+    Sends are fire and forget, so a missing server never slows the bot.
+    Label values are appended to the metric name, dot separated.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='flowbot'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def incr(self, name, value=1, **labels):
+        self._send('%s:%d|c' % (self._name(name, labels), value))
+
+    def observe(self, name, seconds, **labels):
+        self._send('%s:%.3f|ms' % (self._name(name, labels), seconds * 1000))
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name]
+        parts.extend(
+            str(value).replace('.', '_').replace(':', '_')
+            for _, value in _label_key(labels))
+        return '.'.join(parts)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except (IOError, OSError) as err:
+            LOG.debug('statsd send failed: %s', err)
+
+
+# Used when no sink is configured.
+NULL_METRICS = Metrics()
+
+
+def create_metrics(config):
+    """Return the metrics sink chosen by the config's metrics setting."""
+    if config.metrics == REGISTRY:
+        return Registry(prefix=config.metrics_prefix)
+    if config.metrics == STATSD:
+        return Statsd(
+            config.statsd_host, config.statsd_port, config.metrics_prefix)
+    return NULL_METRICS
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels)
@@ -0,0 +1,76 @@
+"""ratelimit.py - token bucket rate limiters."""
+from collections import OrderedDict
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allow rate events per second on average, in bursts of up to burst."""
+
+    def __init__(self, rate, burst=None):
+        """Create a full bucket; burst defaults to max(1, rate)."""
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Take tokens if they are available; return whether they were."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def delay(self, tokens=1):
+        """Return how many seconds until tokens will be available."""
+        with self._lock:
+            self._refill()
+            missing = tokens - self._tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate else float('inf')
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class KeyedBuckets(object):
+    """A TokenBucket per key (sender, channel, ...), created on demand.
+
+    At most max_keys buckets are kept; the least recently used are dropped,
+    which only forgets that a key was recently busy.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        """Return the bucket for key."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(
+                    self.rate, self.burst)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def consume(self, key, tokens=1):
+        """Take tokens from key's bucket; return whether they were there."""
+        return self.bucket(key).consume(tokens)
+
+    def delay(self, key, tokens=1):
+        """Return how many seconds until key's bucket has tokens."""
+        return self.bucket(key).delay(tokens)
@@ -0,0 +1,105 @@
+"""record_store.py - the thread-safe in-memory store behind ChannelDb."""
+from collections import OrderedDict
+import threading
+
+
+class RecordStore(object):
+    """A thread-safe {key: [records]} map with an optional size cap.
+
+    Pinned keys (the preloaded db_keys) are always kept. Other keys are
+    kept in least-recently-used order and the oldest are evicted once there
+    are more than max_keys of them (0 means no limit); on_evict(key) is
+    called, with the store's lock held, for each. Readers get a copy of a
+    key's records, so writers never change a list being read.
+    """
+
+    def __init__(self, data=None, max_keys=0, pinned=(), on_evict=None):
+        """Create a store, optionally seeded with a {key: [records]} dict."""
+        self.max_keys = max_keys
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._pinned = {}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        for key in pinned:
+            self._pinned[key] = []
+        for key, records in (data or {}).items():
+            self._set(key, list(records))
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._pinned or key in self._lru
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pinned) + len(self._lru)
+
+    def __getitem__(self, key):
+        records = self.get(key)
+        if records is None:
+            raise KeyError(key)
+        return records
+
+    def get(self, key, default=None):
+        """Return a copy of key's records, or default if it isn't stored."""
+        with self._lock:
+            if key in self._pinned:
+                return list(self._pinned[key])
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                return list(self._lru[key])
+        return default
+
+    def keys(self):
+        """Return every stored key."""
+        with self._lock:
+            return list(self._pinned) + list(self._lru)
+
+    def as_dict(self):
+        """Return a {key: [records]} copy of the whole store."""
+        with self._lock:
+            data = dict((k, list(v)) for k, v in self._lru.items())
+            data.update((k, list(v)) for k, v in self._pinned.items())
+            return data
+
+    def pin(self, key, records):
+        """Store key's records and never evict it."""
+        with self._lock:
+            self._lru.pop(key, None)
+            self._pinned[key] = list(records)
+
+    def discard(self, key):
+        """Forget key, unless it is pinned."""
+        with self._lock:
+            self._lru.pop(key, None)
+
+    def replace(self, key, records):
+        """Store records as key's full list of records."""
+        with self._lock:
+            self._set(key, list(records))
+
+    def append(self, key, record, initial=()):
+        """Add a record to key, starting from initial if key isn't stored."""
+        with self._lock:
+            records = self._pinned.get(key)
+            if records is None:
+                records = self._lru.get(key)
+            if records is None:
+                records = list(initial)
+                self._set(key, records)
+            elif key in self._lru:
+                self._lru.move_to_end(key)
+            records.append(record)
+
+    def _set(self, key, records):
+        """Store records under key; call with the lock held."""
+        if key in self._pinned:
+            self._pinned[key] = records
+            return
+        self._lru[key] = records
+        self._lru.move_to_end(key)
+        while self.max_keys and len(self._lru) > self.max_keys:
+            key, _ = self._lru.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key)
@@ -0,0 +1,87 @@
+"""reply_cache.py - remembers command replies, see decorators.cached."""
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+import time
+
+
+class ReplyCache(object):
+    """A thread-safe, size-capped map of key to reply that expires.
+
+    Replies are kept for ttl seconds, and once there are more than
+    max_size of them the least recently used are evicted. Concurrent calls
+    for a key that is not cached share one call of the function.
+    """
+
+    def __init__(self, ttl=60, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._replies = OrderedDict()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def get_or_call(self, key, func):
+        """Return the cached reply for key, or call func() for one.
+
+        A reply of None is passed through but not cached; nor are
+        exceptions, which are raised to every caller sharing the call.
+        """
+        with self._lock:
+            cached = self._replies.get(key)
+            if cached is not None:
+                expires, reply = cached
+                if expires > time.time():
+                    self._replies.move_to_end(key)
+                    self.hits += 1
+                    return reply
+                del self._replies[key]
+            future = self._calls.get(key)
+            calling = future is None
+            if calling:
+                future = self._calls[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not calling:
+            return future.result()
+        try:
+            reply = func()
+        except Exception as err:
+            with self._lock:
+                del self._calls[key]
+            future.set_exception(err)
+            raise
+        with self._lock:
+            del self._calls[key]
+            self._store(key, reply)
+        future.set_result(reply)
+        return reply
+
+    def clear(self):
+        """Forget every cached reply."""
+        with self._lock:
+            self._replies.clear()
+
+    def stats(self):
+        """Return the hit, miss, coalesced and eviction counts and size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'size': len(self._replies),
+            }
+
+    def _store(self, key, reply):
+        if reply is None or not self.ttl:
+            return
+        self._replies[key] = (time.time() + self.ttl, reply)
+        self._replies.move_to_end(key)
+        while self.max_size and len(self._replies) > self.max_size:
+            self._replies.popitem(last=False)
+            self.evictions += 1
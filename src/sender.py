@@ -0,0 +1,502 @@
+"""sender.py - a pool of threads sending queued messages to flow."""
+from .metrics import NULL_METRICS
+from collections import deque
+from queue import Empty
+import logging
+import random
+import threading
+import time
+import zlib
+
+
+LOG = logging.getLogger(__name__)
+
+# How long a worker blocks on an empty queue before re-checking state.
+QUEUE_POLL_SECS = 1.0
+# The most queued messages a worker drains in a single tick.
+SEND_BATCH_SIZE = 50
+# Put on a worker's queue to tell it to stop.
+_STOP = object()
+
+# What to do with a new message when its queue is full.
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+# Errors that mean the message itself is bad, so retrying cannot help.
+PERMANENT_ERRORS = (TypeError, ValueError)
+
+
+class MessageDropped(Exception):
+    """A queued message was dropped by the outbound queue's overflow policy."""
+
+
+class Envelope(object):
+    """A queued message (send_message keyword arguments) and its Future.
+
+    Envelopes compare equal when their messages do, so the coalesce policy
+    sees through them.
+    """
+
+    __slots__ = ('message', 'future', 'queued', 'journal_id')
+
+    def __init__(self, message, future=None, journal_id=None):
+        self.message = message
+        self.future = future
+        self.queued = time.time()
+        self.journal_id = journal_id
+
+    def __eq__(self, other):
+        return isinstance(other, Envelope) and self.message == other.message
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def resolve(self, error=None):
+        """Complete the future: True once sent, else with the error."""
+        if self.future is None or self.future.done():
+            return
+        if error is None:
+            self.future.set_result(True)
+        else:
+            self.future.set_exception(error)
+
+
+def shard_index(key, count):
+    """Map key onto one of count shards, stable across processes."""
+    if count <= 1:
+        return 0
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+class OutboundQueue(object):
+    """A FIFO queue with an optional size limit and an overflow policy.
+
+    When the queue is full a put is handled according to the policy:
+
+    - block: wait up to put_timeout seconds for room, then drop the message
+    - drop_oldest: discard the message at the head of the queue
+    - drop_newest: discard the message being put
+    - coalesce: discard the message being put if an identical one for the
+      same channel is already waiting, otherwise block
+
+    Each outcome is counted in `overflow`, and on_drop(item) is called
+    for a queued item discarded by drop_oldest.
+    """
+
+    def __init__(self, maxsize=0, policy=BLOCK, put_timeout=None,
+                 on_drop=None):
+        """Create a queue holding at most maxsize messages (0 is no limit)."""
+        self.on_drop = on_drop
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self.overflow = dict.fromkeys(
+            ('blocked', 'timed_out', 'dropped_oldest', 'dropped_newest',
+             'coalesced'), 0)
+        self._items = deque()
+        self._unfinished = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._all_done = threading.Condition(self._mutex)
+
+    def qsize(self):
+        """The number of messages waiting in the queue."""
+        return len(self._items)
+
+    def put(self, item, force=False, block=True):
+        """Queue item, applying the overflow policy if the queue is full.
+
+        Returns False if the item was dropped. force bypasses the size
+        limit. Without block, the block and coalesce policies drop the item
+        at once instead of waiting for room.
+        """
+        with self._mutex:
+            if not force and self._full():
+                if not self._make_room(item, block):
+                    return False
+            self._items.append(item)
+            self._unfinished += 1
+            self._not_empty.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next item, like queue.Queue.get."""
+        with self._not_empty:
+            if not block:
+                if not self._items:
+                    raise Empty
+            else:
+                deadline = None if timeout is None else time.time() + timeout
+                while not self._items:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise Empty
+                    self._not_empty.wait(remaining)
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def task_done(self):
+        """Mark a previously fetched item as processed, like queue.Queue."""
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._unfinished = 0
+                self._all_done.notify_all()
+
+    def join(self, timeout=None):
+        """Block until every queued item has been processed.
+
+        Returns False if timeout seconds passed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._all_done:
+            while self._unfinished:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._all_done.wait(remaining)
+            return True
+
+    def _full(self):
+        return 0 < self.maxsize <= len(self._items)
+
+    def _make_room(self, item, block=True):
+        """Apply the overflow policy; return True once item may be queued.
+
+        Called with the mutex held.
+        """
+        if self.policy == DROP_NEWEST:
+            self.overflow['dropped_newest'] += 1
+            return False
+        if self.policy == DROP_OLDEST:
+            dropped = self._items.popleft()
+            self._unfinished -= 1
+            if self.on_drop:
+                self.on_drop(dropped)
+            self.overflow['dropped_oldest'] += 1
+            return True
+        if self.policy == COALESCE and item in self._items:
+            self.overflow['coalesced'] += 1
+            return False
+
+        self.overflow['blocked'] += 1
+        put_timeout = self.put_timeout if block else 0
+        deadline = None
+        if put_timeout is not None:
+            deadline = time.time() + put_timeout
+        while self._full():
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.overflow['timed_out'] += 1
+                    LOG.warning('Outbound queue full, dropping message')
+                    return False
+            self._not_full.wait(remaining)
+        return True
+
+
+class Sender(object):
+    """Send queued messages to flow from a pool of worker threads.
+
+    Messages are sharded by channel id, so the messages for one channel are
+    always sent in order by the same worker while different channels are
+    sent in parallel. max_queue_size is split evenly across the workers'
+    queues; see OutboundQueue for the overflow policies.
+
+    Sends wait for the global rate_limit bucket and the message channel's
+    bucket in channel_rate_limit (flowbot.ratelimit), when given. A failed
+    send is retried up to retries times, sleeping a random time up to
+    retry_base * 2 ** attempt (capped at retry_max) in between. Messages
+    that still fail go to `dead_letters`, so the worker keeps running.
+
+    Queue wait and send times go to the metrics sink (flowbot.metrics).
+
+    With a journal (flowbot.journal.OutboxJournal), every queued message is
+    kept on disk until it is sent, dropped or dead-lettered, and the
+    messages a previous run left unsent are queued again first.
+    """
+
+    def __init__(self, send, workers=1, name='flowbot-sender',
+                 max_queue_size=0, overflow_policy=BLOCK, put_timeout=None,
+                 rate_limit=None, channel_rate_limit=None, retries=0,
+                 retry_base=0.5, retry_max=30, dead_letter_size=1000,
+                 metrics=None, journal=None):
+        """Create a sender that delivers each message with send(**message)."""
+        self.send = send
+        self.name = name
+        self.metrics = metrics or NULL_METRICS
+        self.journal = journal
+        self.rate_limit = rate_limit
+        self.channel_rate_limit = channel_rate_limit
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.dead_letters = deque(maxlen=dead_letter_size)
+        self.counts = dict.fromkeys(
+            ('sent', 'retried', 'failed', 'rate_limited'), 0)
+        self._stopping = threading.Event()
+        workers = max(1, workers)
+        shard_size = -(-max_queue_size // workers)
+        self._queues = [
+            OutboundQueue(shard_size, overflow_policy, put_timeout,
+                          on_drop=self._dropped)
+            for _ in range(workers)
+        ]
+        self._threads = []
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        if journal:
+            self._replay()
+
+    @property
+    def workers(self):
+        """The number of worker threads (and queue shards)."""
+        return len(self._queues)
+
+    @property
+    def in_flight(self):
+        """The number of messages currently being sent."""
+        return self._in_flight
+
+    def queue_depth(self):
+        """The number of messages waiting to be sent, across all shards."""
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        """Return a dict of gauges for sizing the worker pool."""
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queue_depth(),
+            'shard_depths': [q.qsize() for q in self._queues],
+            'in_flight': self._in_flight,
+            'overflow': self.overflow(),
+            'dead_letters': len(self.dead_letters),
+            'counts': dict(self.counts),
+        }
+
+    def overflow(self):
+        """Return how often each overflow policy fired, across all shards."""
+        totals = {}
+        for queue in self._queues:
+            for name, count in queue.overflow.items():
+                totals[name] = totals.get(name, 0) + count
+        return totals
+
+    def start(self):
+        """Start one worker thread per shard."""
+        self._stopping.clear()
+        for i, queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run,
+                args=(queue,),
+                name='%s-%d' % (self.name, i)
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=QUEUE_POLL_SECS, drain=0):
+        """Stop every worker, leaving the messages still queued unsent.
+
+        With drain, first wait up to drain seconds for the queued messages
+        to be sent as usual. After that no more messages are sent: retry
+        and rate limit waits are cut short, a failing message goes straight
+        to dead_letters, and the rest are dropped (or, with a journal, kept
+        there for the next run). The journal is closed once every worker
+        has exited, however long the sends in flight take; without one,
+        each worker is waited for up to timeout seconds.
+        """
+        if drain and not self.join(drain):
+            LOG.warning('Stopping with %d unsent message(s)',
+                        self.queue_depth() + self._in_flight)
+        self._stopping.set()
+        for queue in self._queues:
+            queue.put(_STOP, force=True)
+        current = threading.current_thread()
+        for thread in self._threads:
+            if thread is not current:
+                thread.join(None if self.journal else timeout)
+        self._threads = []
+        if self.journal:
+            self.journal.close()
+
+    def put(self, message, future=None, block=True):
+        """Queue a message (send_message keyword arguments) for sending.
+
+        Returns False if the message was dropped because its queue is full;
+        without block, it is never waited for room. If a Future is given,
+        it completes with True once the message is sent, or fails with the
+        send error or MessageDropped.
+        """
+        envelope = Envelope(message, future)
+        if self.journal:
+            try:
+                envelope.journal_id = self.journal.add(message)
+            except (TypeError, ValueError) as err:
+                LOG.warning('message not journaled: %s', err)
+        queue = self._queues[shard_index(message.get('cid'), self.workers)]
+        if queue.put(envelope, block=block):
+            return True
+        self._dropped(envelope)
+        return False
+
+    def join(self, timeout=None):
+        """Block until every queued message has been processed.
+
+        Returns False if timeout seconds passed first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for queue in self._queues:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            if not queue.join(remaining):
+                return False
+        return True
+
+    def _replay(self):
+        """Queue the messages the journal holds from the last run."""
+        pending = self.journal.pending()
+        if pending:
+            LOG.info('Resending %d message(s) from the journal',
+                     len(pending))
+        for journal_id, message in pending:
+            queue = self._queues[
+                shard_index(message.get('cid'), self.workers)]
+            queue.put(Envelope(message, journal_id=journal_id), force=True)
+
+    def _run(self, queue):
+        """Worker loop: drain the shard's queue in batches until stopped."""
+        LOG.info('Message queue thread started...')
+        running = True
+        while running:
+            try:
+                batch = [queue.get(timeout=QUEUE_POLL_SECS)]
+            except Empty:
+                continue
+            while len(batch) < SEND_BATCH_SIZE:
+                try:
+                    batch.append(queue.get(block=False))
+                except Empty:
+                    break
+            LOG.debug('Sending %d queued message(s)', len(batch))
+            for envelope in batch:
+                try:
+                    if envelope is _STOP:
+                        running = False
+                    elif self._stopping.is_set():
+                        # Left in the journal, to be sent by the next run.
+                        self._dropped(envelope, forget=False)
+                    else:
+                        self._send(envelope)
+                finally:
+                    queue.task_done()
+        LOG.info('Message queue thread has ended...')
+
+    def _send(self, envelope):
+        """Send a single message, with rate limits and retries.
+
+        Never raises: a message that can't be sent goes to dead_letters.
+        """
+        message = envelope.message
+        self.metrics.since('send_queue_wait_seconds', envelope.queued)
+        if not self._wait_for_rate_limits(message.get('cid')):
+            self._dropped(envelope, forget=False)
+            return
+        with self._lock:
+            self._in_flight += 1
+        try:
+            attempt = 0
+            while True:
+                start = time.time()
+                try:
+                    self.send(**message)
+                    self.metrics.since('send_seconds', start)
+                    self._count('sent')
+                    self._forget(envelope)
+                    envelope.resolve()
+                    return
+                except Exception as err:
+                    if (isinstance(err, PERMANENT_ERRORS) or
+                            attempt >= self.retries or
+                            self._stopping.is_set()):
+                        self._give_up(envelope, err)
+                        return
+                    delay = random.uniform(0, min(
+                        self.retry_max, self.retry_base * 2 ** attempt))
+                    attempt += 1
+                    self._count('retried')
+                    LOG.warning('send_message failed (%s), retry %d in %.2fs',
+                                err, attempt, delay)
+                    if self._stopping.wait(delay):
+                        self._give_up(envelope, err)
+                        return
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _wait_for_rate_limits(self, cid):
+        """Block until both the channel and the global bucket allow a send.
+
+        Returns False if the sender was stopped while waiting.
+        """
+        buckets = [self.rate_limit]
+        if self.channel_rate_limit:
+            buckets.insert(0, self.channel_rate_limit.bucket(cid))
+        for bucket in buckets:
+            if not bucket:
+                continue
+            while not bucket.consume():
+                self._count('rate_limited')
+                if self._stopping.wait(bucket.delay()):
+                    return False
+        return True
+
+    def _give_up(self, envelope, err):
+        """Dead-letter a failed message; if stopping, keep it journaled."""
+        self._dead_letter(envelope.message, err)
+        if (isinstance(err, PERMANENT_ERRORS) or
+                not self._stopping.is_set()):
+            self._forget(envelope)
+        envelope.resolve(err)
+
+    def _dead_letter(self, message, err):
+        self._count('failed')
+        LOG.error('send_message failed, giving up: %r', err)
+        self.dead_letters.append({
+            'message': message,
+            'error': repr(err),
+            'time': time.time(),
+        })
+
+    def _dropped(self, envelope, forget=True):
+        self.metrics.incr('messages_dropped')
+        if forget:
+            self._forget(envelope)
+        envelope.resolve(MessageDropped(envelope.message.get('cid')))
+
+    def _forget(self, envelope):
+        """Remove a message that won't be sent again from the journal."""
+        if self.journal and envelope.journal_id is not None:
+            self.journal.done(envelope.journal_id)
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+        self.metrics.incr('messages_%s' % name)
@@ -1,35 +1,63 @@
+from .metrics import PhaseTimes
+from concurrent.futures import ThreadPoolExecutor
 from flow import Flow
+import hashlib
+import json
 import logging
+import os
 
 LOG = logging.getLogger(__name__)
 
+PROFILE_HASH_FILENAME = 'flowbot-profile-%s.sha256'
+
 
 class Server(object):
     """A connection to Flow."""
 
     def __init__(self, config):
-        """Initialize a flow server instance."""
+        """Initialize a flow server instance.
+
+        How long each setup step took is kept in self.timings. With the
+        fast_start setting, joining the org and setting the profile run at
+        the same time, and the profile is only set when it has changed.
+        """
         self.config = config
+        self.timings = PhaseTimes()
 
-        self.flow = Flow(
-            server_uri=config.uri,
-            flowappglue=config.flowappglue,
-            host=config.host,
-            port=config.port,
-            schema_dir=config.schema_dir,
-            db_dir=config.db_dir,
-            attachment_dir=config.attachment_dir,
-            use_tls=config.use_tls,
-            decrement_file=config.decrement_file,
-            extra_config=config.extra_config,
-        )
+        with self.timings.phase('flow'):
+            self.flow = Flow(
+                server_uri=config.uri,
+                flowappglue=config.flowappglue,
+                host=config.host,
+                port=config.port,
+                schema_dir=config.schema_dir,
+                db_dir=config.db_dir,
+                attachment_dir=config.attachment_dir,
+                use_tls=config.use_tls,
+                decrement_file=config.decrement_file,
+                extra_config=config.extra_config,
+            )
+
+        with self.timings.phase('login'):
+            if not self._start_server():
+                if not self._setup_device():
+                    self._setup_account()
 
-        if not self._start_server():
-            if not self._setup_device():
-                self._setup_account()
+        steps = [('org', self._setup_org), ('profile', self._set_profile)]
+        if config.fast_start:
+            with ThreadPoolExecutor(len(steps)) as pool:
+                futures = [pool.submit(self._timed, name, step)
+                           for name, step in steps]
+            for future in futures:
+                future.result()
+        else:
+            for name, step in steps:
+                self._timed(name, step)
 
-        self._setup_org()
-        self._set_profile()
+    def _timed(self, name, step):
+        """Run one setup step, timing it as phase name."""
+        with self.timings.phase(name):
+            step()
 
     def _start_server(self):
         """Attempt to start the flow server."""
@@ -63,20 +91,47 @@ class Server(object):
             LOG.error("Create account failed: '%s'", str(create_account_err))
 
     def _setup_org(self):
-        """"Join the org if not already a member."""
+        """"Join the configured org if not already a member."""
+        self.join_org(self.config.org_id)
+
+    def join_org(self, org_id):
+        """Join an org if not already a member."""
         try:
-            self.flow.new_org_join_request(oid=self.config.org_id)
+            self.flow.new_org_join_request(oid=org_id)
         except Flow.FlowError as org_join_err:
             if "Member Already" in str(org_join_err):
-                LOG.debug("already member of org %s", str(self.config.org_id))
+                LOG.debug("already member of org %s", str(org_id))
             else:
                 LOG.error("org join failed: '%s'", str(org_join_err))
 
     def _set_profile(self):
-        """Set the user profile based on the items passed in the config."""
+        """Set the user profile based on the items passed in the config.
+
+        With fast_start, a hash of the last profile set is kept in db_dir
+        and the profile is only sent to flow when it differs.
+        """
         profile = self.flow.get_profile_item_json(
             display_name=getattr(self.config, 'display_name', None),
             biography=getattr(self.config, 'biography', None),
             photo=getattr(self.config, 'photo', None),
         )
+        if not self.config.fast_start:
+            self.flow.set_profile('profile', profile)
+            return
+        digest = hashlib.sha256(
+            json.dumps(profile, sort_keys=True).encode('utf-8')).hexdigest()
+        path = os.path.join(
+            self.config.db_dir, PROFILE_HASH_FILENAME % self.config.username)
+        try:
+            with open(path) as hash_file:
+                if hash_file.read().strip() == digest:
+                    LOG.debug('profile unchanged, not setting it')
+                    return
+        except (IOError, OSError):
+            pass
         self.flow.set_profile('profile', profile)
+        try:
+            with open(path, 'w') as hash_file:
+                hash_file.write(digest)
+        except (IOError, OSError) as err:
+            LOG.debug("couldn't save the profile hash: %s", err)
@@ -0,0 +1,118 @@
+"""snapshot.py - a local sqlite snapshot of the ChannelDb index."""
+import json
+import logging
+import sqlite3
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = 'flowbot-channeldb-%s.sqlite'
+
+
+class ChannelDbSnapshot(object):
+    """Persist the records read from the db channel between restarts.
+
+    Along with the records, the snapshot keeps the position of the newest
+    db channel message it has seen: its creationTime plus the ids of the
+    messages at that time. On restart only messages past that position need
+    to be parsed. It also keeps the org and db channel the records came
+    from, and is emptied when loaded for a different one.
+    """
+
+    def __init__(self, path):
+        """Open (or create) the snapshot database at path."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'key TEXT NOT NULL, value TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._time = 0
+        self._ids = set()
+
+    def load(self, org_id=None, channel_id=None):
+        """Return the saved records as {key: [values]}, oldest first.
+
+        If the snapshot was saved from another org or db channel, it is
+        cleared first, so none of that channel's records or position apply.
+        """
+        data = {}
+        source = json.dumps([org_id, channel_id])
+        with self._lock:
+            saved = self._conn.execute(
+                "SELECT value FROM meta WHERE name = 'source'").fetchone()
+            if not saved or saved[0] != source:
+                if saved:
+                    LOG.info('channel db snapshot is from another channel, '
+                             'discarding it')
+                with self._conn:
+                    self._conn.execute('DELETE FROM records')
+                    self._conn.execute('DELETE FROM meta')
+                    self._conn.execute(
+                        "INSERT INTO meta (name, value) "
+                        "VALUES ('source', ?)", (source,))
+            rows = self._conn.execute(
+                'SELECT key, value FROM records ORDER BY seq').fetchall()
+            position = self._conn.execute(
+                "SELECT value FROM meta WHERE name = 'position'").fetchone()
+        for key, value in rows:
+            data.setdefault(key, []).append(json.loads(value))
+        if position:
+            position = json.loads(position[0])
+            self._time = position['time']
+            self._ids = set(position['ids'])
+        LOG.info('channel db snapshot loaded %d records', len(rows))
+        return data
+
+    def is_new(self, message):
+        """Determine if a db channel message is past the saved position."""
+        time, id_ = _position(message)
+        return time > self._time or (time == self._time and
+                                     id_ not in self._ids)
+
+    def save(self, messages):
+        """Save the records of newly seen messages and advance the position.
+
+        messages is a list of (message, records) pairs, with records as
+        returned by ChannelDb._records: (key, value, replace) tuples, where
+        replace means value is the key's full list of records.
+        """
+        for message, _ in messages:
+            time, id_ = _position(message)
+            if time > self._time:
+                self._time, self._ids = time, set()
+            if time == self._time:
+                self._ids.add(id_)
+        position = json.dumps({'time': self._time, 'ids': list(self._ids)})
+        with self._lock, self._conn:
+            for _, records in messages:
+                for key, value, replace in records:
+                    if replace:
+                        self._conn.execute(
+                            'DELETE FROM records WHERE key = ?', (key,))
+                        values = value
+                    else:
+                        values = [value]
+                    self._conn.executemany(
+                        'INSERT INTO records (key, value) VALUES (?, ?)',
+                        [(key, json.dumps(v)) for v in values])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) "
+                "VALUES ('position', ?)", (position,))
+
+    def close(self):
+        """Close the snapshot database."""
+        with self._lock:
+            self._conn.close()
+
+
+def _position(message):
+    """Return (creationTime, id) of a db channel message."""
+    data = message.get('data', message)
+    return data.get('creationTime', 0), data.get('id')
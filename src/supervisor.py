@@ -0,0 +1,483 @@
+"""supervisor.py - shard a bot's channels across worker processes."""
+from .bot import create_sender
+from .channel_directory import ChannelDirectory
+from .config import Config, ImproperlyConfigured
+from .executor import HandlerExecutor
+from .membership import MembershipCache
+from .metrics import create_metrics
+from .sender import shard_index
+from .server import Server
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+from queue import Queue
+import itertools
+import logging
+import multiprocessing
+import pickle
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+# How often the supervisor checks for crashed workers.
+MONITOR_SECS = 1.0
+# How long shutdown waits for a worker to finish its queue.
+WORKER_STOP_SECS = 5
+# The most notifications sent to a worker that it hasn't taken yet.
+INBOX_WINDOW = 64
+
+
+class Supervisor(object):
+    """Run one bot identity across several worker processes.
+
+    The supervisor holds the only flow connection. It reads notifications
+    and sends each message to a worker chosen by its channel id, so every
+    channel is handled by one worker, in order, while different channels
+    use different cores. Each worker builds the bot (bot_class(settings))
+    and runs its filters and command handlers as a standalone bot would.
+
+    Workers have no flow connection of their own: their flow calls
+    (membership and channel lookups, ChannelDb searches) are made by the
+    supervisor for them, and their outgoing messages go back to the
+    supervisor's sender, so the send rate limits apply to the bot as a
+    whole. Db channel messages and channel and membership changes go to
+    every worker. A worker that dies is restarted, and is sent again any
+    notification it had not taken yet; commands it was running are lost.
+
+    Filters that keep state across channels (sender_rate) only see one
+    worker's share of the channels. The db_snapshot setting is not
+    supported: every worker would write the same snapshot file.
+    """
+
+    def __init__(self, bot_class, settings, workers=None):
+        """Create a supervisor for workers processes of bot_class.
+
+        workers defaults to the worker_processes setting, or one per CPU.
+        """
+        self.bot_class = bot_class
+        self.settings = settings
+        self.config = Config(settings)
+        if self.config.db_snapshot:
+            raise ImproperlyConfigured(
+                'db_snapshot is not supported by the Supervisor')
+        self.metrics = create_metrics(self.config)
+        self.server = Server(self.config)
+        self.account_id = self.server.flow.account_id()
+        self.directory = ChannelDirectory(
+            self.server.flow,
+            self.config.org_id,
+            ttl=self.config.channel_ttl
+        )
+        self.sender = create_sender(
+            self.config, self.server.flow.send_message, self.metrics)
+        self.restarts = 0
+        context = multiprocessing.get_context('spawn')
+        count = (workers or self.config.worker_processes or
+                 multiprocessing.cpu_count())
+        self._workers = [_Worker(context, i) for i in range(count)]
+        self._calls = ThreadPoolExecutor(
+            max_workers=self.config.async_blocking_workers)
+        self._stopping = threading.Event()
+        self._threads = []
+
+        @self.server.flow.message
+        def _handle_message(notification_type, data):
+            self.handle_message(notification_type, data)
+
+        @self.server.flow.channel
+        def _handle_channel(notification_type, data):
+            self.directory.handle_channel_notification(
+                notification_type, data)
+            self._broadcast('channel', notification_type, data)
+
+        @self.server.flow.channel_member_event
+        def _handle_channel_member_event(notification_type, data):
+            self._broadcast('channel_member_event', notification_type, data)
+
+        @self.server.flow.org_member_event
+        def _handle_org_member_event(notification_type, data):
+            self._broadcast('org_member_event', notification_type, data)
+
+    @property
+    def workers(self):
+        """The number of worker processes."""
+        return len(self._workers)
+
+    def run(self, block=True):
+        """Start the workers and read notifications until interrupted."""
+        LOG.info('Supervisor is starting %d worker(s)...', self.workers)
+        for worker in self._workers:
+            self._start(worker)
+        self.sender.start()
+        for target in (self._serve, self._monitor):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if not block:
+            thread = threading.Thread(
+                target=self.server.flow.process_notifications)
+            thread.daemon = True
+            thread.start()
+            return
+        try:
+            self.server.flow.process_notifications()
+        except (KeyboardInterrupt, SystemExit):
+            LOG.info('Interrupt Received')
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        """Stop the workers and the sender, and disconnect.
+
+        Messages the workers queued are given drain_timeout seconds to be
+        sent, as FlowBot.cleanup does.
+        """
+        LOG.info('Supervisor is shutting down...')
+        self._stopping.set()
+        for worker in self._workers:
+            worker.stop(WORKER_STOP_SECS)
+        for thread in self._threads:
+            thread.join(WORKER_STOP_SECS)
+        self._threads = []
+        self.sender.stop(drain=self.config.drain_timeout)
+        self._calls.shutdown(wait=False)
+        if self.server.flow:
+            self.server.flow.terminate()
+
+    def handle_message(self, notification_type, data):
+        """Send each message to its channel's worker.
+
+        The bot's own messages are dropped here, except in the db channel,
+        whose messages go to every worker's ChannelDb.
+        """
+        db_channel_id = self.directory.id_for(self.config.db_channel)
+        shards = {}
+        for message in data.get('regularMessages', []):
+            cid = message.get('channelId')
+            if db_channel_id and cid == db_channel_id:
+                self._broadcast(
+                    'message', notification_type,
+                    {'regularMessages': [message]})
+            elif message.get('senderAccountId') != self.account_id:
+                index = shard_index(cid, self.workers)
+                shards.setdefault(index, []).append(message)
+        for index, messages in shards.items():
+            self._workers[index].put(
+                ('message', notification_type, {'regularMessages': messages}))
+
+    def _broadcast(self, kind, notification_type, data):
+        for worker in self._workers:
+            worker.put((kind, notification_type, data))
+
+    def _start(self, worker):
+        worker.start(_worker_main, (self.bot_class, self.settings))
+
+    def _monitor(self):
+        """Restart workers that have died."""
+        while not self._stopping.wait(MONITOR_SECS):
+            for worker in self._workers:
+                if not worker.is_alive() and not self._stopping.is_set():
+                    LOG.error('worker %d exited with %s, restarting',
+                              worker.index, worker.exitcode)
+                    self.restarts += 1
+                    self.metrics.incr('worker_restarts')
+                    self._start(worker)
+
+    def _serve(self):
+        """Handle the workers' acks, outgoing messages and flow calls."""
+        while True:
+            links = dict((w.link, w) for w in self._workers if w.link)
+            ready = wait(list(links), MONITOR_SECS) if links else []
+            if not ready and self._stopping.is_set() and not any(
+                    w.is_alive() for w in self._workers):
+                break
+            if not links:
+                self._stopping.wait(MONITOR_SECS)
+            for link in ready:
+                worker = links[link]
+                try:
+                    request = link.recv()
+                except (EOFError, OSError):
+                    worker.link_closed(link)
+                    continue
+                if request[0] == 'ack':
+                    worker.ack(request[1])
+                elif request[0] == 'send':
+                    self.sender.put(request[1])
+                else:
+                    self._calls.submit(self._call, worker, *request[1:])
+
+    def _call(self, worker, call_id, name, args, kwargs):
+        """Make a flow call for a worker and send it the result."""
+        try:
+            reply = (call_id, True, getattr(self.server.flow, name)(
+                *args, **kwargs))
+        except Exception as err:
+            reply = (call_id, False, _picklable(err))
+        worker.reply(reply)
+
+
+class _Worker(object):
+    """The supervisor's side of one worker process.
+
+    Each start gets new pipes: an inbox of notifications and a duplex link
+    for the worker's requests and the replies to them. Pipes have no
+    locks a dying process could leave held. Notifications are numbered and
+    acked by the worker when it takes them, at most INBOX_WINDOW ahead, so
+    the ones a dead worker never took can be sent to its replacement. A
+    feeder thread does the sending, so a slow worker never blocks the
+    notification thread.
+    """
+
+    def __init__(self, context, index):
+        self.context = context
+        self.index = index
+        self.process = None
+        self.link = None
+        self._inbox = None
+        self._seq = itertools.count(1)
+        self._waiting = deque()
+        self._unacked = deque()
+        self._closing = False
+        self._feeder = None
+        self._cond = threading.Condition()
+        self._link_lock = threading.Lock()
+
+    def start(self, target, args):
+        inbox_reader, inbox_writer = self.context.Pipe(duplex=False)
+        link, worker_link = self.context.Pipe()
+        process = self.context.Process(
+            target=target,
+            args=args + (self.index, inbox_reader, worker_link),
+            name='flowbot-worker-%d' % self.index
+        )
+        process.daemon = True
+        process.start()
+        # The worker has its own copies now; closing ours means writes to
+        # a dead worker fail instead of blocking.
+        inbox_reader.close()
+        worker_link.close()
+        with self._link_lock:
+            self.link = link
+        with self._cond:
+            self.process = process
+            self._inbox = inbox_writer
+            self._waiting.extendleft(reversed(self._unacked))
+            self._unacked.clear()
+            self._cond.notify()
+        if self._feeder is None:
+            self._feeder = threading.Thread(
+                target=self._feed, name='flowbot-feeder-%d' % self.index)
+            self._feeder.daemon = True
+            self._feeder.start()
+
+    def put(self, item):
+        """Queue a notification for the worker."""
+        with self._cond:
+            self._waiting.append((next(self._seq), item))
+            self._cond.notify()
+
+    def ack(self, seq):
+        """The worker has taken every notification up to seq."""
+        with self._cond:
+            while self._unacked and self._unacked[0][0] <= seq:
+                self._unacked.popleft()
+            self._cond.notify()
+
+    def reply(self, reply):
+        with self._link_lock:
+            try:
+                if self.link:
+                    self.link.send(reply)
+            except (OSError, ValueError):
+                pass
+
+    def link_closed(self, link):
+        with self._link_lock:
+            if self.link is link:
+                self.link = None
+
+    def stop(self, timeout):
+        """Ask the worker to finish its queue and exit."""
+        self.put(None)
+        with self._cond:
+            self._closing = True
+        if self.process is None:
+            return
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    @property
+    def exitcode(self):
+        return self.process.exitcode if self.process else None
+
+    def _feed(self):
+        """Send waiting notifications while the window allows."""
+        while True:
+            with self._cond:
+                while not (self._inbox and self._waiting and
+                           len(self._unacked) < INBOX_WINDOW):
+                    if self._closing and not self._waiting:
+                        return
+                    self._cond.wait(MONITOR_SECS)
+                entry = self._waiting.popleft()
+                self._unacked.append(entry)
+                inbox = self._inbox
+            try:
+                inbox.send(entry)
+            except (OSError, ValueError):
+                with self._cond:
+                    if self._inbox is inbox:
+                        self._inbox = None
+
+
+class FlowProxy(object):
+    """Stands in for flow in a worker, calling the supervisor's flow.
+
+    Any method call is sent to the supervisor, which makes it on the real
+    flow connection; the caller blocks until the result comes back.
+    """
+
+    def __init__(self, link):
+        self._link = link
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._read_replies)
+        thread.daemon = True
+        thread.start()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        call.__name__ = name
+        return call
+
+    def send_request(self, request):
+        """Send a request to the supervisor."""
+        with self._lock:
+            self._link.send(request)
+
+    def _call(self, name, args, kwargs):
+        waiter = Queue(1)
+        with self._lock:
+            call_id = next(self._ids)
+            self._pending[call_id] = waiter
+            self._link.send(('call', call_id, name, args, kwargs))
+        ok, value = waiter.get()
+        if not ok:
+            raise value
+        return value
+
+    def _read_replies(self):
+        while True:
+            try:
+                call_id, ok, value = self._link.recv()
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                waiter = self._pending.pop(call_id, None)
+            if waiter:
+                waiter.put((ok, value))
+
+
+class _ProxyServer(object):
+    """A Server whose flow is a FlowProxy."""
+
+    def __init__(self, config, flow):
+        self.config = config
+        self.flow = flow
+
+
+class _ParentSender(object):
+    """Hands a worker's outgoing messages to the supervisor's sender.
+
+    A message's Future completes once the supervisor has it.
+    """
+
+    def __init__(self, flow):
+        self._flow = flow
+
+    def put(self, message, future=None):
+        self._flow.send_request(('send', message))
+        if future is not None:
+            future.set_result(True)
+        return True
+
+
+class _WorkerHost(object):
+    """The BotHost interface (see flowbot.host) for a worker's bot."""
+
+    def __init__(self, config, flow):
+        self.metrics = create_metrics(config)
+        self.executor = HandlerExecutor(
+            lanes=config.handler_lanes,
+            processes=config.handler_processes,
+            timeout=config.handler_timeout,
+            metrics=self.metrics
+        )
+        self._flow = flow
+        self._sender = _ParentSender(flow)
+
+    def server_for(self, config):
+        return _ProxyServer(config, self._flow)
+
+    def directory_for(self, config):
+        return ChannelDirectory(
+            self._flow, config.org_id, ttl=config.channel_ttl)
+
+    def membership_for(self, config):
+        return MembershipCache(
+            self._flow, config.org_id, ttl=config.membership_ttl)
+
+    def sender_for(self, config):
+        return self._sender
+
+
+def _picklable(err):
+    """Return err, or a RuntimeError describing it if it can't be pickled."""
+    try:
+        pickle.dumps(err)
+        return err
+    except Exception:
+        return RuntimeError(repr(err))
+
+
+def _worker_main(bot_class, settings, index, inbox, link):
+    """Run a worker: build the bot and handle its share of the messages."""
+    flow = FlowProxy(link)
+    host = _WorkerHost(Config(settings), flow)
+    bot = bot_class(settings, host=host)
+    host.executor.start()
+    LOG.info('worker %d started', index)
+    handlers = {
+        'message': bot.handle_message,
+        'channel': bot.directory.handle_channel_notification,
+        'channel_member_event': bot.membership.handle_channel_member_event,
+        'org_member_event': bot.membership.handle_org_member_event,
+    }
+    while True:
+        try:
+            seq, item = inbox.recv()
+        except EOFError:
+            break
+        flow.send_request(('ack', seq))
+        if item is None:
+            break
+        kind, notification_type, data = item
+        try:
+            handlers[kind](notification_type, data)
+        except Exception:
+            LOG.exception('worker %d failed to handle a %s', index, kind)
+    host.executor.stop(WORKER_STOP_SECS)
+    bot.channel_db.close()
+    LOG.info('worker %d stopped', index)
@@ -0,0 +1,99 @@
+"""write_buffer.py - batches ChannelDb writes from a background thread."""
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WriteBuffer(object):
+    """Collect records and hand them to a send function in batches.
+
+    A batch is sent once batch_size records are waiting or the oldest has
+    waited interval seconds. Each add() returns a Future that completes
+    when the batch holding the record has been sent, or fails with the
+    send error.
+    """
+
+    def __init__(self, send, batch_size=50, interval=1.0,
+                 name='flowbot-db-writer'):
+        """Create a buffer that sends each batch with send(records)."""
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = []
+        self._first_added = None
+        self._running = True
+        self._cond = threading.Condition()
+        # Held while a batch is taken and sent, so batches go out in order.
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, record):
+        """Queue a record and return a Future for its write."""
+        future = Future()
+        with self._cond:
+            if not self._pending:
+                self._first_added = time.time()
+            self._pending.append((record, future))
+            if (len(self._pending) == 1 or
+                    len(self._pending) >= self.batch_size):
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        """Send everything waiting now, on the calling thread.
+
+        Returns once any batch already being sent has been sent too.
+        """
+        with self._send_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            self._send(batch)
+
+    def close(self):
+        """Flush the remaining records and stop the writer thread."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._due():
+                    timeout = None
+                    if self._pending:
+                        timeout = max(
+                            0, self._first_added + self.interval - time.time())
+                    self._cond.wait(timeout)
+                running = self._running
+            with self._send_lock:
+                with self._cond:
+                    batch, self._pending = self._pending, []
+                self._send(batch)
+            if not running:
+                break
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return (len(self._pending) >= self.batch_size or
+                time.time() - self._first_added >= self.interval)
+
+    def _send(self, batch):
+        if not batch:
+            return
+        try:
+            self.send([record for record, _ in batch])
+        except Exception as err:
+            LOG.exception('channel db batch write failed')
+            for _, future in batch:
+                future.set_exception(err)
+        else:
+            for _, future in batch:
+                future.set_result(None)
@@ -1,9 +1,15 @@
+from flowbot.metrics import PhaseTimes
+from queue import Queue
+import threading
+import time
+
+
 class MockFlow(object):
     """A Mock Flow object."""
-    def search(self):
-        pass
+    def search(self, **kwargs):
+        return []
 
-    def send_message(self):
+    def send_message(self, **kwargs):
         pass
 
 
@@ -11,3 +17,207 @@ class MockServer(object):
     """A Mock Server object."""
     def __init__(self):
         self.flow = MockFlow()
+
+
+class FakeFlowError(Exception):
+    """Stands in for Flow.FlowError."""
+
+
+class FakeFlow(object):
+    """An in-process flow backend for tests and benchmarks.
+
+    Keeps an org's channels, members and messages in memory and delivers
+    notifications to the registered handlers from process_notifications,
+    like flow does. Each API call sleeps for its entry in latency
+    (seconds, keyed by method name) to simulate the round trip to the
+    flowappglue process. Messages the bot sends are stored in their
+    channel and echoed back as message notifications.
+    """
+
+    FlowError = FakeFlowError
+
+    def __init__(self, account_id='bot', org_id='org', channels=1,
+                 org_members=10, channel_members=10, latency=None):
+        """Create an org with the given numbers of channels and members.
+
+        The bot is a member of every channel. Every tenth member is an
+        admin.
+        """
+        self._account_id = account_id
+        self.org_id = org_id
+        self.latency = latency or {}
+        self.sent = []
+        self.channels = dict(
+            ('c%d' % i, 'channel-%d' % i) for i in range(channels))
+        self.org_members = self._members('m', org_members)
+        self.channel_members = dict(
+            (cid, self._members('m', channel_members))
+            for cid in self.channels)
+        self.messages = dict((cid, []) for cid in self.channels)
+        self._handlers = {}
+        self._notifications = Queue()
+        self._lock = threading.Lock()
+        self._clock = 0
+
+    def _members(self, prefix, count):
+        members = [{'accountId': self._account_id, 'state': 'm'}]
+        members.extend(
+            {'accountId': '%s%d' % (prefix, i),
+             'state': 'a' if i % 10 == 0 else 'm'}
+            for i in range(count))
+        return members
+
+    # Notification handlers, registered with decorators as on flow.Flow.
+
+    def _register(self, name):
+        def decorator(func):
+            self._handlers[name] = func
+            return func
+        return decorator
+
+    @property
+    def message(self):
+        return self._register('message')
+
+    @property
+    def channel(self):
+        return self._register('channel')
+
+    @property
+    def channel_member_event(self):
+        return self._register('channel-member-event')
+
+    @property
+    def org_member_event(self):
+        return self._register('org-member-event')
+
+    def process_notifications(self):
+        """Deliver queued notifications until terminate() is called."""
+        while True:
+            item = self._notifications.get()
+            if item is None:
+                break
+            notification_type, data = item
+            handler = self._handlers.get(notification_type)
+            if handler:
+                handler(notification_type, data)
+
+    def terminate(self):
+        self._notifications.put(None)
+
+    def notify(self, notification_type, data):
+        """Queue a notification for process_notifications."""
+        self._notifications.put((notification_type, data))
+
+    def post(self, cid, text, sender='m1', other_data=None):
+        """Post a message to a channel as another member."""
+        message = self._store(cid, text, sender, other_data)
+        self.notify('message', {'regularMessages': [message]})
+        return message
+
+    def add_history(self, cid, texts, sender=None):
+        """Store messages in a channel without notifying anyone."""
+        for text in texts:
+            self._store(cid, text, sender or self._account_id, None)
+
+    def _store(self, cid, text, sender, other_data):
+        with self._lock:
+            self._clock += 1
+            message = {
+                'id': 'msg%d' % self._clock,
+                'channelId': cid,
+                'senderAccountId': sender,
+                'text': text,
+                'otherData': other_data,
+                'creationTime': int(time.time() * 1000) + self._clock,
+            }
+            self.messages.setdefault(cid, []).append(message)
+        return message
+
+    def _wait(self, name):
+        delay = self.latency.get(name)
+        if delay:
+            time.sleep(delay)
+
+    # The flow API used by flowbot.
+
+    def account_id(self):
+        return self._account_id
+
+    def start_up(self, **kwargs):
+        pass
+
+    def create_device(self, **kwargs):
+        pass
+
+    def create_account(self, **kwargs):
+        pass
+
+    def new_org_join_request(self, **kwargs):
+        pass
+
+    def get_profile_item_json(self, **kwargs):
+        return '{}'
+
+    def set_profile(self, *args, **kwargs):
+        pass
+
+    def enumerate_channels(self, oid):
+        self._wait('enumerate_channels')
+        return [{'id': cid, 'name': name}
+                for cid, name in self.channels.items()]
+
+    def enumerate_channel_members(self, cid):
+        self._wait('enumerate_channel_members')
+        return list(self.channel_members.get(cid, []))
+
+    def enumerate_org_members(self, oid):
+        self._wait('enumerate_org_members')
+        return list(self.org_members)
+
+    def enumerate_messages(self, oid, cid):
+        self._wait('enumerate_messages')
+        return list(self.messages.get(cid, []))
+
+    def search(self, oid=None, cid=None, search='', **kwargs):
+        self._wait('search')
+        return [{'data': m} for m in self.messages.get(cid, [])
+                if search in (m['text'] or '')]
+
+    def new_channel(self, oid, name):
+        self._wait('new_channel')
+        with self._lock:
+            cid = 'c%d' % len(self.channels)
+            self.channels[cid] = name
+            self.messages[cid] = []
+        return cid
+
+    def send_message(self, oid=None, cid=None, msg=None, other_data=None,
+                     **kwargs):
+        self._wait('send_message')
+        message = self._store(cid, msg, self._account_id, other_data)
+        self.sent.append(message)
+        self.notify('message', {'regularMessages': [message]})
+
+
+class FakeServer(object):
+    """A Server holding a FakeFlow."""
+    def __init__(self, flow=None):
+        self.flow = flow or FakeFlow()
+        self.timings = PhaseTimes()
+        self.joined = []
+
+    def join_org(self, org_id):
+        self.joined.append(org_id)
+
+
+def signal_sends(flow):
+    """Return a semaphore released after each flow.send_message call."""
+    sends = threading.Semaphore(0)
+    send_message = flow.send_message
+
+    def send(**kwargs):
+        send_message(**kwargs)
+        sends.release()
+    flow.send_message = send
+    return sends
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from mock import MagicMock, patch
+
+from flowbot import bot as bot_module
+from flowbot.aio import AsyncFlowBot
+from flowbot.decorators import cpu_bound
+from flowbot.tests.mocks import FakeFlow, FakeServer, signal_sends
+
+
+@cpu_bound
+def shout(message):
+    return 'hey'
+
+
+class PingBot(AsyncFlowBot):
+    def commands(self):
+        return {'ping': self.ping}
+
+    async def ping(self, message):
+        await asyncio.sleep(0)
+        self.reply(message, 'pong')
+
+
+class TestAsyncFlowBot(TestCase):
+    """Test AsyncFlowBot command dispatch."""
+
+    def init_bot(self):
+        with patch.object(AsyncFlowBot, '__init__') as init:
+            init.return_value = None
+            bot = AsyncFlowBot()
+        bot.config = MagicMock(handler_timeout=0, reply_with_result=True)
+        bot._blocking = ThreadPoolExecutor(max_workers=2)
+        bot.reply = MagicMock()
+        return bot
+
+    def dispatch(self, bot, command):
+        async def run():
+            bot._handler_slots = asyncio.Semaphore(1)
+            await bot._dispatch(command, {'channelId': 'c'})
+        asyncio.run(run())
+
+    def test_coroutine_command(self):
+        """Coroutine commands are awaited and their text is replied."""
+        bot = self.init_bot()
+
+        async def hello(message):
+            await asyncio.sleep(0)
+            return 'hello'
+        self.dispatch(bot, hello)
+        bot.reply.assert_called_once_with({'channelId': 'c'}, 'hello')
+
+    def test_plain_command(self):
+        """Plain commands run in the thread pool."""
+        bot = self.init_bot()
+        self.dispatch(bot, lambda message: 'plain')
+        bot.reply.assert_called_once_with({'channelId': 'c'}, 'plain')
+
+    def test_returned_text_ignored_by_default(self):
+        """Without reply_with_result only marked commands reply."""
+        bot = self.init_bot()
+        bot.config.reply_with_result = False
+        self.dispatch(bot, lambda message: 'ignored')
+        self.assertFalse(bot.reply.called)
+
+        self.dispatch(bot, shout)
+        bot.reply.assert_called_once_with({'channelId': 'c'}, 'hey')
+
+    def test_reply_sent(self):
+        """A command's reply goes from the notification through the sender."""
+        flow = FakeFlow()
+        sends = signal_sends(flow)
+        settings = {'username': 'bot', 'password': 'p', 'org_id': 'org',
+                    'metrics': 'none'}
+        with patch.object(bot_module, 'Server',
+                          lambda config: FakeServer(flow)):
+            bot = PingBot(settings)
+        thread = threading.Thread(target=bot.run)
+        thread.start()
+        try:
+            flow.post('c0', 'ping')
+            self.assertTrue(sends.acquire(timeout=5))
+        finally:
+            flow.terminate()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([m['text'] for m in flow.sent], ['pong'])
+        self.assertEqual(bot._tasks, set())
@@ -0,0 +1,90 @@
+from concurrent.futures import Future
+from unittest import TestCase
+import threading
+from mock import MagicMock
+
+from flowbot.broadcast import BroadcastDeduper, BroadcastResult
+from flowbot.sender import Sender
+
+
+class TestBroadcastResult(TestCase):
+    """Test BroadcastResult reporting."""
+
+    def test_sent_failed_pending(self):
+        """Each channel is reported by the state of its future."""
+        futures = dict((cid, Future()) for cid in ('a', 'b', 'c'))
+        futures['a'].set_result(True)
+        futures['b'].set_exception(IOError('down'))
+        result = BroadcastResult(futures)
+        self.assertEqual(result.sent, ['a'])
+        self.assertEqual(list(result.failed), ['b'])
+        self.assertEqual(result.pending, ['c'])
+        self.assertFalse(result.done())
+
+    def test_wait_for_sender(self):
+        """Futures passed to the Sender complete once the message is sent."""
+        send = MagicMock(side_effect=[None, TypeError('bad')])
+        sender = Sender(send, workers=2)
+        futures = {'a': Future(), 'b': Future()}
+        sender.start()
+        for cid in sorted(futures):
+            sender.put({'cid': cid, 'msg': 'hi'}, futures[cid])
+        result = BroadcastResult(futures).wait(5)
+        sender.stop()
+        self.assertTrue(result.done())
+        self.assertEqual(len(result.sent) + len(result.failed), 2)
+
+
+class TestBroadcastDeduper(TestCase):
+    """Test collapsing repeated broadcasts."""
+
+    def test_repeat_within_window(self):
+        """A repeat inside the window reuses the first result."""
+        deduper = BroadcastDeduper(60)
+        send = MagicMock(side_effect=['first', 'second'])
+        self.assertEqual(deduper.get_or_send('k', send), 'first')
+        self.assertEqual(deduper.get_or_send('k', send), 'first')
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(deduper.deduplicated, 1)
+
+    def test_disabled(self):
+        """With no window every broadcast is sent."""
+        deduper = BroadcastDeduper(0)
+        send = MagicMock(side_effect=['first', 'second'])
+        deduper.get_or_send('k', send)
+        self.assertEqual(deduper.get_or_send('k', send), 'second')
+
+    def test_send_outside_lock(self):
+        """Other broadcasts go ahead while one is sending; repeats wait."""
+        deduper = BroadcastDeduper(60)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_send():
+            started.set()
+            release.wait(5)
+            return 'slow'
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(deduper.get_or_send('a', slow_send)))
+        first.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(deduper.get_or_send('b', lambda: 'fast'), 'fast')
+        repeat = threading.Thread(
+            target=lambda: results.append(deduper.get_or_send('a', None)))
+        repeat.start()
+        repeat.join(0.1)
+        self.assertTrue(repeat.is_alive())
+        release.set()
+        first.join(5)
+        repeat.join(5)
+        self.assertEqual(results, ['slow', 'slow'])
+        self.assertEqual(deduper.deduplicated, 1)
+
+    def test_failed_send_not_kept(self):
+        """A broadcast whose send raised is sent again next time."""
+        deduper = BroadcastDeduper(60)
+        send = MagicMock(side_effect=[IOError('down'), 'second'])
+        with self.assertRaises(IOError):
+            deduper.get_or_send('k', send)
+        self.assertEqual(deduper.get_or_send('k', send), 'second')
@@ -1,8 +1,12 @@
+from collections import Counter
 from unittest import TestCase
-from mock import patch
+import threading
+from mock import MagicMock, patch
 
 from flowbot.channel_db import ChannelDb
-from flowbot.tests.mocks import MockServer
+from flowbot.record_store import RecordStore
+from flowbot.config import Config
+from flowbot.tests.mocks import FakeFlow, FakeServer, MockServer
 
 
 class TestChannelDb(TestCase):
@@ -14,8 +18,16 @@ class TestChannelDb(TestCase):
             init.return_value = None
             cdb = ChannelDb()
             cdb.account_id = 1
-            cdb._data = {}
+            cdb._data = RecordStore()
+            cdb._pending_echoes = Counter()
+            cdb._echo_lock = threading.Lock()
+            cdb._write_lock = threading.RLock()
+            cdb._searches = {}
+            cdb._search_lock = threading.Lock()
+            cdb._expires = {}
+            cdb.config = MagicMock(org_id=1, db_channel='db')
             cdb.server = MockServer()
+            cdb.directory = MagicMock()
         return cdb
 
     def test_get_from_memory(self):
@@ -115,3 +127,163 @@ class TestChannelDb(TestCase):
             self.assertTrue(send_message.called)
 
         self.assertEqual(cdb._data['hello'][0], 'world')
+
+    def test_db_channel_id_remembered(self):
+        """The db channel id is looked up once, then remembered."""
+        cdb = self.init_channel_db()
+        cdb.directory.id_for.return_value = 'db-cid'
+        self.assertEqual(cdb._get_db_channel_id(), 'db-cid')
+        self.assertEqual(cdb._get_db_channel_id(), 'db-cid')
+        self.assertEqual(cdb.directory.id_for.call_count, 1)
+
+    def test_load_index(self):
+        """Indexing reads every key from one enumeration of the channel."""
+        cdb = self.init_channel_db()
+        cdb._db_channel_id = 'db-cid'
+        cdb.server.flow.enumerate_messages = MagicMock(return_value=[
+            {'text': '{"b": 2}', 'senderAccountId': 1, 'creationTime': 2},
+            {'text': '{"a": 1}', 'senderAccountId': 1, 'creationTime': 1},
+            {'text': '{"a": 3}', 'senderAccountId': 1, 'creationTime': 3},
+            {'text': '{"a": 4}', 'senderAccountId': 2, 'creationTime': 4},
+        ])
+        self.assertEqual(cdb._load_index().as_dict(), {'a': [1, 3], 'b': [2]})
+
+    def test_apply_message(self):
+        """New db channel messages are indexed, echoes of new() are not."""
+        cdb = self.init_channel_db()
+        cdb._indexed = True
+        cdb._db_channel_id = 'db-cid'
+        with patch.object(cdb, '_get_or_create_db_channel'):
+            cdb.new('a', 1)
+        echo = {'channelId': 'db-cid', 'senderAccountId': 1,
+                'text': '{"a": 1}'}
+        other = {'channelId': 'db-cid', 'senderAccountId': 1,
+                 'text': '{"a": 2}'}
+        self.assertTrue(cdb.is_db_message(echo))
+        cdb.apply_message(echo)
+        cdb.apply_message(other)
+        self.assertEqual(cdb.get('a'), [1, 2])
+        self.assertEqual(cdb.get('missing'), [])
+
+    def test_batch_and_compacted_records(self):
+        """Batched records are read in order; compaction replaces history."""
+        cdb = self.init_channel_db()
+        messages = [
+            {'data': {'text': '{"a": 1}', 'senderAccountId': 1}},
+            {'data': {'text': '[{"a": 2}, {"b": 0}, {"a": 3}]',
+                      'senderAccountId': 1}},
+            {'data': {'text': '{"flowbot.compacted": {"a": [9]}}',
+                      'senderAccountId': 1}},
+            {'data': {'text': '[{"a": 10}]', 'senderAccountId': 1}},
+        ]
+        self.assertEqual(cdb._get_data_from_messages(messages[:2], 'a'),
+                         [1, 2, 3])
+        self.assertEqual(cdb._get_data_from_messages(messages, 'a'), [9, 10])
+
+    def test_compact(self):
+        """Compacting a key posts its whole history as one message."""
+        cdb = self.init_channel_db()
+        cdb._data = RecordStore({'a': [1, 2]})
+        with patch.object(cdb.server.flow, 'send_message') as send_message:
+            with patch.object(cdb, '_get_or_create_db_channel'):
+                cdb.compact('a')
+        self.assertEqual(send_message.call_args[1]['msg'],
+                         '{"flowbot.compacted": {"a": [1, 2]}}')
+
+    def test_concurrent_gets_share_one_search(self):
+        """Lookups of a key being searched for wait for that search."""
+        cdb = self.init_channel_db()
+        cdb._db_channel_id = 'db-cid'
+        started = threading.Event()
+        release = threading.Event()
+
+        def search(**kwargs):
+            started.set()
+            release.wait(5)
+            return [{'data': {'text': '{"a": 1}', 'senderAccountId': 1}}]
+        cdb.server.flow.search = MagicMock(side_effect=search)
+        results = []
+        first = threading.Thread(target=lambda: results.append(cdb.get('a')))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=lambda: results.append(cdb.get('a')))
+        second.start()
+        second.join(0.1)
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(results, [[1], [1]])
+        self.assertEqual(cdb.server.flow.search.call_count, 1)
+        self.assertEqual(cdb._searches, {})
+
+    def test_searched_keys_cached_until_ttl(self):
+        """With cache_ttl, a searched key is read from memory until stale."""
+        cdb = self.init_channel_db()
+        cdb._db_channel_id = 'db-cid'
+        cdb.cache_ttl = 60
+        cdb.server.flow.search = MagicMock(return_value=[
+            {'data': {'text': '{"a": 1}', 'senderAccountId': 1}}])
+        with patch('flowbot.channel_db.time.time', return_value=100):
+            self.assertEqual(cdb.get('a'), [1])
+            self.assertEqual(cdb.get('a'), [1])
+        self.assertEqual(cdb.server.flow.search.call_count, 1)
+        with patch('flowbot.channel_db.time.time', return_value=161):
+            self.assertEqual(cdb.get('a'), [1])
+        self.assertEqual(cdb.server.flow.search.call_count, 2)
+        cdb.invalidate('a')
+        self.assertNotIn('a', cdb._data)
+
+    def test_evicted_keys_forget_expiry(self):
+        """A cached key evicted from memory no longer has an expiry."""
+        cdb = self.init_channel_db()
+        cdb._db_channel_id = 'db-cid'
+        cdb.cache_ttl = 60
+        cdb._data = RecordStore(max_keys=10, on_evict=cdb._evicted)
+        cdb.server.flow.search = MagicMock(return_value=[])
+        for i in range(50):
+            cdb.get('k%d' % i)
+        self.assertEqual(cdb._data.evictions, 40)
+        self.assertEqual(sorted(cdb._expires), sorted(cdb._data.keys()))
+
+    def test_get_many_scans_once(self):
+        """Keys missing from memory are read from one channel scan."""
+        cdb = self.init_channel_db()
+        cdb._db_channel_id = 'db-cid'
+        cdb._data = RecordStore({'a': [0]})
+        cdb.server.flow.enumerate_messages = MagicMock(return_value=[
+            {'text': '{"b": 2}', 'senderAccountId': 1, 'creationTime': 2},
+            {'text': '[{"c": 3}, {"b": 4}]', 'senderAccountId': 1,
+             'creationTime': 3},
+        ])
+        cdb.server.flow.search = MagicMock()
+        self.assertEqual(cdb.get_many(['a', 'b', 'c', 'd']),
+                         {'a': [0], 'b': [2, 4], 'c': [3], 'd': []})
+        self.assertEqual(cdb.server.flow.enumerate_messages.call_count, 1)
+        self.assertFalse(cdb.server.flow.search.called)
+
+    def test_fast_start_loads_in_background(self):
+        """With fast_start, db_keys load in the background; reads wait."""
+        flow = FakeFlow(channels=0)
+        cid = flow.new_channel(flow.org_id, 'FLOWBOT_DB_CHANNEL')
+        flow.add_history(cid, ['{"a": 1}', '{"b": 2}', '{"a": 3}'])
+        release = threading.Event()
+        enumerate_messages = flow.enumerate_messages
+
+        def slow_enumerate(oid, cid):
+            release.wait(5)
+            return enumerate_messages(oid, cid)
+        flow.enumerate_messages = slow_enumerate
+        config = Config({'username': 'bot', 'password': 'p',
+                         'org_id': flow.org_id, 'db_keys': ['a', 'b'],
+                         'fast_start': True})
+        cdb = ChannelDb(FakeServer(flow), config)
+        results = []
+        reader = threading.Thread(target=lambda: results.append(cdb.get('a')))
+        reader.start()
+        reader.join(0.1)
+        self.assertEqual(results, [])
+        release.set()
+        reader.join(5)
+        self.assertEqual(results, [[1, 3]])
+        self.assertEqual(cdb.get('b'), [2])
+        cdb.close()
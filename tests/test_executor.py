@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from unittest import TestCase
+from mock import MagicMock
+
+from flowbot.decorators import cpu_bound, handler_limits
+from flowbot.executor import HandlerExecutor
+
+
+@cpu_bound
+def crash(message):
+    os._exit(1)
+
+
+@cpu_bound
+def shout(message):
+    return 'hey'
+
+
+class TestHandlerExecutor(TestCase):
+    """Test the HandlerExecutor lanes."""
+
+    def run_executor(self, executor, calls):
+        executor.start()
+        for command, message in calls:
+            executor.submit(command, message)
+        executor.stop(timeout=5)
+
+    def test_inline_without_lanes(self):
+        """With no lanes, handlers run on the calling thread."""
+        on_result = MagicMock()
+        executor = HandlerExecutor(lanes=0, on_result=on_result)
+        executor.submit(lambda m: 'hi', {'channelId': 'a'})
+        on_result.assert_called_once_with({'channelId': 'a'}, 'hi')
+
+    def test_channel_order(self):
+        """A channel's handlers run in the order they were submitted."""
+        seen = []
+        executor = HandlerExecutor(lanes=3)
+        self.run_executor(executor, [
+            (lambda m: seen.append(m['n']), {'channelId': 'a', 'n': i})
+            for i in range(50)])
+        self.assertEqual(seen, list(range(50)))
+        self.assertEqual(executor.counts['completed'], 50)
+
+    def test_timeout_moves_on(self):
+        """A handler past its timeout no longer holds up its channel."""
+        release = threading.Event()
+        seen = []
+
+        @handler_limits(timeout=0.05)
+        def slow(message):
+            release.wait(5)
+
+        executor = HandlerExecutor(lanes=1)
+        executor.start()
+        executor.submit(slow, {'channelId': 'a'})
+        executor.submit(lambda m: seen.append('fast'), {'channelId': 'a'})
+        deadline = time.time() + 5
+        while not seen and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        executor.stop(timeout=5)
+        self.assertEqual(seen, ['fast'])
+        self.assertEqual(executor.counts['timeouts'], 1)
+
+    def test_errors_are_counted(self):
+        """A failing handler is logged and counted, not raised."""
+        def broken(message):
+            raise ValueError('boom')
+        executor = HandlerExecutor(lanes=0)
+        executor.submit(broken, {'channelId': 'a'})
+        self.assertEqual(executor.counts['errors'], 1)
+
+    def test_lane_survives_broken_process_pool(self):
+        """A dead pool worker is an error; the next handler still runs."""
+        done = threading.Event()
+        results = []
+
+        def on_result(message, result):
+            results.append(result)
+            done.set()
+        executor = HandlerExecutor(lanes=1, processes=1, on_result=on_result)
+        executor.start()
+        try:
+            executor.submit(crash, {'channelId': 'a'})
+            executor.submit(shout, {'channelId': 'a'})
+            self.assertTrue(done.wait(30))
+        finally:
+            executor.stop(timeout=5)
+        self.assertEqual(results, ['hey'])
+        self.assertEqual(executor.counts['errors'], 1)
@@ -0,0 +1,106 @@
+import time
+from unittest import TestCase
+
+from flowbot.decorators import rate_limit
+from flowbot.executor import HandlerExecutor
+from flowbot.filters import (
+    CHANNEL, SENDER, AgeFilter, AuthorFilter, ChannelFilter, CommandLimiter,
+    FilterPipeline, SenderRateFilter
+)
+
+
+class TestFilterPipeline(TestCase):
+    """Test the incoming message filters."""
+
+    def test_stops_at_first_drop(self):
+        """A message is dropped by the first filter that rejects it."""
+        pipeline = FilterPipeline([AuthorFilter('me'), ChannelFilter(
+            deny=['noisy'])])
+        self.assertFalse(pipeline.accept(
+            {'senderAccountId': 'me', 'channelId': 'noisy'}))
+        self.assertFalse(pipeline.accept(
+            {'senderAccountId': 'you', 'channelId': 'noisy'}))
+        self.assertTrue(pipeline.accept(
+            {'senderAccountId': 'you', 'channelId': 'quiet'}))
+        self.assertEqual(pipeline.stats(), {
+            'passed': 1, 'dropped': {'author': 1, 'channel': 1}})
+
+    def test_age(self):
+        """Messages past the age limit are dropped."""
+        age = AgeFilter(60)
+        now = time.time() * 1000
+        self.assertTrue(age.accept({'creationTime': now}))
+        self.assertFalse(age.accept({'creationTime': now - 120000}))
+        self.assertTrue(age.accept({}))
+
+    def test_channel_allow(self):
+        """With an allow list only those channels pass."""
+        channels = ChannelFilter(allow=['a'])
+        self.assertTrue(channels.accept({'channelId': 'a'}))
+        self.assertFalse(channels.accept({'channelId': 'b'}))
+
+    def test_sender_rate(self):
+        """A sender is limited to its burst; others are unaffected."""
+        rate = SenderRateFilter(0.001, burst=2)
+        results = [rate.accept({'senderAccountId': 'a'}) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertTrue(rate.accept({'senderAccountId': 'b'}))
+
+
+def ping(message):
+    return 'pong'
+
+
+@rate_limit(0.001, burst=1, per='channel')
+def status(message):
+    return 'ok'
+
+
+class TestCommandLimiter(TestCase):
+    """Test shedding commands before they reach the executor."""
+
+    def test_limits(self):
+        """Each configured limit is kept per sender or channel."""
+        limiter = CommandLimiter(
+            [(SENDER, 0.001, 2), (CHANNEL, 0.001, 3)])
+        results = [limiter.check(ping, {'senderAccountId': 'a',
+                                        'channelId': 'c'})
+                   for _ in range(3)]
+        self.assertEqual(results, [None, None, 'sender_rate'])
+        self.assertIsNone(
+            limiter.check(ping, {'senderAccountId': 'b', 'channelId': 'c'}))
+        self.assertEqual(
+            limiter.check(ping, {'senderAccountId': 'c', 'channelId': 'c'}),
+            'channel_rate')
+        self.assertIsNone(
+            limiter.check(ping, {'senderAccountId': 'c', 'channelId': 'd'}))
+        self.assertEqual(limiter.stats(),
+                         {'sender_rate': 1, 'channel_rate': 1})
+
+    def test_command_limit(self):
+        """A command's own rate_limit only applies to that command."""
+        limiter = CommandLimiter()
+        message = {'senderAccountId': 'a', 'channelId': 'c'}
+        self.assertIsNone(limiter.check(status, message))
+        self.assertEqual(limiter.check(status, message), 'channel_rate')
+        self.assertIsNone(limiter.check(status, {'channelId': 'd'}))
+        self.assertIsNone(limiter.check(ping, message))
+        with self.assertRaises(ValueError):
+            rate_limit(1, per='org')
+
+    def test_overload(self):
+        """Commands are shed once the backlog reaches max_backlog."""
+        limiter = CommandLimiter(max_backlog=2)
+        self.assertIsNone(limiter.check(ping, {}, backlog=1))
+        self.assertEqual(limiter.check(ping, {}, backlog=2), 'overload')
+
+    def test_lane_backlog(self):
+        """The executor reports the backlog of one channel's lane."""
+        executor = HandlerExecutor(lanes=4)
+        for _ in range(3):
+            executor.submit(ping, {'channelId': 'noisy'})
+        self.assertEqual(executor.backlog(), 3)
+        self.assertEqual(executor.backlog('noisy'), 3)
+        quiet = [c for c in ('a', 'b', 'c', 'd', 'e')
+                 if executor.backlog(c) == 0]
+        self.assertTrue(quiet)
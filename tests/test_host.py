@@ -0,0 +1,94 @@
+from unittest import TestCase
+from mock import patch
+
+from flowbot import host as host_module
+from flowbot.bot import FlowBot
+from flowbot.config import ImproperlyConfigured
+from flowbot.host import BotHost
+from flowbot.tests.mocks import FakeFlow, FakeServer, signal_sends
+
+
+class PingBot(FlowBot):
+    def commands(self):
+        return {'ping': self.ping}
+
+    def ping(self, message):
+        self.reply(message, 'pong')
+
+
+class EchoBot(FlowBot):
+    def commands(self):
+        return {'echo': self.echo}
+
+    def echo(self, message):
+        self.reply(message, 'echo')
+
+
+def settings(org_id='org', username='bot'):
+    return {'username': username, 'password': 'p', 'org_id': org_id}
+
+
+class TestBotHost(TestCase):
+    """Test running several bots on one BotHost."""
+
+    def setUp(self):
+        self.flow = FakeFlow(channels=2)
+        self.replies = signal_sends(self.flow)
+
+    def make_host(self, bots):
+        with patch.object(host_module, 'Server',
+                          lambda config: FakeServer(self.flow)):
+            return BotHost(bots)
+
+    def test_shared_infrastructure(self):
+        """Bots of one account share the connection, caches and workers."""
+        host = self.make_host([(PingBot, settings()), (EchoBot, settings())])
+        ping, echo = host.bots
+        self.assertIs(ping.server, echo.server)
+        self.assertIs(ping.directory, echo.directory)
+        self.assertIs(ping.membership, echo.membership)
+        self.assertIs(ping.executor, echo.executor)
+        self.assertIs(ping.sender.sender, echo.sender.sender)
+        self.assertEqual(len(host._servers), 1)
+
+    def test_shared_account_joins_each_org(self):
+        """A second org of an account is joined on the shared connection."""
+        host = self.make_host([(PingBot, settings('org')),
+                               (EchoBot, settings('other')),
+                               (PingBot, settings('other'))])
+        self.assertEqual(len(host._servers), 1)
+        self.assertEqual(host.bots[0].server.joined, ['other'])
+
+    def test_shared_account_profiles_must_match(self):
+        """Bots of one account can't ask for different profiles."""
+        renamed = dict(settings(), display_name='Echo')
+        with self.assertRaises(ImproperlyConfigured):
+            self.make_host([(PingBot, settings()), (EchoBot, renamed)])
+
+    def test_routes_to_each_bot(self):
+        """A message reaches every bot of its account and org."""
+        host = self.make_host([(PingBot, settings()), (EchoBot, settings())])
+        host.run(block=False)
+        try:
+            self.flow.post('c0', 'ping echo')
+            for _ in range(2):
+                self.assertTrue(self.replies.acquire(timeout=5))
+        finally:
+            host.cleanup()
+        self.assertEqual(sorted(m['text'] for m in self.flow.sent),
+                         ['echo', 'pong'])
+
+    def test_routes_by_org(self):
+        """A message naming its org only reaches that org's bots."""
+        host = self.make_host([(PingBot, settings('org')),
+                               (PingBot, settings('other'))])
+        host.run(block=False)
+        try:
+            self.flow.notify('message', {'regularMessages': [{
+                'orgId': 'other', 'channelId': 'c0',
+                'senderAccountId': 'm1', 'text': 'ping'}]})
+            self.assertTrue(self.replies.acquire(timeout=5))
+            self.assertFalse(self.replies.acquire(timeout=0.2))
+        finally:
+            host.cleanup()
+        self.assertEqual(self.flow.sent[0]['text'], 'pong')
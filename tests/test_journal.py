@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from mock import MagicMock
+
+from flowbot.journal import OutboxJournal
+from flowbot.ratelimit import TokenBucket
+from flowbot.sender import Sender
+
+
+class TestOutboxJournal(TestCase):
+    """Test the on-disk journal of unsent messages."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'outbox.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pending_survives_reopening(self):
+        """Messages not marked done are pending when the journal reopens."""
+        journal = OutboxJournal(self.path, interval=60)
+        first = journal.add({'cid': 'a', 'msg': 1})
+        journal.add({'cid': 'a', 'msg': 2})
+        journal.flush()
+        journal.done(first)
+        journal.add({'cid': 'b', 'msg': 3})
+        journal.close()
+
+        journal = OutboxJournal(self.path, interval=60)
+        self.assertEqual([m['msg'] for _, m in journal.pending()], [2, 3])
+        later = journal.add({'cid': 'c', 'msg': 4})
+        self.assertGreater(later, max(i for i, _ in journal.pending()))
+        journal.close()
+
+    def test_sent_within_interval_never_written(self):
+        """A message added and done before a flush is not written."""
+        journal = OutboxJournal(self.path, interval=60)
+        journal.done(journal.add({'cid': 'a', 'msg': 1}))
+        journal.flush()
+        count = journal._conn.execute(
+            'SELECT COUNT(*) FROM outbox').fetchone()[0]
+        self.assertEqual(count, 0)
+        journal.close()
+
+    def test_sender_resends_after_restart(self):
+        """Messages a stopped sender didn't send are sent by the next one."""
+        journal = OutboxJournal(self.path, interval=60)
+        sender = Sender(MagicMock(), journal=journal)
+        sender.put({'cid': 'a', 'msg': 'hi'})
+        sender.stop(timeout=0)
+
+        send = MagicMock()
+        sender = Sender(send, journal=OutboxJournal(self.path, interval=60))
+        sender.start()
+        self.assertTrue(sender.join(5))
+        sender.stop()
+        send.assert_called_once_with(cid='a', msg='hi')
+
+        journal = OutboxJournal(self.path, interval=60)
+        self.assertEqual(journal.pending(), [])
+        journal.close()
+
+    def test_drain(self):
+        """stop(drain=...) waits for the queued messages to be sent."""
+        release = threading.Event()
+        sent = []
+
+        def send(**message):
+            release.wait(5)
+            sent.append(message['msg'])
+        sender = Sender(send, workers=2)
+        sender.start()
+        for i in range(4):
+            sender.put({'cid': 'c%d' % i, 'msg': i})
+        threading.Timer(0.05, release.set).start()
+        sender.stop(timeout=0, drain=5)
+        self.assertEqual(sorted(sent), [0, 1, 2, 3])
+
+    def test_drain_deadline_stops_sending(self):
+        """Once the drain deadline passes, rate limited sends are not made."""
+        sent = []
+        sender = Sender(lambda **message: sent.append(message['msg']),
+                        rate_limit=TokenBucket(2, burst=1))
+        sender.start()
+        for i in range(40):
+            sender.put({'cid': 'a', 'msg': i})
+        sender.stop(drain=0.5)
+        self.assertLessEqual(len(sent), 3)
+        self.assertEqual(sent, list(range(len(sent))))
+
+    def test_stop_keeps_unsent_messages(self):
+        """Messages not sent by the drain deadline stay in the journal."""
+        sent = []
+
+        def send(**message):
+            time.sleep(0.02)
+            sent.append(message['msg'])
+        sender = Sender(send, journal=OutboxJournal(self.path, interval=60))
+        sender.start()
+        for i in range(100):
+            sender.put({'cid': 'a', 'msg': i})
+        sender.stop(timeout=0, drain=0.1)
+        stopped = list(sent)
+        time.sleep(0.1)
+        self.assertEqual(sent, stopped)
+
+        journal = OutboxJournal(self.path, interval=60)
+        pending = [m['msg'] for _, m in journal.pending()]
+        journal.close()
+        self.assertEqual(sorted(sent + pending), list(range(100)))
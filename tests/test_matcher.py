@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from flowbot.matcher import CommandMatcher, Prefix, Regex, Word, \
+    LINEAR_SCAN_MAX
+
+
+class TestCommandMatcher(TestCase):
+    """Test the compiled CommandMatcher."""
+
+    def test_substring(self):
+        """Plain triggers match anywhere, in registration order."""
+        matcher = CommandMatcher([('hello', 1), ('ell', 2), ('bye', 3)])
+        self.assertEqual(matcher.match('well, hello there'), [1, 2])
+        self.assertEqual(matcher.match('nothing'), [])
+
+    def test_overlapping_literals(self):
+        """Overlapping triggers all fire when compiled into one scanner."""
+        commands = [('hello', 1), ('hell', 2), ('llo', 3), ('lo w', 4)]
+        commands += [('filler%d' % i, None) for i in range(LINEAR_SCAN_MAX)]
+        matcher = CommandMatcher(commands)
+        self.assertIsNotNone(matcher._scanner)
+        self.assertEqual(matcher.match('hello world'), [1, 2, 3, 4])
+
+    def test_word(self):
+        """Word triggers only match whole words."""
+        matcher = CommandMatcher([(Word('hi'), 1)])
+        self.assertEqual(matcher.match('oh hi there'), [1])
+        self.assertEqual(matcher.match('hi'), [1])
+        self.assertEqual(matcher.match('this'), [])
+
+    def test_prefix(self):
+        """Prefix triggers only match as the first word."""
+        matcher = CommandMatcher([(Prefix('!cmd'), 1)])
+        self.assertEqual(matcher.match('  !cmd arg'), [1])
+        self.assertEqual(matcher.match('say !cmd'), [])
+        self.assertEqual(matcher.match('!cmdx'), [])
+
+    def test_regex(self):
+        """Regex triggers match with re.search."""
+        matcher = CommandMatcher([(Regex(r'#\d+'), 1), ('#', 2)])
+        self.assertEqual(matcher.match('see #42'), [1, 2])
+        self.assertEqual(matcher.match('see #x'), [2])
@@ -0,0 +1,70 @@
+from unittest import TestCase
+from mock import MagicMock
+
+from flowbot.membership import MembershipCache
+
+
+class TestMembershipCache(TestCase):
+    """Test the MembershipCache."""
+
+    def init_cache(self, ttl=60):
+        flow = MagicMock()
+        flow.enumerate_channel_members.return_value = [
+            {'accountId': 'admin', 'state': 'a'},
+            {'accountId': 'member', 'state': 'm'},
+        ]
+        flow.enumerate_org_members.return_value = [
+            {'accountId': 'owner', 'state': 'o'},
+        ]
+        return MembershipCache(flow, 'org', ttl=ttl)
+
+    def test_lookup_is_cached(self):
+        """Members are enumerated once per channel until they expire."""
+        cache = self.init_cache()
+        self.assertEqual(cache.channel_state('c', 'admin'), 'a')
+        self.assertEqual(cache.channel_state('c', 'member'), 'm')
+        self.assertIsNone(cache.channel_state('c', 'stranger'))
+        self.assertEqual(cache.flow.enumerate_channel_members.call_count, 1)
+
+    def test_ttl_zero_disables_cache(self):
+        """A ttl of 0 enumerates members on every lookup."""
+        cache = self.init_cache(ttl=0)
+        cache.org_state('owner')
+        cache.org_state('owner')
+        self.assertEqual(cache.flow.enumerate_org_members.call_count, 2)
+
+    def test_member_event_invalidates(self):
+        """A channel-member-event drops only the channels it names."""
+        cache = self.init_cache()
+        cache.channel_state('c1', 'admin')
+        cache.channel_state('c2', 'admin')
+        cache.handle_channel_member_event(
+            'channel-member-event', [{'channelId': 'c1'}])
+        cache.channel_state('c1', 'admin')
+        cache.channel_state('c2', 'admin')
+        self.assertEqual(cache.flow.enumerate_channel_members.call_count, 3)
+
+    def test_unrecognized_event_invalidates_all(self):
+        """An event without ids clears every cached org."""
+        cache = self.init_cache()
+        cache.org_state('owner')
+        cache.handle_org_member_event('org-member-event', {})
+        cache.org_state('owner')
+        self.assertEqual(cache.flow.enumerate_org_members.call_count, 2)
+
+    def test_invalidated_during_load_not_cached(self):
+        """An enumeration overtaken by a member event is not cached."""
+        cache = self.init_cache()
+        states = iter(['a', 'm'])
+
+        def enumerate_members(cid):
+            state = next(states)
+            if state == 'a':
+                cache.handle_channel_member_event(
+                    'channel-member-event', [{'channelId': cid}])
+            return [{'accountId': 'demoted', 'state': state}]
+        cache.flow.enumerate_channel_members.side_effect = enumerate_members
+        self.assertEqual(cache.channel_state('c', 'demoted'), 'a')
+        self.assertEqual(cache.channel_state('c', 'demoted'), 'm')
+        self.assertEqual(cache.channel_state('c', 'demoted'), 'm')
+        self.assertEqual(cache.flow.enumerate_channel_members.call_count, 2)
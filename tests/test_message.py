@@ -0,0 +1,45 @@
+import pickle
+from unittest import TestCase
+
+from flowbot.message import Message
+
+
+class TestMessage(TestCase):
+    """Test the lazily decoded Message envelope."""
+
+    def test_other_data_decoded_on_read(self):
+        """otherData stays raw until it is read, then is a dict."""
+        message = Message({'otherData': '{"highlighted": ["a"]}'})
+        self.assertIsInstance(dict.get(message, 'otherData'), str)
+        self.assertEqual(message['otherData'], {'highlighted': ['a']})
+        self.assertEqual(message.highlighted, frozenset(['a']))
+
+    def test_other_data_decoded_when_copied(self):
+        """Copies and the other dict methods see the decoded otherData."""
+        raw = {'otherData': '{"highlighted": ["a"]}'}
+        decoded = {'highlighted': ['a']}
+        self.assertEqual(dict(Message(raw))['otherData'], decoded)
+        self.assertEqual(dict(**Message(raw))['otherData'], decoded)
+        self.assertEqual(Message(raw).pop('otherData'), decoded)
+        self.assertEqual(Message(raw).setdefault('otherData'), decoded)
+
+    def test_bad_other_data(self):
+        """otherData that isn't JSON is left alone."""
+        message = Message({'otherData': 'not json'})
+        self.assertEqual(message.get('otherData'), 'not json')
+        self.assertEqual(message.highlighted, frozenset())
+
+    def test_cached_fields(self):
+        """The common fields are available as attributes."""
+        message = Message({'senderAccountId': 's', 'channelId': 'c',
+                           'creationTime': 1500, 'text': 'hi'})
+        self.assertEqual(message.sender, 's')
+        self.assertEqual(message.channel_id, 'c')
+        self.assertEqual(message.creation_time, 1.5)
+        self.assertEqual(message.text, 'hi')
+        self.assertIsNone(Message().creation_time)
+
+    def test_pickle(self):
+        """Messages can be sent to a process pool."""
+        message = pickle.loads(pickle.dumps(Message({'otherData': '{}'})))
+        self.assertEqual(message['otherData'], {})
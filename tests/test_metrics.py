@@ -0,0 +1,97 @@
+from unittest import TestCase
+from mock import MagicMock
+
+from flowbot.executor import HandlerExecutor
+from flowbot.message import Message
+from flowbot.metrics import PhaseTimes, Registry, Statsd
+from flowbot.sender import Envelope, Sender
+
+
+class TestRegistry(TestCase):
+    """Test the in-process metrics registry."""
+
+    def test_counters_and_histograms(self):
+        """Counters add up and histograms count their observations."""
+        registry = Registry()
+        registry.incr('hits')
+        registry.incr('hits', 2)
+        registry.observe('lookup_seconds', 0.02, scope='org')
+        registry.observe('lookup_seconds', 3, scope='org')
+        self.assertEqual(registry.counter('hits'), 3)
+        histogram = registry.histogram('lookup_seconds', scope='org')
+        self.assertEqual(histogram['count'], 2)
+        self.assertAlmostEqual(histogram['sum'], 3.02)
+
+    def test_prometheus_dump(self):
+        """dump() renders cumulative buckets in the text format."""
+        registry = Registry(buckets=(0.1, 1))
+        registry.incr('sent', command='ping')
+        registry.observe('send_seconds', 0.5)
+        lines = registry.dump().splitlines()
+        self.assertIn('# TYPE flowbot_sent_total counter', lines)
+        self.assertIn('flowbot_sent_total{command="ping"} 1', lines)
+        self.assertIn('flowbot_send_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('flowbot_send_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('flowbot_send_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('flowbot_send_seconds_count 1', lines)
+
+
+class TestPhaseTimes(TestCase):
+    """Test timing the phases of a job."""
+
+    def test_phases(self):
+        times = PhaseTimes()
+        with times.phase('connect'):
+            pass
+        other = PhaseTimes()
+        other.add('load', 0.5)
+        times.extend(other)
+        self.assertEqual([name for name, _ in times.phases],
+                         ['connect', 'load'])
+        self.assertTrue(str(times).endswith('load 0.500s'))
+        registry = Registry()
+        times.observe(registry)
+        self.assertEqual(registry.histogram(
+            'startup_seconds', phase='load'), {'count': 1, 'sum': 0.5})
+
+
+class TestStatsd(TestCase):
+    """Test the statsd sink."""
+
+    def test_lines(self):
+        """Label values are appended to the metric name."""
+        statsd = Statsd()
+        statsd._socket = MagicMock()
+        statsd.incr('handler_errors', command='ping')
+        statsd.observe('send_seconds', 0.25)
+        sent = [c[0][0] for c in statsd._socket.sendto.call_args_list]
+        self.assertEqual(sent, [b'flowbot.handler_errors.ping:1|c',
+                                b'flowbot.send_seconds:250.000|ms'])
+
+
+class TestInstrumentation(TestCase):
+    """Test the hot-path hooks report to the sink."""
+
+    def test_handler_metrics(self):
+        """The executor times the wait for and run of each handler."""
+        registry = Registry()
+        executor = HandlerExecutor(lanes=0, metrics=registry)
+
+        def ping(message):
+            return 'pong'
+        executor.submit(ping, Message({'channelId': 'c'}))
+        for name in ('handler_wait_seconds', 'handler_seconds'):
+            histogram = registry.histogram(name, command='ping')
+            self.assertEqual(histogram['count'], 1)
+        self.assertEqual(
+            registry.counter('handler_completed', command='ping'), 1)
+
+    def test_send_metrics(self):
+        """The sender times the queue wait and the send."""
+        registry = Registry()
+        sender = Sender(MagicMock(), metrics=registry)
+        sender._send(Envelope({'cid': 'a'}))
+        self.assertEqual(
+            registry.histogram('send_queue_wait_seconds')['count'], 1)
+        self.assertEqual(registry.histogram('send_seconds')['count'], 1)
+        self.assertEqual(registry.counter('messages_sent'), 1)
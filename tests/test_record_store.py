@@ -0,0 +1,47 @@
+import threading
+from unittest import TestCase
+
+from flowbot.record_store import RecordStore
+
+
+class TestRecordStore(TestCase):
+    """Test the RecordStore behind ChannelDb."""
+
+    def test_lru_eviction_skips_pinned(self):
+        """Only unpinned keys are evicted, least recently used first."""
+        store = RecordStore(max_keys=2, pinned=['p'])
+        store.append('a', 1)
+        store.append('b', 2)
+        store.get('a')
+        store.append('c', 3)
+        self.assertEqual(sorted(store.keys()), ['a', 'c', 'p'])
+        self.assertEqual(store.evictions, 1)
+
+    def test_get_returns_copy(self):
+        """Changing a returned list does not change the store."""
+        store = RecordStore({'a': [1]})
+        store.get('a').append(2)
+        self.assertEqual(store['a'], [1])
+        self.assertIsNone(store.get('missing'))
+
+    def test_append_initial(self):
+        """A new key starts from the initial records given."""
+        store = RecordStore()
+        store.append('a', 3, initial=[1, 2])
+        store.append('a', 4, initial=['ignored'])
+        self.assertEqual(store['a'], [1, 2, 3, 4])
+
+    def test_concurrent_appends(self):
+        """Appends from many threads are all kept."""
+        store = RecordStore()
+
+        def write(n):
+            for i in range(500):
+                store.append('k', (n, i))
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(store['k']), 4000)
@@ -0,0 +1,100 @@
+import threading
+from unittest import TestCase
+from mock import patch
+
+from flowbot.decorators import cached
+from flowbot.message import Message
+from flowbot.reply_cache import ReplyCache
+
+
+class StatusBot(object):
+    def __init__(self):
+        self.calls = 0
+
+    @cached(ttl=60, max_size=2)
+    def status(self, message):
+        self.calls += 1
+        return 'ok %d' % self.calls
+
+
+def message(text, channel='c'):
+    return Message({'text': text, 'channelId': channel})
+
+
+class TestReplyCache(TestCase):
+    """Test remembering command replies."""
+
+    def test_hits_and_expiry(self):
+        """A reply is reused until it expires."""
+        cache = ReplyCache(ttl=10)
+        with patch('flowbot.reply_cache.time.time', return_value=100):
+            self.assertEqual(cache.get_or_call('a', lambda: 1), 1)
+            self.assertEqual(cache.get_or_call('a', lambda: 2), 1)
+        with patch('flowbot.reply_cache.time.time', return_value=111):
+            self.assertEqual(cache.get_or_call('a', lambda: 3), 3)
+        self.assertEqual(cache.stats(), {
+            'hits': 1, 'misses': 2, 'coalesced': 0, 'evictions': 0,
+            'size': 1})
+
+    def test_lru_eviction(self):
+        """Past max_size the least recently used reply is dropped."""
+        cache = ReplyCache(max_size=2)
+        cache.get_or_call('a', lambda: 1)
+        cache.get_or_call('b', lambda: 2)
+        cache.get_or_call('a', lambda: 0)
+        cache.get_or_call('c', lambda: 3)
+        self.assertEqual(cache.get_or_call('a', lambda: 0), 1)
+        self.assertEqual(cache.get_or_call('b', lambda: 4), 4)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    def test_none_and_errors_not_cached(self):
+        """Replies of None and exceptions are not remembered."""
+        cache = ReplyCache()
+        self.assertIsNone(cache.get_or_call('a', lambda: None))
+        with self.assertRaises(ValueError):
+            cache.get_or_call('b', lambda: int('x'))
+        self.assertEqual(cache.get_or_call('a', lambda: 1), 1)
+        self.assertEqual(cache.get_or_call('b', lambda: 2), 2)
+
+    def test_concurrent_calls_coalesced(self):
+        """Calls for a key being computed wait for that one call."""
+        cache = ReplyCache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'done'
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(cache.get_or_call('a', slow)))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(
+            target=lambda: results.append(cache.get_or_call('a', slow)))
+        second.start()
+        second.join(0.1)
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(results, ['done', 'done'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['coalesced'], 1)
+
+    def test_cached_decorator(self):
+        """Replies are keyed by channel and normalized text, per bot."""
+        bot = StatusBot()
+        self.assertEqual(bot.status(message('Status')), 'ok 1')
+        self.assertEqual(bot.status(message('  status ')), 'ok 1')
+        self.assertEqual(bot.status(message('status', 'd')), 'ok 2')
+        self.assertEqual(StatusBot().status(message('status')), 'ok 1')
+        self.assertEqual(StatusBot.status.cache.stats()['hits'], 1)
+
+    def test_cached_rejects_async(self):
+        with self.assertRaises(TypeError):
+            @cached()
+            async def status(self, message):
+                return 'ok'
@@ -0,0 +1,141 @@
+from unittest import TestCase
+import threading
+from mock import MagicMock
+
+from flowbot.ratelimit import TokenBucket
+from flowbot.sender import (
+    BLOCK, COALESCE, DROP_NEWEST, DROP_OLDEST, Envelope, OutboundQueue, Sender,
+    shard_index,
+)
+
+
+class TestSender(TestCase):
+    """Test the Sender worker pool."""
+
+    def test_shard_index_stable(self):
+        """The same channel always maps to the same shard."""
+        self.assertEqual(shard_index('abc', 8), shard_index('abc', 8))
+        self.assertEqual(shard_index('abc', 1), 0)
+
+    def test_channel_order_preserved(self):
+        """Messages for one channel are sent in the order they were queued."""
+        send = MagicMock()
+        sender = Sender(send, workers=4)
+        sender.start()
+        for i in range(20):
+            for cid in ('a', 'b', 'c'):
+                sender.put({'cid': cid, 'msg': i})
+        sender.join()
+        sender.stop()
+
+        self.assertEqual(send.call_count, 60)
+        for cid in ('a', 'b', 'c'):
+            sent = [c[1]['msg'] for c in send.call_args_list
+                    if c[1]['cid'] == cid]
+            self.assertEqual(sent, list(range(20)))
+
+    def test_stats(self):
+        """Queued messages show up in the queue depth gauge."""
+        sender = Sender(MagicMock(), workers=2)
+        sender.put({'cid': 'a', 'msg': 'hi'})
+        stats = sender.stats()
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['workers'], 2)
+
+
+class TestOutboundQueue(TestCase):
+    """Test the bounded OutboundQueue overflow policies."""
+
+    def fill(self, queue, count):
+        for i in range(count):
+            queue.put({'cid': 'a', 'msg': i})
+
+    def test_drop_newest(self):
+        """A full drop_newest queue rejects the new message."""
+        queue = OutboundQueue(2, DROP_NEWEST)
+        self.fill(queue, 2)
+        self.assertFalse(queue.put({'cid': 'a', 'msg': 2}))
+        self.assertEqual([queue.get()['msg'] for _ in range(2)], [0, 1])
+        self.assertEqual(queue.overflow['dropped_newest'], 1)
+
+    def test_drop_oldest(self):
+        """A full drop_oldest queue discards its head."""
+        queue = OutboundQueue(2, DROP_OLDEST)
+        self.fill(queue, 3)
+        self.assertEqual([queue.get()['msg'] for _ in range(2)], [1, 2])
+        self.assertEqual(queue.overflow['dropped_oldest'], 1)
+
+    def test_coalesce(self):
+        """A duplicate message is coalesced into the one already queued."""
+        queue = OutboundQueue(2, COALESCE, put_timeout=0)
+        self.fill(queue, 2)
+        self.assertFalse(queue.put({'cid': 'a', 'msg': 1}))
+        self.assertEqual(queue.overflow['coalesced'], 1)
+        self.assertFalse(queue.put({'cid': 'a', 'msg': 5}))
+        self.assertEqual(queue.overflow['timed_out'], 1)
+
+    def test_block_timeout(self):
+        """A full block queue waits for room, then drops the message."""
+        queue = OutboundQueue(1, BLOCK, put_timeout=0.01)
+        self.fill(queue, 1)
+        self.assertFalse(queue.put({'cid': 'a', 'msg': 1}))
+        self.assertEqual(queue.overflow['blocked'], 1)
+        self.assertEqual(queue.overflow['timed_out'], 1)
+        self.assertEqual(queue.qsize(), 1)
+
+    def test_put_without_blocking(self):
+        """Without block, a full block queue drops the message at once."""
+        queue = OutboundQueue(1, BLOCK)
+        self.fill(queue, 1)
+        self.assertFalse(queue.put({'cid': 'a', 'msg': 1}, block=False))
+        self.assertEqual(queue.overflow['timed_out'], 1)
+        self.assertEqual(queue.qsize(), 1)
+
+
+class TestSenderFailures(TestCase):
+    """Test the Sender retries, dead letters and rate limits."""
+
+    def test_retry_then_succeed(self):
+        """A transient failure is retried."""
+        send = MagicMock(side_effect=[IOError('flaky'), None])
+        sender = Sender(send, retries=2, retry_base=0.001)
+        sender._send(Envelope({'cid': 'a', 'msg': 'hi'}))
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(sender.counts['sent'], 1)
+        self.assertEqual(sender.counts['retried'], 1)
+
+    def test_dead_letter(self):
+        """A message that keeps failing is dead-lettered, not raised."""
+        send = MagicMock(side_effect=IOError('down'))
+        sender = Sender(send, retries=2, retry_base=0.001)
+        sender._send(Envelope({'cid': 'a', 'msg': 'hi'}))
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(len(sender.dead_letters), 1)
+        self.assertEqual(sender.dead_letters[0]['message']['msg'], 'hi')
+
+    def test_permanent_error_not_retried(self):
+        """A bad message is dead-lettered without retrying."""
+        send = MagicMock(side_effect=TypeError('bad'))
+        sender = Sender(send, retries=5)
+        sender._send(Envelope({'cid': 'a'}))
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(sender.counts['failed'], 1)
+
+    def test_rate_limit_waits(self):
+        """Sends beyond the burst wait for the bucket to refill."""
+        sender = Sender(MagicMock(), rate_limit=TokenBucket(100, burst=1))
+        for _ in range(3):
+            sender._send(Envelope({'cid': 'a'}))
+        self.assertEqual(sender.counts['sent'], 3)
+        self.assertTrue(sender.counts['rate_limited'] >= 1)
+
+    def test_disabled_rate_limits(self):
+        """Rate limits of 0, as FlowBot passes by default, don't limit."""
+        sent = threading.Event()
+        sender = Sender(lambda **message: sent.set(), rate_limit=0,
+                        channel_rate_limit=0)
+        sender.start()
+        sender.put({'cid': 'a', 'msg': 'hi'})
+        self.assertTrue(sent.wait(5))
+        sender.stop()
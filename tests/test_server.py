@@ -0,0 +1,52 @@
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from flowbot.config import Config
+from flowbot.server import Server
+from flowbot.tests.mocks import FakeFlow
+
+
+class TestServer(TestCase):
+    """Test setting up the flow connection."""
+
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.db_dir)
+        self.flows = []
+
+    def make_server(self, **settings):
+        settings.update(
+            username='bot', password='p', org_id='org', db_dir=self.db_dir)
+        flow = FakeFlow()
+        self.flows.append(flow)
+        with patch('flowbot.server.Flow', return_value=flow):
+            with patch.object(flow, 'set_profile') as set_profile:
+                server = Server(Config(settings))
+        return server, set_profile
+
+    def test_profile_always_set(self):
+        """Without fast_start the profile is set on every start."""
+        for _ in range(2):
+            server, set_profile = self.make_server()
+            self.assertTrue(set_profile.called)
+
+    def test_fast_start_skips_unchanged_profile(self):
+        """With fast_start the profile is only set when it has changed."""
+        _, set_profile = self.make_server(fast_start=True)
+        self.assertTrue(set_profile.called)
+        _, set_profile = self.make_server(fast_start=True)
+        self.assertFalse(set_profile.called)
+        with patch.object(FakeFlow, 'get_profile_item_json',
+                          return_value='{"name": "New Name"}'):
+            _, set_profile = self.make_server(fast_start=True)
+        self.assertTrue(set_profile.called)
+
+    def test_timings(self):
+        """Every setup step is timed, with or without fast_start."""
+        for fast_start in (False, True):
+            server, _ = self.make_server(fast_start=fast_start)
+            self.assertEqual(
+                sorted(name for name, _ in server.timings.phases),
+                ['flow', 'login', 'org', 'profile'])
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flowbot.snapshot import ChannelDbSnapshot
+
+
+class TestChannelDbSnapshot(TestCase):
+    """Test the on-disk ChannelDb snapshot."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        """Saved records and position survive reopening the snapshot."""
+        snapshot = ChannelDbSnapshot(self.path)
+        self.assertEqual(snapshot.load(), {})
+        first = {'id': 'm1', 'creationTime': 10}
+        second = {'id': 'm2', 'creationTime': 20}
+        snapshot.save([(first, [('a', 1, False)]),
+                       (second, [('a', {'x': 2}, False)])])
+        snapshot.close()
+
+        snapshot = ChannelDbSnapshot(self.path)
+        self.assertEqual(snapshot.load(), {'a': [1, {'x': 2}]})
+        self.assertFalse(snapshot.is_new(first))
+        self.assertFalse(snapshot.is_new(second))
+        self.assertTrue(snapshot.is_new({'id': 'm3', 'creationTime': 20}))
+        self.assertTrue(snapshot.is_new({'id': 'm4', 'creationTime': 30}))
+        snapshot.close()
+
+    def test_other_channel_discarded(self):
+        """A snapshot of another org or db channel is not loaded."""
+        snapshot = ChannelDbSnapshot(self.path)
+        snapshot.load('org', 'db1')
+        message = {'id': 'm1', 'creationTime': 10}
+        snapshot.save([(message, [('a', 1, False)])])
+        snapshot.close()
+
+        snapshot = ChannelDbSnapshot(self.path)
+        self.assertEqual(snapshot.load('org', 'db2'), {})
+        self.assertTrue(snapshot.is_new(message))
+        snapshot.close()
+        snapshot = ChannelDbSnapshot(self.path)
+        self.assertEqual(snapshot.load('org', 'db1'), {})
+        snapshot.close()
@@ -0,0 +1,97 @@
+import os
+import time
+from unittest import TestCase
+from mock import patch
+
+from flowbot import supervisor as supervisor_module
+from flowbot.bot import FlowBot
+from flowbot.config import ImproperlyConfigured
+from flowbot.supervisor import Supervisor
+from flowbot.tests.mocks import FakeFlow, FakeServer, signal_sends
+
+
+class WorkerBot(FlowBot):
+    """Replies with its process id; 'crash' kills the worker."""
+
+    def commands(self):
+        return {'ping': self.ping, 'crash': self.crash}
+
+    def ping(self, message):
+        self.reply(message, '%s %d' % (message['text'], os.getpid()))
+
+    def crash(self, message):
+        os._exit(1)
+
+
+SETTINGS = {'username': 'bot', 'password': 'p', 'org_id': 'org',
+            'metrics': 'none'}
+
+
+class TestSupervisor(TestCase):
+    """Test sharding a bot across worker processes."""
+
+    def setUp(self):
+        self.flow = FakeFlow(channels=8)
+        self.replies = signal_sends(self.flow)
+        monitor = patch.object(supervisor_module, 'MONITOR_SECS', 0.1)
+        monitor.start()
+        self.addCleanup(monitor.stop)
+        with patch.object(supervisor_module, 'Server',
+                          lambda config: FakeServer(self.flow)):
+            self.supervisor = Supervisor(WorkerBot, SETTINGS, workers=2)
+        self.supervisor.run(block=False)
+
+    def tearDown(self):
+        self.supervisor.cleanup()
+
+    def wait_for(self, count):
+        for _ in range(count):
+            self.assertTrue(self.replies.acquire(timeout=30))
+
+    def replies_for(self, cid):
+        return [m['text'].split() for m in self.flow.sent
+                if m['channelId'] == cid]
+
+    def test_channel_order_and_sharding(self):
+        """Each channel is answered in order by a single worker."""
+        channels = ('c0', 'c1', 'c4', 'c5')
+        for i in range(10):
+            for cid in channels:
+                self.flow.post(cid, 'ping %d' % i)
+        self.wait_for(40)
+        pids = set()
+        for cid in channels:
+            replies = self.replies_for(cid)
+            self.assertEqual([r[1] for r in replies],
+                             [str(i) for i in range(10)])
+            self.assertEqual(len(set(r[2] for r in replies)), 1)
+            pids.add(replies[0][2])
+        self.assertEqual(len(pids), 2)
+
+    def test_crashed_worker_restarted(self):
+        """A worker that dies is replaced and its channels answered."""
+        self.flow.post('c0', 'ping 0')
+        self.wait_for(1)
+        self.flow.post('c0', 'crash')
+        self.flow.post('c4', 'ping 2')
+        self.wait_for(1)
+        deadline = time.time() + 30
+        while not self.supervisor.restarts and time.time() < deadline:
+            time.sleep(0.05)
+        self.flow.post('c0', 'ping 1')
+        self.wait_for(1)
+        replies = self.replies_for('c0')
+        self.assertEqual([r[1] for r in replies], ['0', '1'])
+        self.assertEqual(len(self.replies_for('c4')), 1)
+        self.assertNotEqual(replies[0][2], replies[1][2])
+        self.assertEqual(self.supervisor.restarts, 1)
+
+
+class TestSupervisorSettings(TestCase):
+    """Test the settings a Supervisor refuses."""
+
+    def test_db_snapshot_rejected(self):
+        """Workers can't share one snapshot file, so it is refused."""
+        settings = dict(SETTINGS, db_snapshot=True)
+        with self.assertRaises(ImproperlyConfigured):
+            Supervisor(WorkerBot, settings, workers=2)
@@ -0,0 +1,34 @@
+from unittest import TestCase
+from mock import MagicMock
+
+from flowbot.write_buffer import WriteBuffer
+
+
+class TestWriteBuffer(TestCase):
+    """Test the WriteBuffer batching."""
+
+    def test_batches_by_size(self):
+        """A full batch is sent together and completes its futures."""
+        send = MagicMock()
+        buf = WriteBuffer(send, batch_size=3, interval=60)
+        futures = [buf.add(i) for i in range(3)]
+        for future in futures:
+            future.result(timeout=5)
+        buf.close()
+        send.assert_called_once_with([0, 1, 2])
+
+    def test_flushes_on_interval(self):
+        """A partial batch is sent once the interval passes."""
+        send = MagicMock()
+        buf = WriteBuffer(send, batch_size=100, interval=0.01)
+        buf.add('a').result(timeout=5)
+        buf.close()
+        send.assert_called_once_with(['a'])
+
+    def test_send_error_fails_futures(self):
+        """A failed send is reported through every future in the batch."""
+        send = MagicMock(side_effect=IOError('down'))
+        buf = WriteBuffer(send, batch_size=1, interval=60)
+        future = buf.add('a')
+        self.assertRaises(IOError, future.result, 5)
+        buf.close()